@@ -1,20 +1,128 @@
 # app.py - Main Flask application
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, Response, stream_with_context, abort
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
 import os
+import re
 import uuid
 import datetime
-from image_compare import compare_images, create_gif_from_images
+import json
+from artifacts import ARTIFACT_KINDS, KIND_COLUMNS, artifact_store
+from batch import BatchRecorder, pairs_from_directories, pairs_from_manifest, resolve_within, run_batch, with_totals
+from database import DEFAULT_SQLITE_PRAGMAS, apply_sqlite_pragmas, database_url, engine_options
 from decorators import admin_required
+from derivatives import DERIVATIVE_COLUMNS, derivative_original_stem, derivative_path
+from encoding import ARTIFACT_FORMATS, ENCODING_PRESETS, parse_encoding
+from instrumentation import instrumentation, stage
+from jobs import job_runner, comparison_options, PENDING, RUNNING, FAILED
+from metrics import METRIC_COLUMNS
+from migrations import backfill_comparison_inputs, backfill_comparison_uids, upgrade_schema
+from pagination import keyset_page
+from result_cache import PATH_COLUMNS, result_cache, comparison_key, remove_file
+from serving import send_artifact
+from sharding import shard_directory
+from stats import TTLCache, admin_stats
+from storage import storage
+from uploads import StreamingUploadRequest, UploadError, ingest_upload
 #from image_compare import compare_images, create_optimized_gif
 app = Flask(__name__)
+app.request_class = StreamingUploadRequest  # uploads are hashed while they are written to disk
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-key-for-testing')
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///image_comparison.db'
+# DATABASE_URL points the app at a server database (e.g. postgresql://...)
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url(os.environ.get('DATABASE_URL', 'sqlite:///image_comparison.db'))
+# Applied to every SQLite connection: WAL, a lock wait instead of "database is locked", a bigger cache
+app.config['SQLITE_PRAGMAS'] = dict(DEFAULT_SQLITE_PRAGMAS)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'],
+                                                         app.config['SQLITE_PRAGMAS'])
 app.config['UPLOAD_FOLDER'] = 'static/uploads/'
 app.config['OUTPUT_FOLDER'] = 'static/outputs/'
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB limit
+app.config['MAX_IMAGE_PIXELS'] = 150 * 10 ** 6  # uploads are rejected from their header above this
+app.config['MAX_IMAGE_DIMENSION'] = 30000
+# Candidates one comparison may hold; each is measured against the baseline,
+# frame by frame for animated images (see sequences.py)
+app.config['MAX_CANDIDATES'] = 20
+# Comparisons are rendered by a local process pool; set COMPARISON_JOBS_SYNC
+# to process them inside the request instead (handy for debugging)
+app.config['COMPARISON_WORKERS'] = int(os.environ.get('COMPARISON_WORKERS', os.cpu_count() or 1))
+app.config['COMPARISON_JOBS_SYNC'] = os.environ.get('COMPARISON_JOBS_SYNC') == '1'
+app.config['JOB_POLL_INTERVAL'] = 2.0  # seconds between queue scans
+app.config['JOB_STALE_SECONDS'] = 3600  # running jobs older than this are requeued
+# Threads per comparison for running the color, grayscale and GIF renderers
+# side by side (0 renders them one after the other)
+app.config['RENDER_WORKERS'] = int(os.environ.get('RENDER_WORKERS', 3))
+# Color difference metric for the heatmap: 'cie76' (fast) or 'ciede2000' (perceptual)
+app.config['DELTA_E_METHOD'] = os.environ.get('DELTA_E_METHOD', 'cie76')
+app.config['DIFF_THRESHOLD'] = 50  # grayscale difference that counts as a change
+app.config['GIF_DURATION'] = 1000.0  # milliseconds per GIF frame
+# Longest side the images are decoded to before diffing (None keeps native size)
+app.config['MAX_IMAGE_DIM'] = 3000
+# With MAX_IMAGE_DIM = None, pairs of at least this many pixels are diffed in
+# row bands from memory-mapped rasters instead of whole frames in memory
+app.config['TILED_COMPARE_MIN_PIXELS'] = 50 * 10 ** 6
+# Pairs whose max Delta-E and changed-pixel fraction are within these limits
+# are only measured, not rendered (None disables a limit)
+app.config['TOLERANCE_MAX_DELTA_E'] = 2.3  # roughly one just-noticeable difference
+app.config['TOLERANCE_CHANGED_RATIO'] = 0.0
+# Align the second image onto the first before diffing, so shifts and crop
+# differences are not reported as changes: 'translation', 'similarity'
+# (shift, rotation and scale) or 'homography'; unset diffs pixel for pixel.
+# Pairs handled by the tiled engine are never registered.
+app.config['REGISTRATION'] = os.environ.get('REGISTRATION') or None
+# Jobs only measure a pair; the overlays and GIF are rendered when the
+# comparison page first asks for them (RENDER_ARTIFACTS_EAGERLY=1 renders
+# them in the job instead)
+app.config['RENDER_ARTIFACTS_EAGERLY'] = os.environ.get('RENDER_ARTIFACTS_EAGERLY') == '1'
+# Output formats: overlays and region zooms can be 'jpeg', 'webp', 'avif' or
+# 'png' (lossless); the alternating animation 'gif', 'webp', 'avif' or 'png'
+# (APNG). ENCODING_PRESET ('high', 'balanced' or 'small') sets the quality and
+# encoder effort, and ENCODING_QUALITY (1-100) overrides the preset's quality.
+# Unset means JPEG overlays and zooms, a GIF and the 'high' preset. A
+# comparison can pick its own on /compare or in a batch request.
+app.config['OVERLAY_FORMAT'] = os.environ.get('OVERLAY_FORMAT') or None
+app.config['ANIMATION_FORMAT'] = os.environ.get('ANIMATION_FORMAT') or None
+app.config['ZOOM_FORMAT'] = os.environ.get('ZOOM_FORMAT') or None
+app.config['ENCODING_PRESET'] = os.environ.get('ENCODING_PRESET') or None
+app.config['ENCODING_QUALITY'] = int(os.environ['ENCODING_QUALITY']) if os.environ.get('ENCODING_QUALITY') else None
+# Directory the batch API may read baselines, candidates and manifests from
+# (the API is disabled while this is unset)
+app.config['BATCH_ROOT'] = os.environ.get('BATCH_ROOT')
+app.config['BATCH_WORKERS'] = int(os.environ.get('BATCH_WORKERS', os.cpu_count() or 1))
+app.config['BATCH_COMMIT_EVERY'] = 100  # batch results stored per transaction
+# Identical uploads reuse earlier results; rendered outputs of the least
+# recently used comparisons are evicted past this many bytes (None = no limit)
+app.config['RESULT_CACHE_MAX_BYTES'] = 5 * 1024 ** 3
+# Bytes each user may keep on disk (None = no limit); User.storage_quota overrides it per user
+app.config['STORAGE_QUOTA_BYTES'] = (int(os.environ['STORAGE_QUOTA_BYTES'])
+                                     if os.environ.get('STORAGE_QUOTA_BYTES') else None)
+# Seconds between garbage collection passes over the upload and output
+# folders (None disables the collector; "python storage.py" runs one pass).
+# Files younger than the grace period are never collected.
+app.config['STORAGE_GC_INTERVAL'] = (float(os.environ['STORAGE_GC_INTERVAL'])
+                                     if os.environ.get('STORAGE_GC_INTERVAL') else None)
+app.config['STORAGE_GC_GRACE_SECONDS'] = 3600
+# Rendered outputs unused for this many days are dropped by the collector and
+# rendered again from the kept inputs when next viewed (None keeps them)
+app.config['OUTPUT_RETENTION_DAYS'] = (float(os.environ['OUTPUT_RETENTION_DAYS'])
+                                       if os.environ.get('OUTPUT_RETENTION_DAYS') else None)
+# Let the front-end web server send uploads and artifacts (X-Sendfile) instead
+# of the app; without it, gunicorn still sends them with sendfile(2)
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+# Rows per page of the dashboard and admin lists, and cards per page of the public feed
+app.config['LISTING_PAGE_SIZE'] = 50
+app.config['PUBLIC_FEED_PAGE_SIZE'] = 6
+# Activity window of /api/admin/stats in days (?days= overrides it up to the max)
+app.config['ADMIN_STATS_DAYS'] = 7
+app.config['ADMIN_STATS_MAX_DAYS'] = 366
+app.config['ADMIN_STATS_TTL'] = 30  # seconds the statistics are cached per process
+# /metrics is open unless this is set; scrapers then send "Authorization: Bearer <token>"
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+# Requests and jobs taking at least this many seconds are dumped as cProfile
+# stats to PROFILE_DIR (unset disables profiling, which slows every request)
+app.config['PROFILE_SLOW_SECONDS'] = (float(os.environ['PROFILE_SLOW_SECONDS'])
+                                      if os.environ.get('PROFILE_SLOW_SECONDS') else None)
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
 
 # Create folders if they don't exist
 for folder in [app.config['UPLOAD_FOLDER'], app.config['OUTPUT_FOLDER']]:
@@ -22,6 +130,8 @@ for folder in [app.config['UPLOAD_FOLDER'], app.config['OUTPUT_FOLDER']]:
 
 # Initialize database
 db = SQLAlchemy(app)
+with app.app_context():
+    apply_sqlite_pragmas(db.engine, app.config['SQLITE_PRAGMAS'])
 
 # Initialize login manager
 login_manager = LoginManager()
@@ -35,6 +145,7 @@ class User(UserMixin, db.Model):
     email = db.Column(db.String(100), unique=True)
     password_hash = db.Column(db.String(200))
     role = db.Column(db.String(20), default='user')  # Options: 'admin', 'user'
+    storage_quota = db.Column(db.BigInteger)  # bytes; NULL uses STORAGE_QUOTA_BYTES
     comparisons = db.relationship('Comparison', backref='user', lazy=True)
 
     def set_password(self, password):
@@ -57,6 +168,130 @@ class Comparison(db.Model):
     gray_diff2_path = db.Column(db.String(255))
     created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     is_public = db.Column(db.Boolean, default=False)
+    cache_key = db.Column(db.String(64), index=True)
+    uid = db.Column(db.String(32), index=True)  # names its uploads, job outputs and uncached artifacts
+    image1_sha256 = db.Column(db.String(64))
+    image1_format = db.Column(db.String(10))
+    image1_width = db.Column(db.Integer)
+    image1_height = db.Column(db.Integer)
+    image2_sha256 = db.Column(db.String(64))
+    image2_format = db.Column(db.String(10))
+    image2_width = db.Column(db.Integer)
+    image2_height = db.Column(db.Integer)
+    max_delta_e = db.Column(db.Float)
+    mean_delta_e = db.Column(db.Float)
+    changed_ratio = db.Column(db.Float)  # fraction of pixels above DIFF_THRESHOLD
+    ssim = db.Column(db.Float)
+    psnr = db.Column(db.Float)  # NULL for identical images
+    metrics_scale = db.Column(db.Float)  # 1.0 when measured at full working resolution
+    within_tolerance = db.Column(db.Boolean, index=True)
+    derivatives = db.Column(db.JSON)  # {kind: {size: [width, height]}} of the thumbnails and previews
+    regions = db.Column(db.JSON)  # changed regions, see regions.find_regions
+    registration = db.Column(db.JSON)  # transform the job estimated, see registration.transform_record
+    output_encoding = db.Column(db.JSON)  # formats and preset chosen for this comparison, see encoding.parse_encoding
+    storage_bytes = db.Column(db.BigInteger, default=0)  # bytes of its files on disk, see storage.Storage.account
+    description_preview = db.query_expression()  # start of the description, loaded by listing_query
+
+    # Newest-first listings: the public feed, a user's dashboard, and the
+    # admin list and stats (range scans on created_at)
+    __table_args__ = (
+        db.Index('ix_comparison_public_created', 'is_public', 'created_at', 'id'),
+        db.Index('ix_comparison_user_created', 'user_id', 'created_at', 'id'),
+        db.Index('ix_comparison_created', 'created_at', 'id'),
+    )
+
+class ComparisonInput(db.Model):
+    # The baseline (position 0) and the candidates (1 and up) of a comparison.
+    # The baseline and first candidate are also Comparison.image1_*/image2_*,
+    # which the result cache, the artifacts and the listings work on.
+    id = db.Column(db.Integer, primary_key=True)
+    comparison_id = db.Column(db.Integer, db.ForeignKey('comparison.id'), nullable=False)
+    position = db.Column(db.Integer, nullable=False)
+    path = db.Column(db.String(255))
+    sha256 = db.Column(db.String(64))
+    format = db.Column(db.String(10))
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    frame_count = db.Column(db.Integer)  # NULL for inputs from before animations were measured
+    # Results of a candidate against the baseline, worst frame first (NULL for the baseline)
+    max_delta_e = db.Column(db.Float)
+    mean_delta_e = db.Column(db.Float)
+    changed_ratio = db.Column(db.Float)
+    ssim = db.Column(db.Float)
+    psnr = db.Column(db.Float)
+    metrics_scale = db.Column(db.Float)
+    within_tolerance = db.Column(db.Boolean)
+    frames_compared = db.Column(db.Integer)
+    worst_frame = db.Column(db.Integer)  # frame with the largest max Delta-E
+    comparison = db.relationship('Comparison', backref=db.backref(
+        'inputs', lazy=True, order_by='ComparisonInput.position', cascade='all, delete-orphan'))
+
+    __table_args__ = (
+        db.UniqueConstraint('comparison_id', 'position', name='uq_comparison_input_position'),
+    )
+
+class ResultCacheEntry(db.Model):
+    key = db.Column(db.String(64), primary_key=True)
+    image1_path = db.Column(db.String(255))
+    image2_path = db.Column(db.String(255))
+    gif_path = db.Column(db.String(255))
+    color_diff1_path = db.Column(db.String(255))
+    color_diff2_path = db.Column(db.String(255))
+    gray_diff1_path = db.Column(db.String(255))
+    gray_diff2_path = db.Column(db.String(255))
+    size_bytes = db.Column(db.Integer, default=0)  # bytes of rendered outputs on disk
+    refcount = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, index=True)
+
+class ComparisonJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    comparison_id = db.Column(db.Integer, db.ForeignKey('comparison.id'), nullable=False)
+    uid = db.Column(db.String(32), nullable=False)
+    status = db.Column(db.String(20), default=PENDING, index=True)  # Options: 'pending', 'running', 'done', 'failed'
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    comparison = db.relationship('Comparison', backref=db.backref('jobs', lazy=True, cascade='all, delete-orphan'))
+
+    __table_args__ = (
+        db.Index('ix_comparison_job_comparison', 'comparison_id', 'id'),  # latest job of a comparison
+    )
+
+job_runner.init_app(app, db, ComparisonJob, Comparison)
+result_cache.init_app(app, db, ResultCacheEntry, Comparison)
+job_runner.on_complete(result_cache.store)
+job_runner.on_complete(storage.account)
+admin_stats_cache = TTLCache(app.config['ADMIN_STATS_TTL'])
+artifact_store.init_app(app, db, result_cache)
+instrumentation.init_app(app, db, ComparisonJob)
+storage.init_app(app, db, Comparison, ComparisonInput, ResultCacheEntry, ComparisonJob, result_cache)
+
+# Columns the listing templates use; the description and the other path
+# columns are left unloaded until something touches them
+LISTING_COLUMNS = ('id', 'user_id', 'title', 'created_at', 'is_public', 'max_delta_e', 'within_tolerance',
+                   'image2_path', 'color_diff2_path', 'derivatives')
+
+def listing_query(query, with_owner=False):
+    """Restricts a Comparison query to the listing columns, optionally joining in the owner's username."""
+    query = query.options(
+        db.load_only(*(getattr(Comparison, column) for column in LISTING_COLUMNS)),
+        db.with_expression(Comparison.description_preview, db.func.substr(Comparison.description, 1, 101))
+    )
+    if with_owner:
+        query = query.join(Comparison.user).options(db.contains_eager(Comparison.user).load_only(User.username))
+    return query
+
+def filter_by_metrics(query, status=None, min_delta_e=None):
+    """Applies the dashboard's optional filters on the stored metrics."""
+    if status == 'changed':
+        query = query.filter(Comparison.within_tolerance.is_(False))
+    elif status == 'within':
+        query = query.filter(Comparison.within_tolerance.is_(True))
+    if min_delta_e is not None:
+        query = query.filter(Comparison.max_delta_e >= min_delta_e)
+    return query
 
 # User loader for Flask-Login
 @login_manager.user_loader
@@ -66,8 +301,12 @@ def load_user(user_id):
 # Routes
 @app.route('/')
 def index():
-    public_comparisons = Comparison.query.filter_by(is_public=True).order_by(Comparison.created_at.desc()).limit(5).all()
-    return render_template('index.html', public_comparisons=public_comparisons)
+    query = listing_query(Comparison.query.filter(Comparison.is_public.is_(True)), with_owner=True)
+    try:
+        page = keyset_page(query, Comparison, request.args.get('cursor'), app.config['PUBLIC_FEED_PAGE_SIZE'])
+    except ValueError:
+        abort(400)
+    return render_template('index.html', public_comparisons=page.items, page=page)
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -121,8 +360,69 @@ def logout():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    user_comparisons = Comparison.query.filter_by(user_id=current_user.id).order_by(Comparison.created_at.desc()).all()
-    return render_template('dashboard.html', comparisons=user_comparisons)
+    # Optional filters on the stored metrics
+    status = request.args.get('status')
+    min_delta_e = request.args.get('min_delta_e', type=float)
+    query = filter_by_metrics(Comparison.query.filter_by(user_id=current_user.id), status, min_delta_e)
+
+    try:
+        page = keyset_page(listing_query(query), Comparison, request.args.get('cursor'),
+                           app.config['LISTING_PAGE_SIZE'])
+    except ValueError:
+        abort(400)
+    return render_template('dashboard.html', comparisons=page.items, page=page, status=status,
+                           min_delta_e=min_delta_e, usage=storage.usage(current_user.id),
+                           quota=storage.quota(current_user))
+
+@app.route('/api/comparisons')
+def comparisons_api():
+    # JSON pages of the public feed ('public'), the dashboard ('mine') or the admin list ('all')
+    scope = request.args.get('scope', 'public')
+    if scope == 'public':
+        query = Comparison.query.filter(Comparison.is_public.is_(True))
+    elif scope == 'mine':
+        if not current_user.is_authenticated:
+            return jsonify({'error': 'Login required'}), 401
+        query = filter_by_metrics(Comparison.query.filter_by(user_id=current_user.id), request.args.get('status'),
+                                  request.args.get('min_delta_e', type=float))
+    elif scope == 'all':
+        if not current_user.is_authenticated or current_user.role != 'admin':
+            return jsonify({'error': 'Not authorized'}), 403
+        query = Comparison.query
+    else:
+        return jsonify({'error': f'Unknown scope {scope!r}'}), 400
+
+    try:
+        page = keyset_page(listing_query(query, with_owner=scope != 'mine'), Comparison, request.args.get('cursor'),
+                           request.args.get('per_page', app.config['LISTING_PAGE_SIZE'], type=int))
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+
+    return jsonify({
+        'comparisons': [listing_item(comparison, with_owner=scope != 'mine') for comparison in page.items],
+        'next_cursor': page.next_cursor
+    })
+
+def listing_item(comparison, with_owner=False):
+    """JSON form of a listing row, with the srcsets of its thumbnail."""
+    kind = thumbnail_kind(comparison)
+    item = {
+        'id': comparison.id,
+        'title': comparison.title,
+        'created_at': comparison.created_at.isoformat(),
+        'is_public': comparison.is_public,
+        'max_delta_e': comparison.max_delta_e,
+        'within_tolerance': comparison.within_tolerance,
+        'url': url_for('view_comparison', comparison_id=comparison.id),
+        'thumbnail': {
+            'src': derivative_url(comparison, kind, 'thumb', 'jpeg'),
+            'srcset': derivative_srcset(comparison, kind, 'jpeg'),
+            'webp_srcset': derivative_srcset(comparison, kind, 'webp')
+        } if kind else None
+    }
+    if with_owner:
+        item['username'] = comparison.user.username
+    return item
 
 @app.route('/team')
 @login_required
@@ -171,56 +471,104 @@ def demote_user(user_id):
 @login_required
 def compare():
     if request.method == 'POST':
-        image1 = request.files.get('image1')
-        image2 = request.files.get('image2')
+        # Checked before the body is read; the upload size is bounded by the request's
+        # length, so a body without one (chunked) is refused rather than let past the quota
+        if request.content_length is None:
+            abort(411)
+        if not storage.allows(current_user, request.content_length):
+            flash('These images would exceed your storage quota. Delete some comparisons to make room.')
+            return redirect(url_for('compare'))
+        with stage('upload'):
+            image1 = request.files.get('image1')
+            # Several candidates may be uploaded at once; each is compared with image1
+            candidates = [image for image in request.files.getlist('image2') if image]
         title = request.form.get('title', 'Untitled Comparison')
         description = request.form.get('description', '')
         is_public = 'is_public' in request.form
 
-        if not image1 or not image2:
+        if not image1 or not candidates:
             flash('Both images are required')
             return redirect(url_for('compare'))
+        if len(candidates) > app.config['MAX_CANDIDATES']:
+            flash(f"At most {app.config['MAX_CANDIDATES']} candidate images can be compared at once")
+            return redirect(url_for('compare'))
+        try:
+            output_encoding = parse_encoding(request.form) or None
+        except ValueError as exc:
+            flash(f'Invalid output format: {exc}')
+            return redirect(url_for('compare'))
 
         uid = uuid.uuid4().hex
 
-        # Save uploaded images
-        path1 = os.path.join(app.config['UPLOAD_FOLDER'], f"{uid}_img1.png")
-        path2 = os.path.join(app.config['UPLOAD_FOLDER'], f"{uid}_img2.png")
-        image1.save(path1)
-        image2.save(path2)
-
-        # Define output paths
-        out1 = os.path.join(app.config['OUTPUT_FOLDER'], f"{uid}_out1.jpg")
-        out2 = os.path.join(app.config['OUTPUT_FOLDER'], f"{uid}_out2.jpg")
-        gif_path = os.path.join(app.config['OUTPUT_FOLDER'], f"{uid}_output.gif")
-
-        # Process images
-        compare_results = compare_images(path1, path2, out1, out2, mode="both")
-        create_gif_from_images(path1, path2, gif_path)
+        # Move the uploads into place, rejecting anything that is not an image
+        uploads = []
+        try:
+            for n, image in enumerate([image1, *candidates], start=1):
+                with stage('ingest'):
+                    uploads.append(ingest_upload(
+                        image, shard_directory(app.config['UPLOAD_FOLDER'], uid), f"{uid}_img{n}",
+                        max_pixels=app.config['MAX_IMAGE_PIXELS'],
+                        max_dimension=app.config['MAX_IMAGE_DIMENSION']
+                    ))
+        except UploadError as exc:
+            for upload in uploads:
+                remove_file(upload['path'])
+            flash(str(exc))
+            return redirect(url_for('compare'))
+        # Checked again on what was actually written: other uploads may have been stored meanwhile
+        if not storage.allows(current_user, sum(upload['size'] for upload in uploads)):
+            for upload in uploads:
+                remove_file(upload['path'])
+            flash('These images would exceed your storage quota. Delete some comparisons to make room.')
+            return redirect(url_for('compare'))
+        upload1, upload2 = uploads[:2]
+        path1, path2 = upload1['path'], upload2['path']
 
-        # Create database entry
+        # Create database entry; the overlays and GIF are rendered by a background job
         comparison = Comparison(
             user_id=current_user.id,
             title=title,
             description=description,
             image1_path=path1,
             image2_path=path2,
-            gif_path=gif_path,
-            color_diff1_path=compare_results.get('color1'),
-            color_diff2_path=compare_results.get('color2'),
-            gray_diff1_path=compare_results.get('gray1'),
-            gray_diff2_path=compare_results.get('gray2'),
-            is_public=is_public
+            is_public=is_public,
+            output_encoding=output_encoding,
+            uid=uid,
+            cache_key=comparison_key([upload['sha256'] for upload in uploads],
+                                     comparison_options(app.config, output_encoding),
+                                     multi_frame=any(upload['frames'] > 1 for upload in uploads))
         )
-
-        db.session.add(comparison)
-        db.session.commit()
+        for n, upload in enumerate(uploads[:2], start=1):
+            setattr(comparison, f'image{n}_sha256', upload['sha256'])
+            setattr(comparison, f'image{n}_format', upload['format'])
+            setattr(comparison, f'image{n}_width', upload['width'])
+            setattr(comparison, f'image{n}_height', upload['height'])
+        for position, upload in enumerate(uploads):
+            comparison.inputs.append(ComparisonInput(
+                position=position, path=upload['path'], sha256=upload['sha256'], format=upload['format'],
+                width=upload['width'], height=upload['height'], frame_count=upload['frames']
+            ))
+
+        # Reuse the files of an identical earlier comparison when we have them
+        entry = result_cache.lookup(comparison.cache_key) if comparison.cache_key else None
+        if entry:
+            remove_file(path1)
+            remove_file(path2)
+            result_cache.attach(comparison, entry)
+            storage.account(comparison)
+            with stage('db_commit'):
+                db.session.commit()
+        else:
+            db.session.add(comparison)
+            job_runner.enqueue(comparison, uid)
+            with stage('db_commit'):
+                db.session.commit()
+            job_runner.wake()
 
         return redirect(url_for('view_comparison', comparison_id=comparison.id))
 
-    return render_template('compare.html')
-from pathlib import Path
-
+    return render_template('compare.html', artifact_formats=ARTIFACT_FORMATS, encoding_presets=ENCODING_PRESETS,
+                           max_candidates=app.config['MAX_CANDIDATES'])
 @app.route('/comparison/<int:comparison_id>')
 def view_comparison(comparison_id):
     comparison = Comparison.query.get_or_404(comparison_id)
@@ -229,32 +577,217 @@ def view_comparison(comparison_id):
         flash('You do not have permission to view this comparison')
         return redirect(url_for('index'))
 
-    # Normalize paths for use in HTML
-    def relative_static_path(full_path):
-        if full_path and 'static/' in full_path:
-            return str(Path(full_path).relative_to('static'))
-        return None
-
-    comparison.gif_path = relative_static_path(comparison.gif_path)
-    comparison.color_diff1_path = relative_static_path(comparison.color_diff1_path)
-    comparison.color_diff2_path = relative_static_path(comparison.color_diff2_path)
-    comparison.gray_diff1_path = relative_static_path(comparison.gray_diff1_path)
-    comparison.gray_diff2_path = relative_static_path(comparison.gray_diff2_path)
-    comparison.image1_path = relative_static_path(comparison.image1_path)
-    comparison.image2_path = relative_static_path(comparison.image2_path)
-
+    # Show a status page until the background job has rendered the artifacts
+    job = latest_job(comparison)
+    if job and job.status in (PENDING, RUNNING, FAILED):
+        if job.status != FAILED:
+            job_runner.wake()
+        return render_template('comparison_status.html', comparison=comparison, job=job)
+
+    result_cache.touch(comparison)
+
+    # Rendered artifacts are linked at their immutable file URLs; the others
+    # are rendered on first request by comparison_artifact
+    artifact_urls = {}
+    for kind in ARTIFACT_KINDS:
+        path = getattr(comparison, KIND_COLUMNS[kind])
+        if file_exists_filter(path):
+            artifact_urls[kind] = file_url(path)
+        else:
+            artifact_urls[kind] = url_for('comparison_artifact', comparison_id=comparison.id, kind=kind)
     file_paths = {
-        'color_diff1_exists': bool(comparison.color_diff1_path),
-        'color_diff2_exists': bool(comparison.color_diff2_path),
-        'gray_diff1_exists': bool(comparison.gray_diff1_path),
-        'gray_diff2_exists': bool(comparison.gray_diff2_path),
-        'gif_exists': bool(comparison.gif_path),
-        'image1_exists': bool(comparison.image1_path),
-        'image2_exists': bool(comparison.image2_path)
+        'image1_exists': file_exists_filter(comparison.image1_path),
+        'image2_exists': file_exists_filter(comparison.image2_path)
     }
+    # Sets and animations list every candidate with its own results
+    inputs = comparison.inputs
+    candidates = inputs[1:] if len(inputs) > 2 or any((row.frame_count or 1) > 1 for row in inputs) else []
 
-    return render_template('comparison.html', comparison=comparison, file_paths=file_paths)
+    return render_template('comparison.html', comparison=comparison, file_paths=file_paths, candidates=candidates,
+                           artifact_urls=artifact_urls)
 
+@app.route('/comparison/<int:comparison_id>/artifact/<kind>')
+def comparison_artifact(comparison_id, kind):
+    comparison = Comparison.query.get_or_404(comparison_id)
+
+    if not comparison.is_public and (not current_user.is_authenticated or current_user.id != comparison.user_id):
+        abort(403)
+    if kind not in ARTIFACT_KINDS:
+        abort(404)
+    if not file_exists_filter(comparison.image1_path) or not file_exists_filter(comparison.image2_path):
+        abort(404)
+
+    path = artifact_store.get(comparison, kind)
+    return send_artifact(path, etag=stored_etag(path, [comparison]), private=not comparison.is_public)
+
+@app.route('/comparison/<int:comparison_id>/region/<int:index>')
+def comparison_region(comparison_id, index):
+    comparison = Comparison.query.get_or_404(comparison_id)
+
+    if not comparison.is_public and (not current_user.is_authenticated or current_user.id != comparison.user_id):
+        abort(403)
+    if not file_exists_filter(comparison.image1_path) or not file_exists_filter(comparison.image2_path):
+        abort(404)
+
+    path = artifact_store.region_zoom(comparison, index)
+    if path is None:
+        abort(404)
+    return send_artifact(path, etag=stored_etag(path, [comparison]), private=not comparison.is_public)
+
+# Folders served by comparison_file, by URL prefix
+FILE_FOLDERS = {'uploads': 'UPLOAD_FOLDER', 'outputs': 'OUTPUT_FOLDER'}
+
+# Leading uid (see Comparison.uid) or cache key of a file name
+FILE_OWNER_NAME = re.compile(r'([0-9a-f]{64}|[0-9a-f]{32})_')
+
+def file_comparisons(path):
+    """
+    Returns the comparisons that use a file under the upload or output folder.
+
+    Files are named after the uid or cache key of the comparison that wrote
+    them, which the indexed columns find; rows sharing them through the
+    result cache are found by their cache key. Files without such a name, or
+    that outlived the comparison that wrote them, are looked up by path.
+    """
+    owner = FILE_OWNER_NAME.match(os.path.basename(path))
+    comparisons = []
+    if owner:
+        comparisons = Comparison.query.filter(db.or_(Comparison.uid == owner.group(1),
+                                                     Comparison.cache_key == owner.group(1))).all()
+    keys = set()
+    if not comparisons:
+        stem = derivative_original_stem(path)
+        def refers(column):
+            return column.startswith(stem + '.', autoescape=True) if stem else column == path
+        keys = set(db.session.scalars(db.select(ResultCacheEntry.key).where(
+            db.or_(*[refers(getattr(ResultCacheEntry, column)) for column in PATH_COLUMNS]))))
+        comparisons = Comparison.query.filter(db.or_(
+            *[refers(getattr(Comparison, column)) for column in PATH_COLUMNS],
+            Comparison.id.in_(db.select(ComparisonInput.comparison_id).where(refers(ComparisonInput.path)))
+        )).all()
+    keys.update(comparison.cache_key for comparison in comparisons if comparison.cache_key)
+    if keys:
+        comparisons += Comparison.query.filter(Comparison.cache_key.in_(keys),
+                                               Comparison.id.notin_([c.id for c in comparisons])).all()
+    return comparisons
+
+def stored_etag(path, comparisons):
+    """
+    Returns the ETag of a file served for comparisons, without reading the file.
+
+    Uploads are tagged with the SHA-256 stored when they were ingested, and
+    other files named by a uid or cache key with that name, which always holds
+    the same content. Other files get None (see serving.send_artifact).
+    """
+    path = os.path.normpath(path)
+    for comparison in comparisons:
+        for row in comparison.inputs:
+            if row.sha256 and row.path and os.path.normpath(row.path) == path:
+                return row.sha256
+    name = os.path.basename(path)
+    return name if FILE_OWNER_NAME.match(name) else None
+
+@app.route('/files/<folder>/<path:filename>')
+def comparison_file(folder, filename):
+    if folder not in FILE_FOLDERS or os.path.basename(filename).startswith('.'):
+        abort(404)
+    path = safe_join(app.config[FILE_FOLDERS[folder]], filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    comparisons = file_comparisons(path)
+    if not comparisons:
+        abort(404)
+    is_public = any(comparison.is_public for comparison in comparisons)
+    if not is_public and (not current_user.is_authenticated
+                          or all(current_user.id != comparison.user_id for comparison in comparisons)):
+        abort(403)
+    # A file named by uid or cache key always holds the same content, so its URL is immutable
+    immutable = FILE_OWNER_NAME.match(os.path.basename(path)) is not None
+    return send_artifact(path, etag=stored_etag(path, comparisons), immutable=immutable, private=not is_public)
+
+def latest_job(comparison):
+    return ComparisonJob.query.filter_by(comparison_id=comparison.id).order_by(ComparisonJob.id.desc()).first()
+
+@app.route('/api/comparison/<int:comparison_id>/status')
+def comparison_status_api(comparison_id):
+    comparison = Comparison.query.get_or_404(comparison_id)
+
+    if not comparison.is_public and (not current_user.is_authenticated or current_user.id != comparison.user_id):
+        return jsonify({'error': 'Not authorized'}), 403
+
+    job = latest_job(comparison)
+    return jsonify({
+        'status': job.status if job else 'done',
+        'error': job.error if job else None,
+        'metrics': {key: getattr(comparison, column) for key, column in METRIC_COLUMNS.items()},
+        'candidates': [dict({key: getattr(row, column) for key, column in METRIC_COLUMNS.items()},
+                            position=row.position, frame_count=row.frame_count,
+                            frames_compared=row.frames_compared, worst_frame=row.worst_frame)
+                       for row in comparison.inputs if row.position > 0]
+    })
+
+def batch_results(pairs, user_id, title=None, is_public=False, workers=None, options=None, output_encoding=None):
+    """
+    Runs a batch for a user and stores every result as a Comparison.
+
+    Yields the per-pair results followed by a summary record. Must be consumed
+    inside an app context; rows are committed every BATCH_COMMIT_EVERY pairs
+    and once more at the end. options override the configured rendering
+    parameters, and output_encoding the configured output formats (see
+    encoding.parse_encoding).
+    """
+    options = dict(comparison_options(app.config, output_encoding), **(options or {}))
+    recorder = BatchRecorder(db, Comparison, user_id, app.config['UPLOAD_FOLDER'], options,
+                             result_cache=result_cache, title=title, is_public=is_public,
+                             commit_every=app.config['BATCH_COMMIT_EVERY'], output_encoding=output_encoding,
+                             storage=storage, input_model=ComparisonInput)
+    results = run_batch(pairs, app.config['OUTPUT_FOLDER'], options, workers or app.config['BATCH_WORKERS'],
+                        describe_inputs=True, tiled_min_pixels=app.config['TILED_COMPARE_MIN_PIXELS'],
+                        prepare=recorder.stage, derivatives=True, shard=True)
+    try:
+        yield from with_totals(map(recorder.record, results))
+    finally:
+        recorder.commit()
+
+@app.route('/api/batch', methods=['POST'])
+@login_required
+def batch_api():
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Not authorized'}), 403
+
+    root = app.config['BATCH_ROOT']
+    if not root:
+        return jsonify({'error': 'Batch comparisons are disabled (BATCH_ROOT is not set)'}), 403
+    if not storage.allows(current_user):
+        return jsonify({'error': 'Storage quota exceeded'}), 403
+
+    # Pairs come from a manifest, two directories or an inline list, all inside BATCH_ROOT
+    payload = request.get_json(silent=True) or {}
+    try:
+        if payload.get('manifest'):
+            pairs = pairs_from_manifest(payload['manifest'], root=root)
+        elif payload.get('baseline_dir') and payload.get('candidate_dir'):
+            pairs = pairs_from_directories(payload['baseline_dir'], payload['candidate_dir'], root=root)
+        elif payload.get('pairs'):
+            pairs = [{
+                'name': pair.get('name') or os.path.basename(pair['candidate']),
+                'baseline': resolve_within(root, pair['baseline']),
+                'candidate': resolve_within(root, pair['candidate'])
+            } for pair in payload['pairs']]
+        else:
+            return jsonify({'error': 'Provide a manifest, baseline_dir and candidate_dir, or pairs'}), 400
+        overrides = {key: None if payload[key] is None else float(payload[key])
+                     for key in ('tolerance_delta_e', 'tolerance_changed_ratio') if key in payload}
+        output_encoding = parse_encoding(payload) or None
+    except (KeyError, TypeError, OSError, ValueError) as exc:
+        return jsonify({'error': f'Invalid batch request: {exc}'}), 400
+
+    results = batch_results(pairs, current_user.id, title=payload.get('title'),
+                            is_public=bool(payload.get('is_public')), options=overrides,
+                            output_encoding=output_encoding)
+    lines = (json.dumps(result) + '\n' for result in results)
+    return Response(stream_with_context(lines), mimetype='application/x-ndjson')
 
 @app.route('/delete/<int:comparison_id>')
 @login_required
@@ -266,15 +799,8 @@ def delete_comparison(comparison_id):
         flash('You do not have permission to delete this comparison')
         return redirect(url_for('dashboard'))
 
-    # Delete associated files
-    for path in [comparison.image1_path, comparison.image2_path, comparison.gif_path,
-                comparison.color_diff1_path, comparison.color_diff2_path,
-                comparison.gray_diff1_path, comparison.gray_diff2_path]:
-        if path and os.path.exists(path):
-            try:
-                os.remove(path)
-            except:
-                pass
+    # Delete associated files that no other comparison shares
+    result_cache.release(comparison)
 
     db.session.delete(comparison)
     db.session.commit()
@@ -285,50 +811,107 @@ def delete_comparison(comparison_id):
 @app.template_filter('file_exists')
 def file_exists_filter(path):
     return path and os.path.exists(path)
-# Add this to your app.py file
-# Replace the existing admin_dashboard route with this corrected version
+
+@app.template_global()
+def file_url(path):
+    """Returns the URL of an upload, artifact or derivative."""
+    for folder, key in FILE_FOLDERS.items():
+        relative = os.path.relpath(os.path.abspath(path), os.path.abspath(app.config[key]))
+        if not relative.startswith(os.pardir):
+            return url_for('comparison_file', folder=folder, filename=relative.replace(os.sep, '/'))
+    return url_for('static', filename=os.path.relpath(path, 'static').replace(os.sep, '/'))
+
+@app.template_global()
+def derivative_srcset(comparison, kind, fmt):
+    """Returns the srcset of the thumbnails and previews of one image of comparison ('' if it has none)."""
+    path = getattr(comparison, DERIVATIVE_COLUMNS[kind])
+    sizes = (comparison.derivatives or {}).get(kind)
+    if not path or not sizes:
+        return ''
+    return ', '.join(f"{file_url(derivative_path(path, size, fmt))} {width}w"
+                     for size, (width, height) in sorted(sizes.items(), key=lambda item: item[1][0]))
+
+@app.template_global()
+def thumbnail_kind(comparison):
+    """Image kind shown in listings: the color overlay once it has derivatives, else the second image (or None)."""
+    for kind in ('color2', 'image2'):
+        if getattr(comparison, DERIVATIVE_COLUMNS[kind]) and (comparison.derivatives or {}).get(kind):
+            return kind
+    return None
+
+@app.template_global()
+def derivative_url(comparison, kind, size, fmt):
+    """Returns the URL of one derivative of comparison, or None."""
+    path = getattr(comparison, DERIVATIVE_COLUMNS[kind])
+    if not path or size not in (comparison.derivatives or {}).get(kind, {}):
+        return None
+    return file_url(derivative_path(path, size, fmt))
 @app.route('/admin/dashboard')
 @admin_required
 def admin_dashboard():
-    # Get all comparisons
-    comparisons = Comparison.query.all()  # Changed from ImageComparison to Comparison
-
-    # Get all users
-    users = User.query.all()
-
-    # Add username attribute to each comparison object
-    for comparison in comparisons:
-        user = User.query.get(comparison.user_id)
-        comparison.username = user.username if user else "Unknown"
-
-    # Count comparisons per user
-    users_with_counts = []
-    comparisons_by_user = {}
-
-    for user in users:
-        user_comparisons = Comparison.query.filter_by(user_id=user.id).all()  # Changed from ImageComparison to Comparison
-        users_with_counts.append((user, len(user_comparisons)))
-        comparisons_by_user[user.username] = user_comparisons
+    # Counts come from aggregate queries, never from loading the rows
+    total, public = db.session.query(
+        db.func.count(Comparison.id),
+        db.func.coalesce(db.func.sum(db.case((Comparison.is_public.is_(True), 1), else_=0)), 0)
+    ).one()
+
+    # Users with their comparison counts in one grouped query; each user's
+    # comparisons are loaded on demand by admin_user_comparisons_api
+    users_with_counts = db.session.query(User, db.func.count(Comparison.id)).outerjoin(
+        Comparison, Comparison.user_id == User.id
+    ).group_by(User.id).order_by(User.username).all()
 
-    # Calculate statistics
     stats = {
-        'total_comparisons': len(comparisons),
-        'total_users': len(users),
-        'public_comparisons': len([c for c in comparisons if c.is_public]),
-        'private_comparisons': len([c for c in comparisons if not c.is_public])
+        'total_comparisons': total,
+        'total_users': len(users_with_counts),
+        'public_comparisons': public,
+        'private_comparisons': total - public
     }
 
+    # One page of all comparisons, with their owners joined in
+    visibility = request.args.get('visibility')
+    query = listing_query(Comparison.query, with_owner=True)
+    if visibility == 'public':
+        query = query.filter(Comparison.is_public.is_(True))
+    elif visibility == 'private':
+        query = query.filter(Comparison.is_public.is_not(True))
+    try:
+        page = keyset_page(query, Comparison, request.args.get('cursor'), app.config['LISTING_PAGE_SIZE'])
+    except ValueError:
+        abort(400)
+
     return render_template(
         'admin_dashboard.html',
         stats=stats,
         users_with_counts=users_with_counts,
-        comparisons=comparisons,
-        comparisons_by_user=comparisons_by_user
+        comparisons=page.items,
+        page=page,
+        visibility=visibility
     )
 
+@app.route('/api/admin/users/<int:user_id>/comparisons')
+@login_required
+def admin_user_comparisons_api(user_id):
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Not authorized'}), 403
 
+    try:
+        page = keyset_page(listing_query(Comparison.query.filter_by(user_id=user_id)), Comparison,
+                           request.args.get('cursor'), request.args.get('per_page', type=int))
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
 
-# Add this route to your app.py file
+    return jsonify({
+        'comparisons': [{
+            'id': comparison.id,
+            'title': comparison.title,
+            'created_at': comparison.created_at.strftime('%Y-%m-%d %H:%M'),
+            'is_public': comparison.is_public,
+            'url': url_for('view_comparison', comparison_id=comparison.id),
+            'delete_url': url_for('delete_comparison', comparison_id=comparison.id)
+        } for comparison in page.items],
+        'next_cursor': page.next_cursor
+    })
 
 @app.route('/api/admin/stats')
 @login_required
@@ -336,70 +919,22 @@ def admin_stats_api():
     if current_user.role != 'admin':
         return jsonify({'error': 'Not authorized'}), 403
 
-    # Get comparison stats
-    total_comparisons = Comparison.query.count()
-    public_comparisons = Comparison.query.filter_by(is_public=True).count()
-    private_comparisons = total_comparisons - public_comparisons
-
-    # Get user stats
-    total_users = User.query.count()
-    admin_users = User.query.filter_by(role='admin').count()
-    regular_users = total_users - admin_users
-
-    # Get recent activity (last 7 days)
-    one_week_ago = datetime.datetime.utcnow() - datetime.timedelta(days=7)
-    recent_comparisons = Comparison.query.filter(Comparison.created_at >= one_week_ago).count()
-
-    # Activity by day (last 7 days)
-    daily_activity = []
-    for i in range(7):
-        day = datetime.datetime.utcnow() - datetime.timedelta(days=i)
-        day_start = datetime.datetime(day.year, day.month, day.day, 0, 0, 0)
-        day_end = datetime.datetime(day.year, day.month, day.day, 23, 59, 59)
-
-        count = Comparison.query.filter(
-            Comparison.created_at >= day_start,
-            Comparison.created_at <= day_end
-        ).count()
-
-        daily_activity.append({
-            'date': day_start.strftime('%Y-%m-%d'),
-            'day': day_start.strftime('%a'),
-            'count': count
-        })
-
-    # Top users by comparison count
-    top_users = db.session.query(
-        User.username,
-        db.func.count(Comparison.id).label('count')
-    ).join(
-        Comparison, User.id == Comparison.user_id
-    ).group_by(
-        User.username
-    ).order_by(
-        db.func.count(Comparison.id).desc()
-    ).limit(5).all()
+    days = request.args.get('days', app.config['ADMIN_STATS_DAYS'], type=int)
+    days = max(1, min(days, app.config['ADMIN_STATS_MAX_DAYS']))
+    return jsonify(admin_stats_cache.get_or_compute(days, lambda: admin_stats(db, User, Comparison, days)))
+
+@app.route('/metrics')
+def prometheus_metrics():
+    if not instrumentation.authorized():
+        abort(401)
+    return Response(instrumentation.render(), mimetype='text/plain; version=0.0.4')
 
-    return jsonify({
-        'comparison_stats': {
-            'total': total_comparisons,
-            'public': public_comparisons,
-            'private': private_comparisons
-        },
-        'user_stats': {
-            'total': total_users,
-            'admin': admin_users,
-            'regular': regular_users
-        },
-        'activity': {
-            'recent': recent_comparisons,
-            'daily': daily_activity
-        },
-        'top_users': [{'username': user[0], 'count': user[1]} for user in top_users]
-    })
 # Initialize the database
 with app.app_context():
     db.create_all()
+    upgrade_schema(db)
+    backfill_comparison_inputs(db, Comparison, ComparisonInput, METRIC_COLUMNS.values())
+    backfill_comparison_uids(db, Comparison, ComparisonJob)
 
 @app.context_processor
 def inject_year():
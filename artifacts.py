@@ -0,0 +1,260 @@
+# artifacts.py - Comparison artifacts rendered on first request
+#
+# With RENDER_ARTIFACTS_EAGERLY off, a comparison job only measures the pair.
+# The overlays and the GIF are rendered the first time the comparison page
+# asks for them and kept on disk under content-addressed names
+# ("<cache_key>_<kind>"), so every comparison of the same inputs and
+# parameters shares them. Artifacts render in groups (both color overlays
+# share one Delta-E map), and a striped thread lock plus a file lock make sure
+# concurrent first requests, even from several processes, render a group once.
+# The zoom images of the changed regions (see regions.py) are always rendered
+# this way, all regions of a comparison in one go.
+import contextlib
+import hashlib
+import os
+import threading
+import uuid
+from derivatives import make_comparison_derivatives
+from encoding import OUTPUT_FORMATS, artifact_encoding, write_image
+from image_compare import (create_gif_from_images, load_pair, overlay_images_with_diff_and_transparency,
+                           visualize_color_difference)
+from instrumentation import record_written, stage
+from jobs import comparison_options, overlay_encoding, use_tiled_engine
+from regions import region_zoom_path, render_zoom, scale_box
+from result_cache import artifact_name
+from sharding import shard_directory
+from tiled_compare import compare_images_tiled
+
+try:
+    import fcntl
+except ImportError:  # Windows: only the thread locks apply
+    fcntl = None
+
+ARTIFACT_KINDS = ('color1', 'color2', 'gray1', 'gray2', 'gif')
+
+GROUPS = {
+    'color': ('color1', 'color2'),
+    'gray': ('gray1', 'gray2'),
+    'gif': ('gif',),
+}
+
+KIND_COLUMNS = {
+    'color1': 'color_diff1_path',
+    'color2': 'color_diff2_path',
+    'gray1': 'gray_diff1_path',
+    'gray2': 'gray_diff2_path',
+    'gif': 'gif_path',
+}
+
+LOCK_STRIPES = 64
+
+def group_of(kind):
+    for group, kinds in GROUPS.items():
+        if kind in kinds:
+            return group
+    raise ValueError(f"Unknown artifact kind {kind!r}")
+
+def artifact_path(output_folder, name, kind, encoding=None):
+    """Returns the content-addressed path of one artifact, with the extension of its encoding."""
+    if encoding is None:
+        ext = '.gif' if kind == 'gif' else '.jpg'
+    else:
+        ext = OUTPUT_FORMATS[encoding['format']]['ext']
+    return os.path.join(output_folder, f"{name}_{kind}{ext}")
+
+def render_artifacts(image_path1, image_path2, group, paths, options=None, tiled_min_pixels=None, stored=None):
+    """
+    Renders one group of artifacts ('color', 'gray' or 'gif') to the given paths.
+
+    Every file is written under a temporary name and then moved into place, so
+    a reader never sees a partial artifact.
+
+    Args:
+        image_path1: Path to the first image
+        image_path2: Path to the second image
+        group: Artifact group to render
+        paths: dict mapping each kind of the group to its final path
+        options: Rendering parameters (see jobs.comparison_options)
+        tiled_min_pixels: Native-size pairs this large render with the tiled engine
+        stored: Transform estimated by the job, if any (see registration.transform_record)
+    """
+    options = dict(options or {})
+    max_dim = options.get('max_dim', 3000)
+    temporary = {}
+    for kind, path in paths.items():
+        root, ext = os.path.splitext(path)
+        temporary[kind] = f"{root}.{uuid.uuid4().hex[:8]}.tmp{ext}"
+
+    try:
+        if group == 'gif':
+            # The GIF is a preview, so native-size pairs use a reduced decode. Like their
+            # overlays, pairs for the tiled engine are not registered.
+            registration = options.get('registration')
+            if use_tiled_engine(image_path1, image_path2, max_dim, tiled_min_pixels):
+                registration = None
+            pair = load_pair(image_path1, image_path2, 3000 if max_dim is None else max_dim, registration, stored)
+            if not pair.ok:
+                raise ValueError('One of the input images could not be read')
+            create_gif_from_images(image_path1, image_path2, temporary['gif'], options.get('gif_duration', 1000.0),
+                                   pair=pair, encoding=artifact_encoding(options, 'animation'))
+        elif use_tiled_engine(image_path1, image_path2, max_dim, tiled_min_pixels):
+            base1, base2 = (temporary[kind] for kind in GROUPS[group])
+            rendered = compare_images_tiled(image_path1, image_path2, base1, base2,
+                                            mode='color' if group == 'color' else 'grayscale',
+                                            alpha=options.get('alpha', 0.7),
+                                            delta_e_method=options.get('delta_e_method', 'cie76'),
+                                            threshold=options.get('threshold', 50),
+                                            workdir=os.path.dirname(paths[GROUPS[group][0]]),
+                                            overlay_encoding=overlay_encoding(options, image_path1))
+            for kind in GROUPS[group]:
+                os.replace(rendered[kind], temporary[kind])
+        else:
+            pair = load_pair(image_path1, image_path2, max_dim, options.get('registration'), stored)
+            if not pair.ok:
+                raise ValueError('One of the input images could not be read')
+            if group == 'color':
+                overlays = visualize_color_difference(image_path1, image_path2, pair=pair,
+                                                      delta_e_method=options.get('delta_e_method', 'cie76'))
+            else:
+                overlays = overlay_images_with_diff_and_transparency(image_path1, image_path2,
+                                                                     alpha=options.get('alpha', 0.7), pair=pair,
+                                                                     threshold=options.get('threshold', 50))
+            encoding = overlay_encoding(options, image_path1)
+            for kind, overlay in zip(GROUPS[group], overlays):
+                with stage('write'):
+                    write_image(temporary[kind], overlay, encoding)
+
+        for kind, path in paths.items():
+            os.replace(temporary[kind], path)
+        if group != 'gif':  # counted by create_gif_from_images
+            record_written('overlay', *paths.values())
+    finally:
+        for path in temporary.values():
+            if os.path.exists(path):
+                os.remove(path)
+    return paths
+
+def render_region_zooms(image_path1, image_path2, regions, paths, options=None, tiled_min_pixels=None, stored=None):
+    """
+    Renders the zoom image of every region of a comparison (see regions.render_zoom).
+
+    The pair is decoded once, at the resolution the regions were found at.
+
+    Args:
+        image_path1: Path to the first image
+        image_path2: Path to the second image
+        regions: Regions stored on the comparison (see regions.find_regions)
+        paths: Final path of each zoom image, in the order of regions['boxes']
+        options: Rendering parameters (see jobs.comparison_options)
+        tiled_min_pixels: Native-size pairs this large were measured unregistered
+        stored: Transform estimated by the job, if any (see registration.transform_record)
+    """
+    options = dict(options or {})
+    registration = options.get('registration')
+    if use_tiled_engine(image_path1, image_path2, options.get('max_dim', 3000), tiled_min_pixels):
+        registration = None
+    pair = load_pair(image_path1, image_path2, max(regions['frame']), registration, stored)
+    if not pair.ok:
+        raise ValueError('One of the input images could not be read')
+    size = pair.img1.shape[1::-1]
+    encoding = artifact_encoding(options, 'zoom')
+
+    for box, path in zip(regions['boxes'], paths):
+        root, ext = os.path.splitext(path)
+        temporary = f"{root}.{uuid.uuid4().hex[:8]}.tmp{ext}"
+        try:
+            zoom = render_zoom(pair.img1, pair.img2, scale_box(box, regions['frame'], size))
+            with stage('write'):
+                write_image(temporary, zoom, encoding)
+            os.replace(temporary, path)
+            record_written('region_zoom', path)
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+    return paths
+
+class ArtifactStore:
+    """
+    Serves the artifacts of a comparison, rendering missing ones on demand.
+
+    Works the same whether the artifacts were rendered by the job, evicted
+    from the result cache since, or never rendered at all.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.db = None
+        self.result_cache = None
+        self._thread_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+    def init_app(self, app, db, result_cache):
+        self.app = app
+        self.db = db
+        self.result_cache = result_cache
+        app.extensions['artifact_store'] = self
+
+    def get(self, comparison, kind):
+        """Returns the path of one artifact of comparison, rendering its group first if needed."""
+        path = getattr(comparison, KIND_COLUMNS[kind])
+        if path and os.path.exists(path):
+            return path
+
+        group = group_of(kind)
+        name = artifact_name(comparison)
+        options = comparison_options(self.app.config, comparison.output_encoding)
+        if group == 'gif':
+            encoding = artifact_encoding(options, 'animation')
+        else:
+            encoding = overlay_encoding(options, comparison.image1_path)
+        folder = shard_directory(self.app.config['OUTPUT_FOLDER'], name)
+        paths = {k: artifact_path(folder, name, k, encoding) for k in GROUPS[group]}
+        derivatives = None
+        with self._locked(f"{name}_{group}"):
+            if not all(os.path.exists(p) for p in paths.values()):
+                render_artifacts(comparison.image1_path, comparison.image2_path, group, paths, options,
+                                 self.app.config['TILED_COMPARE_MIN_PIXELS'], comparison.registration)
+                derivatives = make_comparison_derivatives(paths)
+
+        self.result_cache.record_outputs(comparison, {KIND_COLUMNS[k]: p for k, p in paths.items()}, derivatives)
+        self.db.session.commit()
+        return paths[kind]
+
+    def region_zoom(self, comparison, index):
+        """
+        Returns the path of the zoom image of one region of comparison, rendering
+        the zooms of all its regions first if needed. Returns None for an unknown region.
+        """
+        boxes = (comparison.regions or {}).get('boxes') or []
+        if not 0 <= index < len(boxes):
+            return None
+        name = artifact_name(comparison)
+        options = comparison_options(self.app.config, comparison.output_encoding)
+        ext = OUTPUT_FORMATS[artifact_encoding(options, 'zoom')['format']]['ext']
+        folder = shard_directory(self.app.config['OUTPUT_FOLDER'], name)
+        paths = [region_zoom_path(folder, name, n, ext) for n in range(len(boxes))]
+        if os.path.exists(paths[index]):
+            return paths[index]
+        with self._locked(f"{name}_regions"):
+            if not os.path.exists(paths[index]):
+                render_region_zooms(comparison.image1_path, comparison.image2_path, comparison.regions, paths,
+                                    options, self.app.config['TILED_COMPARE_MIN_PIXELS'], comparison.registration)
+        return paths[index]
+
+    @contextlib.contextmanager
+    def _locked(self, key):
+        """Holds the thread lock and the file lock of the stripe key hashes to."""
+        stripe = int(hashlib.sha1(key.encode('utf-8')).hexdigest(), 16) % LOCK_STRIPES
+        with self._thread_locks[stripe]:
+            if fcntl is None:
+                yield
+                return
+            lock_dir = os.path.join(self.app.config['OUTPUT_FOLDER'], '.locks')
+            os.makedirs(lock_dir, exist_ok=True)
+            with open(os.path.join(lock_dir, f"{stripe}.lock"), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+artifact_store = ArtifactStore()
@@ -0,0 +1,441 @@
+# batch.py - Batch comparison of many baseline/candidate pairs
+#
+# Regression runs compare thousands of rendered images against their
+# baselines. The pairs come from a manifest or from two directories with
+# matching file names, are fanned out over a process pool, and every result
+# (metrics, tolerance verdict, artifact paths) is yielded as soon as it is
+# ready so callers can stream it as JSON lines. A manifest entry may list
+# several candidates for one baseline, and baselines and candidates may be
+# animations or directories of frames (see sequences.py). BatchRecorder
+# optionally stores each result as a Comparison row, committing in groups
+# instead of once per pair.
+#
+# Usage:
+#   python batch.py --baseline-dir baseline/ --candidate-dir candidate/ --output-dir diffs/
+#   python batch.py --manifest pairs.jsonl --record alice
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from PIL import Image
+from encoding import ARTIFACT_FORMATS, ENCODING_PRESETS, parse_encoding
+from jobs import DEFAULT_OPTIONS, run_comparison
+from metrics import apply_metrics
+from result_cache import comparison_key, file_sha256, remove_file
+from sequences import apply_candidates
+from registration import REGISTRATION_MODES
+from sharding import shard_directory
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tif', '.tiff', '.webp', '.ppm', '.npy')
+
+OK = 'ok'
+ERROR = 'error'
+MISSING = 'missing'
+
+def resolve_within(root, path, base=None):
+    """
+    Resolves path against base (or root) and checks that it stays inside root.
+
+    Raises:
+        ValueError: if the resolved path escapes root.
+    """
+    resolved = os.path.realpath(os.path.join(base or root, path))
+    root = os.path.realpath(root)
+    if os.path.commonpath([root, resolved]) != root:
+        raise ValueError(f"{path} is outside of {root}")
+    return resolved
+
+def _resolve(path, base, root):
+    if root:
+        return resolve_within(root, path, base)
+    return os.path.join(base, path)
+
+def pairs_from_manifest(manifest_path, root=None):
+    """
+    Reads the pairs listed in a manifest.
+
+    The manifest is a JSON array or JSON lines of objects with "baseline",
+    "candidate" (or a list of "candidates") and an optional "name". Relative
+    paths are resolved against the manifest's directory; with root, every
+    path must lie inside root. Pairs with more than one candidate carry the
+    others in "candidates".
+    """
+    if root:
+        manifest_path = resolve_within(root, manifest_path)
+    base = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, encoding='utf-8') as f:
+        text = f.read()
+    stripped = text.lstrip()
+    if stripped.startswith('['):
+        entries = json.loads(stripped)
+    else:
+        entries = [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    pairs = []
+    for n, entry in enumerate(entries, start=1):
+        candidates = [entry['candidate']] if 'candidate' in entry else list(entry.get('candidates') or [])
+        if 'baseline' not in entry or not candidates:
+            raise ValueError(f"Manifest entry {n} needs a baseline and a candidate")
+        pair = {
+            'name': entry.get('name') or os.path.basename(os.path.normpath(candidates[0])),
+            'baseline': _resolve(entry['baseline'], base, root),
+            'candidate': _resolve(candidates[0], base, root),
+        }
+        if len(candidates) > 1:
+            pair['candidates'] = [_resolve(candidate, base, root) for candidate in candidates[1:]]
+        pairs.append(pair)
+    return pairs
+
+def pairs_from_directories(baseline_dir, candidate_dir, root=None, extensions=IMAGE_EXTENSIONS):
+    """
+    Pairs the images of two directory trees by relative path.
+
+    Images that exist on one side only are returned with None for the other
+    side and are reported as missing by run_batch.
+    """
+    if root:
+        baseline_dir = resolve_within(root, baseline_dir)
+        candidate_dir = resolve_within(root, candidate_dir)
+    for directory in (baseline_dir, candidate_dir):
+        if not os.path.isdir(directory):
+            raise ValueError(f"{directory} is not a directory")
+
+    def images(directory):
+        found = {}
+        for dirpath, _, filenames in os.walk(directory):
+            for filename in filenames:
+                if filename.lower().endswith(extensions):
+                    path = os.path.join(dirpath, filename)
+                    found[os.path.relpath(path, directory)] = path
+        return found
+
+    baselines = images(baseline_dir)
+    candidates = images(candidate_dir)
+    return [{'name': name, 'baseline': baselines.get(name), 'candidate': candidates.get(name)}
+            for name in sorted(baselines.keys() | candidates.keys())]
+
+def describe_image(path):
+    """Returns the hash and header metadata stored on Comparison rows."""
+    info = {'sha256': file_sha256(path), 'format': None, 'width': None, 'height': None, 'frames': None}
+    try:
+        with Image.open(path) as img:
+            info['format'] = img.format
+            info['width'], info['height'] = img.size
+            info['frames'] = getattr(img, 'n_frames', 1)
+    except Exception:
+        pass
+    return info
+
+def compare_pair(pair, output_folder, uid, options, describe_inputs=False, tiled_min_pixels=None,
+                 derivatives=False):
+    """
+    Compares one pair and returns its result dict. Runs inside a worker process.
+
+    Failures are reported in the result rather than raised, so one broken
+    image never stops the batch.
+    """
+    result = dict(pair, uid=uid)
+    start = time.perf_counter()
+    try:
+        artifacts = run_comparison(pair['baseline'], pair['candidate'], output_folder, uid, options,
+                                   tiled_min_pixels=tiled_min_pixels, derivatives=derivatives,
+                                   candidates=pair.get('candidates'))
+        result.update(artifacts.pop('metrics'))
+        artifacts.pop('trace', None)
+        if 'candidates' in artifacts:
+            result['candidate_results'] = artifacts.pop('candidates')
+        if derivatives:
+            result['derivatives'] = artifacts.pop('derivatives')
+        if 'regions' in artifacts:
+            result['regions'] = artifacts.pop('regions')
+        if 'registration' in artifacts:
+            result['registration'] = artifacts.pop('registration')
+        result['artifacts'] = artifacts
+        if describe_inputs:
+            result['inputs'] = [describe_image(path)
+                                for path in [pair['baseline'], pair['candidate'], *pair.get('candidates', ())]]
+        result['status'] = OK
+    except Exception as exc:
+        result['status'] = ERROR
+        result['error'] = str(exc)
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+def run_batch(pairs, output_folder, options=None, workers=None, describe_inputs=False, tiled_min_pixels=None,
+              prepare=None, derivatives=False, shard=False):
+    """
+    Compares pairs across a process pool, yielding each result as it completes.
+
+    At most a few pairs per worker are in flight, so huge batches do not queue
+    up in memory and closing the generator stops the run early.
+
+    Args:
+        pairs: Dicts with name, baseline and candidate (see pairs_from_manifest)
+        output_folder: Folder where the overlays and GIFs are written
+        options: Rendering parameters (see jobs.comparison_options)
+        workers: Worker processes (defaults to the CPU count)
+        describe_inputs: Add the hash and header metadata of both inputs to each result
+        tiled_min_pixels: Passed to jobs.run_comparison
+        prepare: Optional callable(pair, uid) returning the pair to compare,
+            e.g. with its inputs staged elsewhere
+        derivatives: Write thumbnails and previews next to the inputs and
+            overlays (only sensible for staged inputs)
+        shard: Write the outputs of each pair to its uid's directory under
+            output_folder (see sharding.py) instead of output_folder itself
+    """
+    options = dict(DEFAULT_OPTIONS, **(options or {}))
+    os.makedirs(output_folder, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    executor = ProcessPoolExecutor(max_workers=workers)
+    pending = set()
+    try:
+        for pair in pairs:
+            if not pair['baseline'] or not pair['candidate']:
+                yield dict(pair, status=MISSING, error='No matching baseline' if not pair['baseline']
+                           else 'No matching candidate')
+                continue
+            uid = uuid.uuid4().hex
+            if prepare is not None:
+                try:
+                    pair = prepare(pair, uid)
+                except OSError as exc:
+                    yield dict(pair, status=ERROR, error=str(exc))
+                    continue
+            folder = shard_directory(output_folder, uid) if shard else output_folder
+            pending.add(executor.submit(compare_pair, pair, folder, uid, options, describe_inputs,
+                                        tiled_min_pixels, derivatives))
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def with_totals(results):
+    """Passes results through and finishes with a {"summary": ...} record of the counts."""
+    counts = {OK: 0, ERROR: 0, MISSING: 0}
+    out_of_tolerance = 0
+    start = time.perf_counter()
+    for result in results:
+        counts[result['status']] += 1
+        out_of_tolerance += result.get('within_tolerance') is False
+        yield result
+    counts['out_of_tolerance'] = out_of_tolerance
+    yield {'summary': dict(counts, total=counts[OK] + counts[ERROR] + counts[MISSING],
+                           seconds=round(time.perf_counter() - start, 3))}
+
+class BatchRecorder:
+    """
+    Stores batch results as Comparison rows, committing every commit_every rows.
+
+    Use stage as the prepare hook of run_batch and pass every result of a run
+    started with describe_inputs through record. Staging hard-links (or
+    copies) the inputs into the upload folder, so the rows own their files
+    like uploaded comparisons do and deleting a row never touches the
+    caller's baseline or candidate images. With a storage (see
+    storage.Storage), every row is accounted against the user's usage. With
+    an input_model (app.ComparisonInput), every row lists its baseline and
+    candidates, and pairs may carry further candidates; frame directories
+    cannot be recorded.
+    """
+
+    def __init__(self, db, comparison_model, user_id, upload_folder, options, result_cache=None, title=None,
+                 is_public=False, commit_every=100, output_encoding=None, storage=None, input_model=None):
+        self.db = db
+        self.comparison_model = comparison_model
+        self.input_model = input_model
+        self.user_id = user_id
+        self.upload_folder = upload_folder
+        self.options = options
+        self.result_cache = result_cache
+        self.title = title
+        self.is_public = is_public
+        self.commit_every = commit_every
+        self.output_encoding = output_encoding
+        self.storage = storage
+        self._uncommitted = 0
+        os.makedirs(upload_folder, exist_ok=True)
+
+    def stage(self, pair, uid):
+        """Links the inputs of pair into the upload folder under uid (a run_batch prepare hook)."""
+        sources = [pair['baseline'], pair['candidate'], *pair.get('candidates', ())]
+        directory = shard_directory(self.upload_folder, uid)
+        paths = []
+        try:
+            for n, source in enumerate(sources, start=1):
+                if os.path.isdir(source):
+                    raise OSError(f"{source} is a directory of frames, which cannot be recorded")
+                ext = os.path.splitext(source)[1].lower()
+                path = os.path.join(directory, f"{uid}_img{n}{ext}")
+                try:
+                    os.link(source, path)
+                except OSError:
+                    shutil.copyfile(source, path)
+                paths.append(path)
+        except OSError:
+            for path in paths:
+                remove_file(path)
+            raise
+        staged = dict(pair, baseline=paths[0], candidate=paths[1], source_baseline=pair['baseline'],
+                      source_candidate=pair['candidate'])
+        if len(paths) > 2:
+            staged.update(candidates=paths[2:], source_candidates=pair['candidates'])
+        return staged
+
+    def record(self, result):
+        """Adds the row for one result and sets result['comparison_id']. Returns the result for streaming."""
+        if result['status'] != OK:
+            if 'source_baseline' not in result:
+                return result
+            for path in [result['baseline'], result['candidate'], *result.get('candidates', ())]:
+                remove_file(path)
+            return self._unstage(result)
+
+        infos = result['inputs']
+        input1, input2 = infos[:2]
+        artifacts = result['artifacts']
+        comparison = self.comparison_model(
+            user_id=self.user_id,
+            title=(f"{self.title}: {result['name']}" if self.title else result['name'])[:200],
+            description=f"{result['source_baseline']} vs {result['source_candidate']}",
+            image1_path=result['baseline'],
+            image2_path=result['candidate'],
+            gif_path=artifacts.get('gif'),
+            color_diff1_path=artifacts.get('color1'),
+            color_diff2_path=artifacts.get('color2'),
+            gray_diff1_path=artifacts.get('gray1'),
+            gray_diff2_path=artifacts.get('gray2'),
+            is_public=self.is_public,
+            output_encoding=self.output_encoding,
+            uid=result['uid'],
+            cache_key=comparison_key([info['sha256'] for info in infos], self.options,
+                                     multi_frame=any((info['frames'] or 1) > 1 for info in infos))
+        )
+        for n, info in enumerate([input1, input2], start=1):
+            for field in ('sha256', 'format', 'width', 'height'):
+                setattr(comparison, f'image{n}_{field}', info[field])
+        if self.input_model is not None:
+            paths = [result['baseline'], result['candidate'], *result.get('candidates', ())]
+            for position, (path, info) in enumerate(zip(paths, infos)):
+                comparison.inputs.append(self.input_model(
+                    position=position, path=path, sha256=info['sha256'], format=info['format'],
+                    width=info['width'], height=info['height'], frame_count=info['frames']
+                ))
+            apply_candidates(comparison.inputs, result.pop('candidate_results', None)
+                             or [dict(result, frames_compared=1, worst_frame=0)])
+        apply_metrics(comparison, result)
+        comparison.derivatives = result.pop('derivatives', None)
+        comparison.regions = result.get('regions')
+        comparison.registration = result.get('registration')
+        self.db.session.add(comparison)
+        self.db.session.flush()
+        if self.result_cache is not None:
+            self.result_cache.store(comparison)
+        if self.storage is not None:
+            self.storage.account(comparison)
+
+        result['comparison_id'] = comparison.id
+        result['inputs'] = [comparison.image1_path, comparison.image2_path, *result.get('candidates', ())]
+        result['artifacts'] = {
+            'color1': comparison.color_diff1_path, 'color2': comparison.color_diff2_path,
+            'gray1': comparison.gray_diff1_path, 'gray2': comparison.gray_diff2_path,
+            'gif': comparison.gif_path,
+        }
+
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_every:
+            self.commit()
+        return self._unstage(result)
+
+    def _unstage(self, result):
+        """Reports the caller's paths as baseline and candidates again."""
+        result['baseline'] = result.pop('source_baseline')
+        result['candidate'] = result.pop('source_candidate')
+        if 'source_candidates' in result:
+            result['candidates'] = result.pop('source_candidates')
+        return result
+
+    def commit(self):
+        self.db.session.commit()
+        self._uncommitted = 0
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare many baseline/candidate image pairs')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--manifest',
+                        help='JSON or JSON lines file of {"baseline", "candidate" or "candidates", "name"} objects')
+    source.add_argument('--baseline-dir', help='Directory of baseline images (needs --candidate-dir)')
+    parser.add_argument('--candidate-dir', help='Directory of candidate images, matched by relative path')
+    parser.add_argument('--output-dir', default='batch_output', help='Where artifacts go without --record')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: CPU count)')
+    parser.add_argument('--tolerance-delta-e', type=float,
+                        help='Largest max Delta-E that passes without rendering (default: 2.3)')
+    parser.add_argument('--tolerance-changed-ratio', type=float,
+                        help='Largest changed-pixel fraction that passes without rendering (default: 0)')
+    parser.add_argument('--registration', choices=REGISTRATION_MODES,
+                        help='Align each candidate onto its baseline before diffing')
+    parser.add_argument('--overlay-format', choices=ARTIFACT_FORMATS['overlay'][1], help='Format of the overlays')
+    parser.add_argument('--animation-format', choices=ARTIFACT_FORMATS['animation'][1],
+                        help='Format of the alternating animation')
+    parser.add_argument('--preset', choices=list(ENCODING_PRESETS), help='Quality and effort preset of the outputs')
+    parser.add_argument('--quality', type=int, help='Encoder quality (1-100), overriding the preset')
+    parser.add_argument('--record', metavar='USERNAME', help='Store results as comparisons owned by USERNAME')
+    parser.add_argument('--title', help='Title prefix of recorded comparisons')
+    parser.add_argument('--public', action='store_true', help='Make recorded comparisons public')
+    args = parser.parse_args()
+
+    if args.baseline_dir and not args.candidate_dir:
+        parser.error('--baseline-dir needs --candidate-dir')
+    try:
+        if args.manifest:
+            pairs = pairs_from_manifest(args.manifest)
+        else:
+            pairs = pairs_from_directories(args.baseline_dir, args.candidate_dir)
+    except (OSError, ValueError) as exc:
+        parser.error(str(exc))
+
+    overrides = {}
+    if args.tolerance_delta_e is not None:
+        overrides['tolerance_delta_e'] = args.tolerance_delta_e
+    if args.tolerance_changed_ratio is not None:
+        overrides['tolerance_changed_ratio'] = args.tolerance_changed_ratio
+    if args.registration:
+        overrides['registration'] = args.registration
+    try:
+        output_encoding = parse_encoding({'overlay_format': args.overlay_format,
+                                          'animation_format': args.animation_format,
+                                          'encoding_preset': args.preset, 'encoding_quality': args.quality})
+    except ValueError as exc:
+        parser.error(str(exc))
+
+    # Exit with 1 when a pair failed, is missing a side or is out of tolerance
+    failed = False
+    if args.record:
+        # Imported here so plain runs do not need the database
+        from app import app, User, batch_results
+        with app.app_context():
+            user = User.query.filter_by(username=args.record).first()
+            if user is None:
+                parser.error(f'No user named {args.record}')
+            for result in batch_results(pairs, user.id, title=args.title, is_public=args.public,
+                                        workers=args.workers, options=overrides,
+                                        output_encoding=output_encoding or None):
+                failed |= result.get('status') in (ERROR, MISSING) or result.get('within_tolerance') is False
+                print(json.dumps(result), flush=True)
+    else:
+        overrides.update(output_encoding)
+        for result in with_totals(run_batch(pairs, args.output_dir, overrides, workers=args.workers)):
+            failed |= result.get('status') in (ERROR, MISSING) or result.get('within_tolerance') is False
+            print(json.dumps(result), flush=True)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
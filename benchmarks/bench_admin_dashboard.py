@@ -0,0 +1,97 @@
+# benchmarks/bench_admin_dashboard.py - Query count and latency of the admin pages
+#
+# Usage: python -m benchmarks.bench_admin_dashboard [--comparisons 100000] [--users 200]
+#                                                   [--max-queries 5] [--max-seconds 1.0]
+#
+# Seeds a throwaway SQLite database with synthetic users and comparisons,
+# then requests the admin dashboard (first and second page) and one user's
+# drill-down through the test client. Every page must stay within the query
+# and time budgets; the script exits with an error otherwise.
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from sqlalchemy import event
+
+def seed(db, User, Comparison, comparisons, users, chunk=10000):
+    """Bulk-inserts users and comparisons spread over the last year."""
+    db.session.execute(db.insert(User), [
+        {'username': f'user{n}', 'email': f'user{n}@example.com', 'password_hash': '', 'role': 'user'}
+        for n in range(users)
+    ])
+    user_ids = [row[0] for row in db.session.query(User.id).all()]
+    rng = random.Random(0)
+    now = datetime.datetime.utcnow()
+    for start in range(0, comparisons, chunk):
+        db.session.execute(db.insert(Comparison), [{
+            'user_id': rng.choice(user_ids),
+            'title': f'Comparison {n}',
+            'description': 'Synthetic benchmark row',
+            'image1_path': f'static/uploads/{n}_img1.png',
+            'image2_path': f'static/uploads/{n}_img2.png',
+            'is_public': rng.random() < 0.3,
+            'created_at': now - datetime.timedelta(seconds=rng.randrange(365 * 24 * 3600)),
+        } for n in range(start, min(start + chunk, comparisons))])
+    db.session.commit()
+
+def main():
+    parser = argparse.ArgumentParser(description='Query count and latency of the admin pages')
+    parser.add_argument('--comparisons', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--max-queries', type=int, default=5)
+    parser.add_argument('--max-seconds', type=float, default=1.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        from app import app, db, User, Comparison
+
+        with app.app_context():
+            start = time.perf_counter()
+            seed(db, User, Comparison, args.comparisons, args.users)
+            seed_seconds = time.perf_counter() - start
+            admin = User(username='bench-admin', email='admin@example.com', role='admin')
+            admin.set_password('bench')
+            db.session.add(admin)
+            db.session.commit()
+            busiest = db.session.query(Comparison.user_id).group_by(Comparison.user_id).order_by(
+                db.func.count().desc()).limit(1).scalar()
+            engine = db.engine
+
+        statements = []
+        event.listen(engine, 'before_cursor_execute', lambda *a: statements.append(a[2]))
+
+        client = app.test_client()
+        client.post('/login', data={'username': 'bench-admin', 'password': 'bench'})
+
+        def measure(url):
+            client.get(url)  # warm up caches and the connection pool
+            statements.clear()
+            start = time.perf_counter()
+            response = client.get(url)
+            seconds = time.perf_counter() - start
+            return {'url': url, 'status': response.status_code, 'queries': len(statements),
+                    'seconds': round(seconds, 4)}
+
+        report = {'comparisons': args.comparisons, 'users': args.users, 'seed_seconds': round(seed_seconds, 2),
+                  'pages': []}
+        report['pages'].append(measure('/admin/dashboard'))
+        with app.app_context():
+            cursor = db.session.query(Comparison.created_at, Comparison.id).order_by(
+                Comparison.created_at.desc(), Comparison.id.desc()).offset(49).limit(1).one()
+        from pagination import encode_cursor
+        report['pages'].append(measure(f'/admin/dashboard?cursor={encode_cursor(*cursor)}'))
+        report['pages'].append(measure(f'/api/admin/users/{busiest}/comparisons'))
+
+    print(json.dumps(report, indent=2))
+    failures = [page for page in report['pages']
+                if page['status'] != 200 or page['queries'] > args.max_queries or page['seconds'] > args.max_seconds]
+    if failures:
+        sys.exit(f"Over budget ({args.max_queries} queries, {args.max_seconds}s): {json.dumps(failures)}")
+
+if __name__ == '__main__':
+    main()
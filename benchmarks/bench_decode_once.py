@@ -0,0 +1,66 @@
+# benchmarks/bench_decode_once.py - Decode count and wall time for one /compare run
+#
+# Usage: python -m benchmarks.bench_decode_once [--width 4000] [--height 3000]
+#
+# "before" is not the original /compare code: it calls today's renderers
+# without a shared LoadedPair, so each one decodes the inputs itself, the way
+# the original renderers did. Decoding and rendering are today's, so the
+# numbers isolate the repeated decodes rather than reproduce the old timings.
+import argparse
+import json
+import tempfile
+import cv2
+import image_compare
+from benchmarks.common import make_image_pair, best_of
+
+class DecodeCounter:
+    """Wraps cv2.imread so every decode made by image_compare is counted."""
+
+    def __init__(self):
+        self.count = 0
+        self._imread = cv2.imread
+
+    def __enter__(self):
+        def counting_imread(*args, **kwargs):
+            self.count += 1
+            return self._imread(*args, **kwargs)
+        cv2.imread = counting_imread
+        return self
+
+    def __exit__(self, *exc):
+        cv2.imread = self._imread
+
+def run_before(path1, path2, gif_path):
+    # Every renderer decodes the inputs on its own, as /compare used to do
+    image_compare.visualize_color_difference(path1, path2)
+    image_compare.overlay_images_with_diff_and_transparency(path1, path2)
+    image_compare.create_gif_from_images(path1, path2, gif_path)
+
+def run_after(path1, path2, gif_path):
+    pair = image_compare.load_pair(path1, path2)
+    image_compare.visualize_color_difference(path1, path2, pair=pair)
+    image_compare.overlay_images_with_diff_and_transparency(path1, path2, pair=pair)
+    image_compare.create_gif_from_images(path1, path2, gif_path, pair=pair)
+
+def main():
+    parser = argparse.ArgumentParser(description='Decode count and wall time for one /compare run')
+    parser.add_argument('--width', type=int, default=4000)
+    parser.add_argument('--height', type=int, default=3000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path1, path2 = make_image_pair(tmp, args.width, args.height)
+        gif_path = f"{tmp}/output.gif"
+
+        report = {'width': args.width, 'height': args.height}
+        for name, fn in [('before', run_before), ('after', run_after)]:
+            with DecodeCounter() as counter:
+                fn(path1, path2, gif_path)
+            seconds, _ = best_of(lambda: fn(path1, path2, gif_path), args.repeat)
+            report[name] = {'decodes': counter.count, 'seconds': round(seconds, 4)}
+
+    print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# benchmarks/bench_delta_e.py - Delta-E throughput and peak memory
+#
+# Usage: python -m benchmarks.bench_delta_e [--megapixels 50] [--methods legacy,cie76,ciede2000]
+#
+# Each method runs in a fresh process so its peak RSS can be measured on its own.
+import argparse
+import json
+import time
+import cv2
+import numpy as np
+from delta_e import delta_e_map
+from benchmarks.common import peak_rss_kb, run_isolated
+
+def legacy_delta_e(img1, img2):
+    # The expression visualize_color_difference used before the delta_e module
+    img1_lab = cv2.cvtColor(img1, cv2.COLOR_BGR2Lab)
+    img2_lab = cv2.cvtColor(img2, cv2.COLOR_BGR2Lab)
+    return np.sqrt(np.sum((img1_lab - img2_lab) ** 2, axis=2))
+
+def synthetic_pair(width, height):
+    rng = np.random.default_rng(0)
+    small = rng.integers(0, 256, size=(height // 16 + 1, width // 16 + 1, 3), dtype=np.uint8)
+    img1 = cv2.resize(small, (width, height))
+    img2 = cv2.add(img1, (3, 3, 3, 0))
+    return img1, img2
+
+def measure(method, width, height, tile_rows):
+    img1, img2 = synthetic_pair(width, height)
+    baseline_kb = peak_rss_kb()
+    start = time.perf_counter()
+    if method == 'legacy':
+        legacy_delta_e(img1, img2)
+    else:
+        delta_e_map(img1, img2, method, tile_rows=tile_rows)
+    elapsed = time.perf_counter() - start
+    peak_kb = peak_rss_kb()
+    return {
+        'method': method,
+        'seconds': round(elapsed, 4),
+        'megapixels_per_second': round(width * height / 1e6 / elapsed, 2),
+        'peak_extra_rss_mb': round((peak_kb - baseline_kb) / 1024, 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Delta-E throughput and peak memory')
+    parser.add_argument('--megapixels', type=float, default=12)
+    parser.add_argument('--methods', default='legacy,cie76,ciede2000')
+    parser.add_argument('--tile-rows', type=int, default=None)
+    args = parser.parse_args()
+
+    width = int((args.megapixels * 1e6 * 4 / 3) ** 0.5)
+    height = int(width * 3 / 4)
+    results = [run_isolated(measure, method, width, height, args.tile_rows)
+               for method in args.methods.split(',')]
+
+    print(json.dumps({'width': width, 'height': height, 'results': results}, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# benchmarks/bench_encoding.py - Encode time against file size of every output format
+#
+# Usage: python -m benchmarks.bench_encoding [--width 3000] [--height 2250] [--repeat 3]
+#
+# Renders the color overlay and the grayscale overlay of a synthetic pair once,
+# then encodes them in memory in every still format under every preset, and
+# the alternating animation in every animated format. Each result has the
+# best encode time and the bytes the file would take on disk; the overlays are
+# also decoded again to report their PSNR against the rendered pixels.
+import argparse
+import json
+import tempfile
+import cv2
+import numpy as np
+from benchmarks.common import best_of, make_image_pair
+from encoding import ARTIFACT_FORMATS, ENCODING_PRESETS, encode_image, resolve_encoding
+from image_compare import encode_animation, load_pair, overlay_images_with_diff_and_transparency, \
+    visualize_color_difference
+
+def main():
+    parser = argparse.ArgumentParser(description='Encode time against file size of every output format')
+    parser.add_argument('--width', type=int, default=3000)
+    parser.add_argument('--height', type=int, default=2250)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    report = {'width': args.width, 'height': args.height, 'overlays': [], 'animations': []}
+    with tempfile.TemporaryDirectory() as tmp:
+        path1, path2 = make_image_pair(tmp, args.width, args.height, ext='.png')
+        pair = load_pair(path1, path2, max_dim=None)
+        overlays = {
+            'color': visualize_color_difference(path1, path2, pair=pair)[0],
+            'gray': overlay_images_with_diff_and_transparency(path1, path2, pair=pair)[0],
+        }
+
+        for preset in ENCODING_PRESETS:
+            for fmt in ARTIFACT_FORMATS['overlay'][1]:
+                encoding = resolve_encoding(fmt, preset)
+                for kind, overlay in overlays.items():
+                    seconds, data = best_of(lambda: encode_image(overlay, encoding), args.repeat)
+                    decoded = cv2.imdecode(data, cv2.IMREAD_COLOR)
+                    psnr = cv2.PSNR(overlay, decoded)
+                    report['overlays'].append({
+                        'overlay': kind, 'format': fmt, 'preset': preset, 'quality': encoding['quality'],
+                        'seconds': round(seconds, 4), 'bytes': int(data.size),
+                        'psnr': None if not np.isfinite(psnr) or psnr >= 100 else round(psnr, 2),
+                    })
+
+            frames = [pair.img1, pair.img2]
+            for fmt in ARTIFACT_FORMATS['animation'][1]:
+                encoding = resolve_encoding(fmt, preset)
+                seconds, data = best_of(lambda: encode_animation(frames, encoding=encoding), args.repeat)
+                report['animations'].append({'format': fmt, 'preset': preset, 'quality': encoding['quality'],
+                                             'seconds': round(seconds, 4), 'bytes': len(data)})
+
+    print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# benchmarks/bench_gif.py - Encode time and size of the GIF builders
+#
+# Usage: python -m benchmarks.bench_gif [--width 3000] [--height 2250] [--repeat 3]
+#
+# Compares the three GIF builders image_compare had before encode_gif (kept
+# below as they were) with encode_gif on frames that are already decoded, and
+# with the current wrappers, which decode the files themselves.
+import argparse
+import json
+import os
+import tempfile
+import cv2
+import imageio.v2 as imageio
+from PIL import Image
+from image_compare import (create_gif_from_images, create_optimized_gif, create_pillow_gif, encode_gif,
+                           load_pair)
+from benchmarks.common import best_of, make_image_pair
+
+def legacy_create_gif_from_images(image_path1, image_path2, gif_output_path, duration=1000.0):
+    img1 = cv2.imread(image_path1)
+    img2 = cv2.imread(image_path2)
+    height, width = img1.shape[:2]
+    img2 = cv2.resize(img2, (width, height))
+    img1_rgb = cv2.cvtColor(img1, cv2.COLOR_BGR2RGB)
+    img2_rgb = cv2.cvtColor(img2, cv2.COLOR_BGR2RGB)
+    new_size = (int(width * 0.5), int(height * 0.5))
+    imageio.mimsave(gif_output_path, [cv2.resize(img1_rgb, new_size), cv2.resize(img2_rgb, new_size)],
+                    duration=duration, loop=0)
+    return gif_output_path
+
+def legacy_create_optimized_gif(image_path1, image_path2, gif_output_path, duration=1000, resize_factor=0.5,
+                                optimize=True):
+    img1 = cv2.imread(image_path1)
+    img2 = cv2.imread(image_path2)
+    height, width = img1.shape[:2]
+    new_size = (int(width * resize_factor), int(height * resize_factor))
+    img1 = cv2.cvtColor(cv2.resize(img1, new_size), cv2.COLOR_BGR2RGB)
+    img2 = cv2.cvtColor(cv2.resize(img2, new_size), cv2.COLOR_BGR2RGB)
+    Image.fromarray(img1).convert('P', palette=Image.ADAPTIVE, colors=128).save("temp_img1.png")
+    Image.fromarray(img2).convert('P', palette=Image.ADAPTIVE, colors=128).save("temp_img2.png")
+    frames = [imageio.imread("temp_img1.png"), imageio.imread("temp_img2.png")]
+    imageio.mimsave(gif_output_path, frames, duration=duration, loop=0, optimize=optimize, quantizer='nq',
+                    palettesize=128)
+    os.remove("temp_img1.png")
+    os.remove("temp_img2.png")
+    return gif_output_path
+
+def legacy_create_pillow_gif(image_path1, image_path2, gif_output_path, duration=1000, resize_factor=0.5, colors=64):
+    img1 = Image.open(image_path1)
+    img2 = Image.open(image_path2)
+    new_size = (int(img1.width * resize_factor), int(img1.height * resize_factor))
+    img1 = img1.resize(new_size, Image.LANCZOS).convert('P', palette=Image.ADAPTIVE, colors=colors)
+    img2 = img2.resize(new_size, Image.LANCZOS).convert('P', palette=Image.ADAPTIVE, colors=colors)
+    img1.save(gif_output_path, save_all=True, append_images=[img2], optimize=True, duration=duration, loop=0)
+    return gif_output_path
+
+def main():
+    parser = argparse.ArgumentParser(description='Encode time and size of the GIF builders')
+    parser.add_argument('--width', type=int, default=3000)
+    parser.add_argument('--height', type=int, default=2250)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    report = {'width': args.width, 'height': args.height, 'results': []}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        path1, path2 = make_image_pair(tmp, args.width, args.height, ext='.png')
+        pair = load_pair(path1, path2, max_dim=None)
+        frames = [pair.img1, pair.img2]
+        out = os.path.join(tmp, 'out.gif')
+        # The legacy optimized builder writes its frames to the working directory
+        os.chdir(tmp)
+
+        variants = [
+            ('legacy create_gif_from_images', lambda: legacy_create_gif_from_images(path1, path2, out)),
+            ('legacy create_optimized_gif', lambda: legacy_create_optimized_gif(path1, path2, out)),
+            ('legacy create_pillow_gif', lambda: legacy_create_pillow_gif(path1, path2, out)),
+            ('create_gif_from_images (decoded pair)', lambda: create_gif_from_images(path1, path2, out, pair=pair)),
+            ('create_optimized_gif', lambda: create_optimized_gif(path1, path2, out)),
+            ('create_pillow_gif', lambda: create_pillow_gif(path1, path2, out)),
+            ('encode_gif to bytes (decoded frames)', lambda: encode_gif(frames)),
+            ('encode_gif 64 colors (decoded frames)', lambda: encode_gif(frames, out, colors=64, optimize=True)),
+        ]
+        for name, fn in variants:
+            seconds, result = best_of(fn, args.repeat)
+            size = len(result) if isinstance(result, bytes) else os.path.getsize(out)
+            report['results'].append({'variant': name, 'seconds': round(seconds, 4), 'bytes': size})
+        os.chdir(cwd)
+
+    print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
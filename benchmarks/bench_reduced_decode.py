@@ -0,0 +1,59 @@
+# benchmarks/bench_reduced_decode.py - Decode time and peak memory for oversized inputs
+#
+# Usage: python -m benchmarks.bench_reduced_decode [--width 12000] [--height 9000] [--max-dim 3000]
+#
+# Compares the old decode-then-halve path (cv2.imread + resize_if_large, kept
+# here as it was in image_compare) with load_image, which picks a reduced
+# decode scale from the header, on a large JPEG and a large PNG. Each
+# measurement runs in a fresh process.
+import argparse
+import json
+import tempfile
+import time
+import cv2
+from image_compare import load_image
+from benchmarks.common import make_image_pair, peak_rss_kb, run_isolated
+
+def resize_if_large(img, max_dim=3000):
+    """The decode-then-halve step /compare used before load_image."""
+    if img is None:
+        return None
+    height, width = img.shape[:2]
+    if height > max_dim or width > max_dim:
+        scale = 0.5
+        img = cv2.resize(img, (int(width * scale), int(height * scale)))
+    return img
+
+def measure(variant, path, max_dim):
+    baseline_kb = peak_rss_kb()
+    start = time.perf_counter()
+    if variant == 'imread+resize_if_large':
+        img = resize_if_large(cv2.imread(path), max_dim)
+    else:
+        img = load_image(path, max_dim)
+    elapsed = time.perf_counter() - start
+    return {
+        'variant': variant,
+        'seconds': round(elapsed, 4),
+        'peak_extra_rss_mb': round((peak_rss_kb() - baseline_kb) / 1024, 1),
+        'output': f"{img.shape[1]}x{img.shape[0]}",
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Decode time and peak memory for oversized inputs')
+    parser.add_argument('--width', type=int, default=12000)
+    parser.add_argument('--height', type=int, default=9000)
+    parser.add_argument('--max-dim', type=int, default=3000)
+    args = parser.parse_args()
+
+    report = {'width': args.width, 'height': args.height, 'max_dim': args.max_dim, 'results': {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        for ext in ['.jpg', '.png']:
+            path, _ = make_image_pair(tmp, args.width, args.height, ext=ext)
+            report['results'][ext] = [run_isolated(measure, variant, path, args.max_dim)
+                                      for variant in ['imread+resize_if_large', 'load_image']]
+
+    print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
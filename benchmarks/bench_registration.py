@@ -0,0 +1,80 @@
+# benchmarks/bench_registration.py - Cost and effect of the registration stage
+#
+# Usage: python -m benchmarks.bench_registration [--width 8000] [--height 6000] [--max-dim none]
+#
+# The candidate is the baseline with a few changed rectangles, shifted by a
+# few pixels and cropped on every side. For each registration mode the script
+# reports the time to estimate the transform on its own, the time of a full
+# load_pair that estimates it and of one given the stored estimate (as the
+# artifacts rendered after the job are), how far the recovered shift is from
+# the true one, and the changed-pixel fraction the diff reports.
+import argparse
+import json
+import os
+import tempfile
+import time
+import cv2
+import numpy as np
+from benchmarks.common import make_image_pair, best_of
+from image_compare import load_pair
+from metrics import measure_pair
+from registration import REGISTRATION_MODES, estimate_transform
+
+SHIFT = (37, -21)  # native pixels
+CROP = 0.02  # fraction cut from each side
+
+def make_shifted_candidate(directory, path1, path2):
+    """Writes the changed image shifted by SHIFT and cropped by CROP, returns its path."""
+    img = cv2.imread(path2)
+    height, width = img.shape[:2]
+    shifted = cv2.warpAffine(img, np.float32([[1, 0, SHIFT[0]], [0, 1, SHIFT[1]]]), (width, height),
+                             borderMode=cv2.BORDER_REFLECT)
+    top, left = int(height * CROP), int(width * CROP)
+    path = os.path.join(directory, f"shifted{os.path.splitext(path1)[1]}")
+    cv2.imwrite(path, shifted[top:height - top, left:width - left])
+    # A candidate pixel (x, y) shows the baseline at (x + left - dx, y + top - dy)
+    return path, (left - SHIFT[0], top - SHIFT[1])
+
+def main():
+    parser = argparse.ArgumentParser(description='Cost and effect of the registration stage')
+    parser.add_argument('--width', type=int, default=8000)
+    parser.add_argument('--height', type=int, default=6000)
+    parser.add_argument('--max-dim', default='3000', help="Working resolution, or 'none' for native size")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    max_dim = None if args.max_dim.lower() == 'none' else int(args.max_dim)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path1, path2 = make_image_pair(tmp, args.width, args.height)
+        candidate, offset = make_shifted_candidate(tmp, path1, path2)
+
+        report = {'width': args.width, 'height': args.height, 'max_dim': max_dim,
+                  'true_offset': offset, 'modes': {}}
+        for mode in (None,) + REGISTRATION_MODES:
+            start = time.perf_counter()
+            cold = load_pair(path1, candidate, max_dim, mode)
+            cold_seconds = time.perf_counter() - start
+            if not cold.ok:
+                raise SystemExit('Could not decode the benchmark images')
+            seconds, pair = best_of(lambda: load_pair(path1, candidate, max_dim, mode, cold.registration),
+                                    args.repeat)
+            entry = {'load_pair_seconds': round(cold_seconds, 4), 'load_pair_stored_seconds': round(seconds, 4),
+                     'changed_ratio': measure_pair(pair)['changed_ratio']}
+            if mode:
+                # The estimate alone, on the frames load_pair hands it
+                scale = pair.img1.shape[1] / args.width
+                img2 = cv2.resize(cv2.imread(candidate), None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+                estimate_seconds, matrix = best_of(lambda: estimate_transform(pair.img1, img2, mode), args.repeat)
+                entry['estimate_seconds'] = round(estimate_seconds, 4)
+                if matrix is not None:
+                    # Translation of the estimate, in native pixels
+                    recovered = matrix[:2, 2] * args.width / pair.img1.shape[1]
+                    entry['offset_error_px'] = round(float(np.abs(recovered - np.array(offset)).max()), 2)
+                else:
+                    entry['offset_error_px'] = None
+            report['modes'][mode or 'off'] = entry
+
+    print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
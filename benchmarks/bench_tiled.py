@@ -0,0 +1,69 @@
+# benchmarks/bench_tiled.py - Peak memory of the tiled engine against the in-memory renderers
+#
+# Usage: python -m benchmarks.bench_tiled [--width 12000] [--height 9000] [--method cie76]
+#
+# Renders the color and grayscale overlays of a large PPM pair at native
+# resolution, once with the in-memory renderers and once with the tiled engine,
+# each in a fresh process. The overlays are checked pixel for pixel and the
+# script exits non-zero if they differ.
+import argparse
+import json
+import sys
+import tempfile
+import time
+import numpy as np
+from image_compare import load_pair, overlay_images_with_diff_and_transparency, visualize_color_difference
+from tiled_compare import open_raster, render_overlays_tiled
+from benchmarks.common import make_image_pair, peak_rss_kb, run_isolated
+
+def render(variant, path1, path2, method, out_dir):
+    """Renders all four overlays into .npy files (before any JPEG encoding) for the comparison."""
+    baseline_kb = peak_rss_kb()
+    start = time.perf_counter()
+    if variant == 'in-memory':
+        pair = load_pair(path1, path2, None)
+        color = visualize_color_difference(path1, path2, pair=pair, delta_e_method=method)
+        gray = overlay_images_with_diff_and_transparency(path1, path2, pair=pair)
+    else:
+        overlays = render_overlays_tiled(open_raster(path1, out_dir, 'input1'), open_raster(path2, out_dir, 'input2'),
+                                         out_dir, delta_e_method=method)
+        color, gray = overlays['color'], overlays['gray']
+    elapsed = time.perf_counter() - start
+    peak_mb = round((peak_rss_kb() - baseline_kb) / 1024, 1)
+
+    saved = []
+    for name, overlay in zip(['color1', 'color2', 'gray1', 'gray2'], [*color, *gray]):
+        if isinstance(overlay, str):
+            saved.append(overlay)
+            continue
+        path = f"{out_dir}/{variant}_{name}_result.npy"
+        np.save(path, overlay)
+        saved.append(path)
+    return {'variant': variant, 'seconds': round(elapsed, 3), 'peak_extra_rss_mb': peak_mb, 'overlays': saved}
+
+def main():
+    parser = argparse.ArgumentParser(description='Peak memory of the tiled engine against the in-memory renderers')
+    parser.add_argument('--width', type=int, default=12000)
+    parser.add_argument('--height', type=int, default=9000)
+    parser.add_argument('--method', default='cie76', choices=['cie76', 'ciede2000'])
+    args = parser.parse_args()
+
+    report = {'width': args.width, 'height': args.height, 'method': args.method, 'results': []}
+    identical = True
+    with tempfile.TemporaryDirectory() as tmp:
+        path1, path2 = make_image_pair(tmp, args.width, args.height, ext='.ppm')
+        runs = [run_isolated(render, variant, path1, path2, args.method, tmp)
+                for variant in ['in-memory', 'tiled']]
+        for expected, actual in zip(runs[0]['overlays'], runs[1]['overlays']):
+            identical &= np.array_equal(np.load(expected, mmap_mode='r'), np.load(actual, mmap_mode='r'))
+        for run in runs:
+            del run['overlays']
+            report['results'].append(run)
+    report['identical'] = bool(identical)
+
+    print(json.dumps(report, indent=2))
+    if not identical:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+# benchmarks/common.py - Shared helpers for the benchmark scripts
+import multiprocessing
+import os
+import resource
+import time
+import numpy as np
+import cv2
+
+def make_image_pair(directory, width=4000, height=3000, ext='.png', seed=0):
+    """
+    Writes a deterministic pair of synthetic images and returns their paths.
+
+    The second image is the first one with a few changed rectangles, so the
+    diff renderers have real work to do.
+    """
+    rng = np.random.default_rng(seed)
+    base = rng.integers(0, 256, size=(height // 8 + 1, width // 8 + 1, 3), dtype=np.uint8)
+    img1 = cv2.resize(base, (width, height), interpolation=cv2.INTER_LINEAR)
+    img2 = img1.copy()
+    for _ in range(8):
+        x = int(rng.integers(0, width - width // 10))
+        y = int(rng.integers(0, height - height // 10))
+        img2[y:y + height // 10, x:x + width // 10] = rng.integers(0, 256, size=3, dtype=np.uint8)
+
+    path1 = os.path.join(directory, f"bench_{width}x{height}_{seed}_a{ext}")
+    path2 = os.path.join(directory, f"bench_{width}x{height}_{seed}_b{ext}")
+    cv2.imwrite(path1, img1)
+    cv2.imwrite(path2, img2)
+    return path1, path2
+
+def best_of(fn, repeat=3):
+    """Runs fn repeat times and returns (best wall time in seconds, last result)."""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def peak_rss_kb():
+    """
+    Peak resident set size of the current process in KiB.
+
+    Reads VmHWM, which belongs to the current address space. ru_maxrss is
+    only a fallback: on Linux it carries the parent's peak over fork/exec.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_isolated(fn, *args):
+    """
+    Runs fn(*args) in a fresh process and returns its result.
+
+    Used to measure peak RSS per variant, since ru_maxrss never goes down
+    within a process. fn must be a module-level function.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1) as pool:
+        return pool.apply(fn, args)
@@ -0,0 +1,132 @@
+# benchmarks/corpus.py - Deterministic synthetic image pairs for the benchmark suite
+#
+# Usage: python -m benchmarks.corpus DIRECTORY [--sizes 0.5mp,3mp,12mp] [--formats png,jpg]
+#
+# Every pair is generated from a fixed seed, so the same arguments always
+# produce the same pixels (and, for a given OpenCV build, the same bytes).
+# The baseline is smooth noise with hard-edged shapes and a gradient, so
+# decoders, JPEG and the diff kernels all see realistic content; the
+# candidate is one of the VARIANTS below. Files already on disk are reused.
+import argparse
+import json
+import os
+import cv2
+import numpy as np
+
+# Name -> (width, height); 'all' on the command line selects every size
+SIZES = {
+    '0.5mp': (816, 612),
+    '3mp': (2000, 1500),
+    '12mp': (4000, 3000),
+    '24mp': (6000, 4000),
+    '50mp': (8660, 5774),
+    '100mp': (11548, 8660),
+}
+DEFAULT_SIZES = ('0.5mp', '3mp', '12mp')
+
+FORMATS = {
+    'png': ('.png', [cv2.IMWRITE_PNG_COMPRESSION, 1]),
+    'jpg': ('.jpg', [cv2.IMWRITE_JPEG_QUALITY, 92]),
+}
+
+VARIANTS = ('identical', 'shifted', 'recolored', 'changed')
+
+def make_baseline(width, height, seed=0):
+    """Smooth noise, a horizontal gradient and a few dozen solid shapes."""
+    rng = np.random.default_rng(seed)
+    base = rng.integers(0, 256, size=(height // 16 + 2, width // 16 + 2, 3), dtype=np.uint8)
+    img = cv2.resize(base, (width, height), interpolation=cv2.INTER_CUBIC)
+    gradient = np.linspace(0, 60, width, dtype=np.float32)
+    cv2.add(img, cv2.merge([gradient[np.newaxis].repeat(height, axis=0).astype(np.uint8)] * 3), dst=img)
+    scale = max(width, height) / 1000
+    for _ in range(40):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        color = tuple(int(c) for c in rng.integers(0, 256, size=3))
+        if rng.random() < 0.5:
+            axes = (int(rng.integers(10, 80) * scale), int(rng.integers(10, 80) * scale))
+            cv2.ellipse(img, center, axes, float(rng.integers(0, 180)), 0, 360, color, -1)
+        else:
+            size = (int(rng.integers(10, 120) * scale), int(rng.integers(10, 120) * scale))
+            cv2.rectangle(img, center, (center[0] + size[0], center[1] + size[1]), color, -1)
+    return img
+
+def make_variant(img, variant, seed=0):
+    """Returns the candidate image of one variant."""
+    height, width = img.shape[:2]
+    if variant == 'identical':
+        return img
+    if variant == 'shifted':
+        # A few pixels, as from a re-export with a different crop origin
+        matrix = np.float32([[1, 0, 3], [0, 1, -2]])
+        return cv2.warpAffine(img, matrix, (width, height), borderMode=cv2.BORDER_REFLECT)
+    if variant == 'recolored':
+        # A slight global color cast: every pixel changes a little
+        return cv2.convertScaleAbs(img, alpha=1.04, beta=6)
+    if variant == 'changed':
+        rng = np.random.default_rng(seed + 1)
+        out = img.copy()
+        for _ in range(20):
+            w, h = int(rng.integers(width // 40, width // 8)), int(rng.integers(height // 40, height // 8))
+            x, y = int(rng.integers(0, width - w)), int(rng.integers(0, height - h))
+            out[y:y + h, x:x + w] = rng.integers(0, 256, size=3, dtype=np.uint8)
+        return out
+    raise ValueError(f"Unknown variant {variant!r}")
+
+def generate(directory, sizes=DEFAULT_SIZES, formats=tuple(FORMATS), variants=VARIANTS, seed=0):
+    """
+    Writes the corpus into directory and returns its pairs.
+
+    Returns:
+        A list of {'name', 'size', 'format', 'variant', 'width', 'height',
+        'baseline', 'candidate'} dicts, in a stable order.
+    """
+    os.makedirs(directory, exist_ok=True)
+    pairs = []
+    for size in sizes:
+        width, height = SIZES[size]
+        baseline = None
+        for fmt in formats:
+            ext, params = FORMATS[fmt]
+            baseline_path = os.path.join(directory, f"{size}_{seed}_baseline{ext}")
+            if not os.path.exists(baseline_path) or any(
+                    not os.path.exists(os.path.join(directory, f"{size}_{seed}_{v}{ext}")) for v in variants):
+                if baseline is None:
+                    baseline = make_baseline(width, height, seed)
+                _write(baseline_path, baseline, params)
+            for variant in variants:
+                path = os.path.join(directory, f"{size}_{seed}_{variant}{ext}")
+                if not os.path.exists(path):
+                    _write(path, make_variant(baseline, variant, seed), params)
+                pairs.append({'name': f"{size}-{fmt}-{variant}", 'size': size, 'format': fmt, 'variant': variant,
+                              'width': width, 'height': height, 'baseline': baseline_path, 'candidate': path})
+    return pairs
+
+def _write(path, img, params):
+    # Written under a temporary name so an interrupted run never leaves a truncated file behind
+    root, ext = os.path.splitext(path)
+    temporary = f"{root}.tmp{ext}"
+    if not cv2.imwrite(temporary, img, params):
+        raise OSError(f"Could not write {path}")
+    os.replace(temporary, path)
+
+def parse_sizes(value):
+    if value == 'all':
+        return tuple(SIZES)
+    sizes = tuple(s.strip() for s in value.split(',') if s.strip())
+    unknown = [s for s in sizes if s not in SIZES]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"Unknown sizes {unknown}; choose from {', '.join(SIZES)} or 'all'")
+    return sizes
+
+def main():
+    parser = argparse.ArgumentParser(description='Writes the synthetic benchmark corpus')
+    parser.add_argument('directory')
+    parser.add_argument('--sizes', type=parse_sizes, default=DEFAULT_SIZES)
+    parser.add_argument('--formats', default=','.join(FORMATS))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    pairs = generate(args.directory, args.sizes, tuple(args.formats.split(',')), seed=args.seed)
+    print(json.dumps(pairs, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,347 @@
+# benchmarks/suite.py - The whole comparison pipeline over the synthetic corpus
+#
+# Usage: python -m benchmarks.suite [--sizes 0.5mp,3mp,12mp|all] [--formats png,jpg]
+#                                   [--filter REGEX] [--repeat 3] [--output report.json]
+#                                   [--baseline old.json [--tolerance 0.15] [--memory-tolerance 0.15]]
+#
+# Every public function of image_compare and the /compare route (through
+# Flask's test client, with the job run inline) is timed on the pairs of
+# benchmarks.corpus. The kernels and renderers run on the 'changed' variant of
+# each size and format; compare_images and /compare run on every variant,
+# since identical and barely different pairs take different paths. Each case
+# runs in a fresh process so its peak RSS is its own, and reports the best of
+# --repeat wall times, the input megapixels per second and the peak RSS.
+#
+# The report is JSON on stdout (or --output). With --baseline, every case is
+# also compared to the same case of an earlier report; a case that got more
+# than --tolerance slower, or whose peak RSS grew by more than
+# --memory-tolerance, is listed under 'regressions' and the exit status is 1.
+import argparse
+import inspect
+import json
+import os
+import platform
+import re
+import shutil
+import sys
+import tempfile
+import time
+import cv2
+import numpy as np
+import PIL
+from benchmarks.common import best_of, peak_rss_kb, run_isolated
+from benchmarks.corpus import DEFAULT_SIZES, FORMATS, VARIANTS, generate, parse_sizes
+
+# Case name -> (image_compare functions it covers, variants it runs on, setup)
+CASES = {}
+
+def case(name, covers=(), variants=('changed',)):
+    """
+    Registers a benchmark case.
+
+    The decorated setup(path1, path2, workdir) does everything that should not
+    be timed and returns the zero-argument callable that is.
+    """
+    def register(setup):
+        CASES[name] = (tuple(covers) or (name,), variants, setup)
+        return setup
+    return register
+
+def _decoded(path1, path2):
+    from image_compare import load_pair
+    pair = load_pair(path1, path2)
+    pair.img1, pair.img2  # decoded outside the timing
+    return pair
+
+@case('read_image_size')
+def setup_read_image_size(path1, path2, workdir):
+    from image_compare import read_image_size
+    return lambda: read_image_size(path1)
+
+@case('load_image')
+def setup_load_image(path1, path2, workdir):
+    from image_compare import load_image
+    return lambda: load_image(path1)
+
+@case('load_pair', covers=('load_pair', 'LoadedPair'))
+def setup_load_pair(path1, path2, workdir):
+    from image_compare import load_pair
+    # LoadedPair decodes lazily, so the images are touched inside the timing
+    return lambda: load_pair(path1, path2).img2
+
+@case('scale_delta_e')
+def setup_scale_delta_e(path1, path2, workdir):
+    from image_compare import scale_delta_e
+    delta_e = _decoded(path1, path2).delta_e()
+    lo, hi, _, _ = cv2.minMaxLoc(delta_e)
+    out = np.empty(delta_e.shape, np.uint8)
+    return lambda: scale_delta_e(delta_e, lo, hi, out)
+
+def _over_bands(kernel, img1, img2, *args):
+    from image_compare import BAND_ROWS
+    out1, out2 = np.empty_like(img1), np.empty_like(img2)
+    def run():
+        for top in range(0, img1.shape[0], BAND_ROWS):
+            rows = slice(top, top + BAND_ROWS)
+            kernel(img1[rows], img2[rows], *(a[rows] if isinstance(a, np.ndarray) else a for a in args),
+                   out1[rows], out2[rows])
+    return run
+
+@case('color_overlay_band')
+def setup_color_overlay_band(path1, path2, workdir):
+    from image_compare import color_overlay_band
+    pair = _decoded(path1, path2)
+    delta_e = pair.delta_e()
+    lo, hi, _, _ = cv2.minMaxLoc(delta_e)
+    return _over_bands(color_overlay_band, pair.img1, pair.img2, delta_e, lo, hi)
+
+@case('gray_overlay_band')
+def setup_gray_overlay_band(path1, path2, workdir):
+    from image_compare import gray_overlay_band
+    pair = _decoded(path1, path2)
+    return _over_bands(gray_overlay_band, pair.img1, pair.img2, 0.7, 50)
+
+@case('visualize_color_difference')
+def setup_visualize_color_difference(path1, path2, workdir):
+    from image_compare import visualize_color_difference
+    return lambda: visualize_color_difference(path1, path2)
+
+@case('overlay_images_with_diff_and_transparency')
+def setup_overlay_images_with_diff_and_transparency(path1, path2, workdir):
+    from image_compare import overlay_images_with_diff_and_transparency
+    return lambda: overlay_images_with_diff_and_transparency(path1, path2)
+
+@case('compare_images', variants=VARIANTS)
+def setup_compare_images(path1, path2, workdir):
+    from image_compare import compare_images
+    out1, out2 = os.path.join(workdir, 'out1.jpg'), os.path.join(workdir, 'out2.jpg')
+    gif = os.path.join(workdir, 'out.gif')
+    return lambda: compare_images(path1, path2, out1, out2, gif_output_path=gif)
+
+@case('compare_images_parallel', covers=('compare_images', 'get_render_executor'), variants=VARIANTS)
+def setup_compare_images_parallel(path1, path2, workdir):
+    from image_compare import compare_images, get_render_executor
+    out1, out2 = os.path.join(workdir, 'out1.jpg'), os.path.join(workdir, 'out2.jpg')
+    gif = os.path.join(workdir, 'out.gif')
+    return lambda: compare_images(path1, path2, out1, out2, gif_output_path=gif, executor=get_render_executor())
+
+@case('write_overlay')
+def setup_write_overlay(path1, path2, workdir):
+    from image_compare import visualize_color_difference, write_overlay
+    overlay, _ = visualize_color_difference(path1, path2)
+    path = os.path.join(workdir, 'overlay.jpg')
+    return lambda: write_overlay(path, overlay)
+
+@case('encode_gif')
+def setup_encode_gif(path1, path2, workdir):
+    from image_compare import encode_gif
+    pair = _decoded(path1, path2)
+    return lambda: encode_gif([pair.img1, pair.img2])
+
+@case('encode_animation')
+def setup_encode_animation(path1, path2, workdir):
+    from encoding import resolve_encoding
+    from image_compare import encode_animation
+    pair = _decoded(path1, path2)
+    encoding = resolve_encoding('webp')
+    return lambda: encode_animation([pair.img1, pair.img2], encoding=encoding)
+
+@case('create_gif_from_images')
+def setup_create_gif_from_images(path1, path2, workdir):
+    from image_compare import create_gif_from_images
+    gif = os.path.join(workdir, 'out.gif')
+    return lambda: create_gif_from_images(path1, path2, gif)
+
+@case('create_optimized_gif')
+def setup_create_optimized_gif(path1, path2, workdir):
+    from image_compare import create_optimized_gif
+    gif = os.path.join(workdir, 'out.gif')
+    return lambda: create_optimized_gif(path1, path2, gif)
+
+@case('create_pillow_gif')
+def setup_create_pillow_gif(path1, path2, workdir):
+    from image_compare import create_pillow_gif
+    gif = os.path.join(workdir, 'out.gif')
+    return lambda: create_pillow_gif(path1, path2, gif)
+
+@case('compare_route', covers=('/compare',), variants=VARIANTS)
+def setup_compare_route(path1, path2, workdir):
+    # The app reads these when it is imported, and this process is fresh
+    os.environ['COMPARISON_JOBS_SYNC'] = '1'
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    from app import app
+    app.config.update(UPLOAD_FOLDER=os.path.join(workdir, 'uploads'), OUTPUT_FOLDER=os.path.join(workdir, 'outputs'),
+                      MAX_CONTENT_LENGTH=None, PROFILE_SLOW_SECONDS=None)
+    for key in ('UPLOAD_FOLDER', 'OUTPUT_FOLDER'):
+        os.makedirs(app.config[key], exist_ok=True)
+
+    client = app.test_client()
+    account = {'username': 'bench', 'email': 'bench@example.com', 'password': 'bench'}
+    client.post('/register', data=account)
+    client.post('/login', data=account)
+    with open(path1, 'rb') as f1, open(path2, 'rb') as f2:
+        data1, data2 = f1.read(), f2.read()
+
+    def post():
+        from io import BytesIO
+        response = client.post('/compare', content_type='multipart/form-data', data={
+            'title': 'bench',
+            'image1': (BytesIO(data1), os.path.basename(path1)),
+            'image2': (BytesIO(data2), os.path.basename(path2)),
+        })
+        if response.status_code != 302 or '/comparison/' not in response.location:
+            raise RuntimeError(f"/compare returned {response.status_code} {response.location}")
+        # Deleting it again keeps the next repeat from being a result-cache hit
+        post.pending.append(response.location.rstrip('/').rsplit('/', 1)[1])
+        return response
+    post.pending = []
+
+    def run():
+        while post.pending:
+            client.get(f"/delete/{post.pending.pop()}")
+        return post()
+    return run
+
+def measure(name, path1, path2, megapixels, repeat):
+    """Runs one case in this process and returns its measurements; see run_isolated."""
+    _, _, setup = CASES[name]
+    workdir = tempfile.mkdtemp(prefix='bench_')
+    try:
+        fn = setup(path1, path2, workdir)
+        setup_rss = peak_rss_kb()
+        _reset_peak_rss()
+        seconds, _ = best_of(fn, repeat)
+        return {
+            'seconds': round(seconds, 4),
+            'megapixels_per_second': round(megapixels / seconds, 2) if seconds else None,
+            'setup_peak_rss_kb': setup_rss,
+            'peak_rss_kb': peak_rss_kb(),
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def _reset_peak_rss():
+    # Linux resets VmHWM to the current RSS, so the peak after this is the timed part's
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def uncovered_functions():
+    """Returns the public functions and classes of image_compare no case covers."""
+    import image_compare
+    public = {name for name, obj in vars(image_compare).items()
+              if not name.startswith('_') and (inspect.isfunction(obj) or inspect.isclass(obj))
+              and obj.__module__ == 'image_compare'}
+    covered = {name for covers, _, _ in CASES.values() for name in covers}
+    return sorted(public - covered)
+
+def environment():
+    from importlib.metadata import version
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'opencv': cv2.__version__,
+        'numpy': np.__version__,
+        'pillow': PIL.__version__,
+        'flask': version('flask'),
+    }
+
+def compare_reports(report, baseline, tolerance=0.15, memory_tolerance=0.15):
+    """
+    Lists the cases of report that regressed against baseline.
+
+    Args:
+        report: Report of this run
+        baseline: Earlier report with the same case and pair names
+        tolerance: Allowed relative increase in seconds (0.15 = 15% slower)
+        memory_tolerance: Allowed relative increase in peak RSS
+
+    Returns:
+        A list of {'case', 'pair', 'metric', 'baseline', 'current', 'change'}
+        dicts, worst first. Cases missing from either report are skipped.
+    """
+    previous = {(r['case'], r['pair']): r for r in baseline['results'] if 'error' not in r}
+    regressions = []
+    for result in report['results']:
+        old = previous.get((result['case'], result['pair']))
+        if old is None or 'error' in result:
+            continue
+        for metric, allowed in (('seconds', tolerance), ('peak_rss_kb', memory_tolerance)):
+            if not old.get(metric) or result.get(metric) is None:
+                continue
+            change = result[metric] / old[metric] - 1
+            if change > allowed:
+                regressions.append({'case': result['case'], 'pair': result['pair'], 'metric': metric,
+                                    'baseline': old[metric], 'current': result[metric], 'change': round(change, 3)})
+    return sorted(regressions, key=lambda r: r['change'], reverse=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Times the comparison pipeline over a synthetic corpus')
+    parser.add_argument('--sizes', type=parse_sizes, default=DEFAULT_SIZES, help="e.g. 0.5mp,12mp or 'all'")
+    parser.add_argument('--formats', default=','.join(FORMATS))
+    parser.add_argument('--corpus-dir', help='Keep the corpus here between runs (default: a temporary directory)')
+    parser.add_argument('--filter', help='Only run cases whose name matches this regular expression')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='Write the report here instead of stdout')
+    parser.add_argument('--baseline', help='Report of an earlier run to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.15)
+    parser.add_argument('--memory-tolerance', type=float, default=0.15)
+    args = parser.parse_args()
+
+    corpus_dir = args.corpus_dir or tempfile.mkdtemp(prefix='bench_corpus_')
+    try:
+        pairs = generate(corpus_dir, args.sizes, tuple(args.formats.split(',')))
+        names = [name for name in CASES if not args.filter or re.search(args.filter, name)]
+        results = []
+        for name in names:
+            _, variants, _ = CASES[name]
+            for pair in pairs:
+                if pair['variant'] not in variants:
+                    continue
+                megapixels = pair['width'] * pair['height'] / 1e6
+                result = {'case': name, 'pair': pair['name'], 'megapixels': round(megapixels, 2)}
+                start = time.perf_counter()
+                try:
+                    result.update(run_isolated(measure, name, pair['baseline'], pair['candidate'], megapixels,
+                                               args.repeat))
+                except Exception as exc:
+                    result['error'] = f"{type(exc).__name__}: {exc}"
+                print(f"{name} {pair['name']}: {result.get('seconds', result.get('error'))} "
+                      f"({time.perf_counter() - start:.1f}s)", file=sys.stderr)
+                results.append(result)
+    finally:
+        if not args.corpus_dir:
+            shutil.rmtree(corpus_dir, ignore_errors=True)
+
+    report = {
+        'environment': environment(),
+        'sizes': list(args.sizes),
+        'repeat': args.repeat,
+        'uncovered': uncovered_functions(),
+        'results': results,
+    }
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        report['baseline'] = {'path': args.baseline, 'environment': baseline.get('environment'),
+                              'tolerance': args.tolerance, 'memory_tolerance': args.memory_tolerance}
+        report['regressions'] = compare_reports(report, baseline, args.tolerance, args.memory_tolerance)
+        status = 1 if report['regressions'] else 0
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if any('error' in r for r in results):
+        status = status or 2
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
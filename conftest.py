@@ -0,0 +1 @@
+# conftest.py - Puts the repository root on sys.path, so the tests import the app's modules as `python app.py` does
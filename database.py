@@ -0,0 +1,51 @@
+# database.py - Engine configuration for SQLite and server databases
+#
+# The app defaults to a local SQLite file, where concurrent writes from
+# uploads, jobs and batch runs would otherwise serialize on the rollback
+# journal. Every SQLite connection is switched to WAL (readers no longer block
+# the writer), waits for locks instead of failing at once, and gets a larger
+# page cache. DATABASE_URL points the same models at a server database, where
+# only pool settings apply.
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+# Applied to every new SQLite connection, in this order
+DEFAULT_SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',  # durable at checkpoints; safe with WAL
+    'busy_timeout': 30000,  # milliseconds to wait for a lock
+    'cache_size': -64000,  # negative: KiB, i.e. 64 MB
+    'temp_store': 'memory',
+}
+
+def database_url(url):
+    """Normalizes a DATABASE_URL (some hosts still hand out the old postgres:// scheme)."""
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+def is_sqlite(url):
+    return make_url(url).get_backend_name() == 'sqlite'
+
+def engine_options(url, pragmas=None):
+    """Returns SQLALCHEMY_ENGINE_OPTIONS suited to the database at url."""
+    if is_sqlite(url):
+        busy_timeout = (pragmas or DEFAULT_SQLITE_PRAGMAS).get('busy_timeout', 0)
+        # The sqlite3 module's own lock wait, which also covers opening the connection
+        return {'connect_args': {'timeout': busy_timeout / 1000}}
+    # Server connections can be dropped while idle in the pool
+    return {'pool_pre_ping': True, 'pool_recycle': 1800}
+
+def apply_sqlite_pragmas(engine, pragmas):
+    """Runs pragmas on every new connection of a SQLite engine; does nothing for other engines."""
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f'PRAGMA {name}={value}')
+        finally:
+            cursor.close()
@@ -0,0 +1,107 @@
+# derivatives.py - Thumbnails and previews of comparison images
+#
+# Listing pages should not pull full-size uploads and overlays. Every input
+# and overlay gets a small thumbnail and a medium-resolution preview, each as
+# WebP and as progressive JPEG, written next to the original as
+# "<name>.<size>.<ext>". Only the pixel size of each derivative is tracked on
+# the Comparison row (see DERIVATIVE_COLUMNS); the file names follow from the
+# original's path, so rows that share files through the result cache share
+# their derivatives too.
+import os
+import cv2
+from image_compare import load_image
+from instrumentation import record_written, timed
+
+# Longest side of each derivative
+DERIVATIVE_SIZES = {
+    'thumb': 320,
+    'preview': 1024,
+}
+
+# Extension and encoder parameters of each derivative format, preferred first
+DERIVATIVE_FORMATS = {
+    'webp': ('.webp', [cv2.IMWRITE_WEBP_QUALITY, 80]),
+    'jpeg': ('.jpg', [cv2.IMWRITE_JPEG_QUALITY, 85, cv2.IMWRITE_JPEG_PROGRESSIVE, 1]),
+}
+
+# Comparison column holding the original of each kind of image
+DERIVATIVE_COLUMNS = {
+    'image1': 'image1_path',
+    'image2': 'image2_path',
+    'color1': 'color_diff1_path',
+    'color2': 'color_diff2_path',
+    'gray1': 'gray_diff1_path',
+    'gray2': 'gray_diff2_path',
+}
+
+def derivative_path(path, size, fmt):
+    """Returns the path of one derivative of the image at path."""
+    return f"{os.path.splitext(path)[0]}.{size}{DERIVATIVE_FORMATS[fmt][0]}"
+
+def derivative_original_stem(path):
+    """Returns the path of the original of a derivative, without its extension (None if path is no derivative)."""
+    stem, ext = os.path.splitext(path)
+    stem, size = os.path.splitext(stem)
+    if size[1:] in DERIVATIVE_SIZES and ext in [spec[0] for spec in DERIVATIVE_FORMATS.values()]:
+        return stem
+    return None
+
+def derivative_paths(path):
+    """Returns the paths of every derivative the image at path can have."""
+    return [derivative_path(path, size, fmt) for size in DERIVATIVE_SIZES for fmt in DERIVATIVE_FORMATS]
+
+@timed('derivatives')
+def make_derivatives(path, image=None):
+    """
+    Writes the thumbnail and preview of one image next to it.
+
+    Args:
+        path: Path to the original image
+        image: Optional BGR decode of the original (at any size no smaller
+            than the largest derivative), saving a second decode
+
+    Returns:
+        dict mapping each size name to its [width, height], or None if the
+        image could not be decoded. Images smaller than a size are written at
+        their own size.
+    """
+    if image is None:
+        image = load_image(path, max(DERIVATIVE_SIZES.values()))
+        if image is None:
+            return None
+
+    sizes = {}
+    height, width = image.shape[:2]
+    # Largest first, so each size is resized from the one above it
+    for size, max_dim in sorted(DERIVATIVE_SIZES.items(), key=lambda item: -item[1]):
+        scale = min(1.0, max_dim / max(height, width))
+        if scale < 1:
+            image = cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))),
+                               interpolation=cv2.INTER_AREA)
+            height, width = image.shape[:2]
+        for fmt, (_, params) in DERIVATIVE_FORMATS.items():
+            if not cv2.imwrite(derivative_path(path, size, fmt), image, params):
+                raise OSError(f"Could not write {derivative_path(path, size, fmt)}")
+        sizes[size] = [width, height]
+    record_written('derivative', *derivative_paths(path))
+    return sizes
+
+def make_comparison_derivatives(paths, images=None):
+    """
+    Writes the derivatives of several images of a comparison.
+
+    Args:
+        paths: dict mapping kinds (see DERIVATIVE_COLUMNS) to image paths
+        images: Optional dict mapping kinds to decoded images
+
+    Returns:
+        dict mapping each kind that could be decoded to its sizes (see make_derivatives)
+    """
+    images = images or {}
+    derivatives = {}
+    for kind, path in paths.items():
+        if kind in DERIVATIVE_COLUMNS and path:
+            sizes = make_derivatives(path, images.get(kind))
+            if sizes:
+                derivatives[kind] = sizes
+    return derivatives
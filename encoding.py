@@ -0,0 +1,171 @@
+# encoding.py - Output formats and quality presets of the rendered artifacts
+#
+# The overlays, the alternating animation and the region zooms are the
+# largest files a comparison stores and serves. Each of these artifact types
+# has its own format (OVERLAY_FORMAT, ANIMATION_FORMAT and ZOOM_FORMAT in
+# app.config, or per comparison), and one preset (ENCODING_PRESET) sets the
+# quality and encoder effort of all of them; ENCODING_QUALITY overrides the
+# preset's quality. Stills are encoded from the in-memory BGR arrays with
+# cv2.imencode; animations go through Pillow, since OpenCV cannot write
+# animated files. The defaults are the JPEG overlays and GIF the app has
+# always written, and only options that differ from them become part of the
+# rendering options, so existing cache keys stay valid.
+import os
+import cv2
+
+# Extension and longest side of each format, and whether it holds stills and animations
+OUTPUT_FORMATS = {
+    'jpeg': {'ext': '.jpg', 'max_side': 65500, 'still': True, 'animated': False},
+    'webp': {'ext': '.webp', 'max_side': 16383, 'still': True, 'animated': True},
+    'avif': {'ext': '.avif', 'max_side': 65536, 'still': True, 'animated': True},
+    'png': {'ext': '.png', 'max_side': 2 ** 31 - 1, 'still': True, 'animated': True},
+    'gif': {'ext': '.gif', 'max_side': 65535, 'still': False, 'animated': True},
+}
+
+# Effort runs from 0 (fastest) to 9 (smallest files); quality is on each
+# lossy encoder's own 0-100 scale. PNG and GIF ignore the quality.
+ENCODING_PRESETS = {
+    'high': {'effort': 3, 'quality': {'jpeg': 95, 'webp': 90, 'avif': 80}},
+    'balanced': {'effort': 5, 'quality': {'jpeg': 85, 'webp': 80, 'avif': 60}},
+    'small': {'effort': 8, 'quality': {'jpeg': 75, 'webp': 65, 'avif': 45}},
+}
+DEFAULT_PRESET = 'high'
+
+# Artifact type -> (option holding its format, formats it may use, default format)
+ARTIFACT_FORMATS = {
+    'overlay': ('overlay_format', tuple(f for f, spec in OUTPUT_FORMATS.items() if spec['still']), 'jpeg'),
+    'animation': ('animation_format', tuple(f for f, spec in OUTPUT_FORMATS.items() if spec['animated']), 'gif'),
+    'zoom': ('zoom_format', tuple(f for f, spec in OUTPUT_FORMATS.items() if spec['still']), 'jpeg'),
+}
+
+# Rendering option -> app.config key it is read from
+ENCODING_CONFIG = {
+    'overlay_format': 'OVERLAY_FORMAT',
+    'animation_format': 'ANIMATION_FORMAT',
+    'zoom_format': 'ZOOM_FORMAT',
+    'encoding_preset': 'ENCODING_PRESET',
+    'encoding_quality': 'ENCODING_QUALITY',
+}
+
+def parse_encoding(values):
+    """
+    Validates the encoding options in values (a form, JSON payload or config subset).
+
+    Missing, None and empty values are left out, so the result only holds
+    what was actually chosen.
+
+    Raises:
+        ValueError: for an unknown format or preset, or a quality outside 1-100.
+    """
+    options = {}
+    for key, allowed, _ in ARTIFACT_FORMATS.values():
+        fmt = values.get(key)
+        if fmt:
+            fmt = str(fmt).lower()
+            if fmt not in allowed:
+                raise ValueError(f"{key} must be one of {', '.join(allowed)}, got {fmt!r}")
+            options[key] = fmt
+    preset = values.get('encoding_preset')
+    if preset:
+        if preset not in ENCODING_PRESETS:
+            raise ValueError(f"encoding_preset must be one of {', '.join(ENCODING_PRESETS)}, got {preset!r}")
+        options['encoding_preset'] = preset
+    quality = values.get('encoding_quality')
+    if quality not in (None, ''):
+        quality = int(quality)
+        if not 1 <= quality <= 100:
+            raise ValueError(f"encoding_quality must be between 1 and 100, got {quality}")
+        options['encoding_quality'] = quality
+    return options
+
+def encoding_options(values):
+    """Returns the validated encoding options of values that differ from the defaults (see parse_encoding)."""
+    options = parse_encoding(values)
+    for key, _, default in ARTIFACT_FORMATS.values():
+        if options.get(key) == default:
+            del options[key]
+    if options.get('encoding_preset') == DEFAULT_PRESET:
+        del options['encoding_preset']
+    return options
+
+def resolve_encoding(fmt, preset=DEFAULT_PRESET, quality=None):
+    """Returns the {'format', 'quality', 'effort'} encoding of fmt under preset."""
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format {fmt!r}")
+    settings = ENCODING_PRESETS[preset]
+    return {
+        'format': fmt,
+        'quality': quality or settings['quality'].get(fmt),
+        'effort': settings['effort'],
+    }
+
+def artifact_encoding(options, artifact, longest_side=None):
+    """
+    Returns the encoding of one artifact type under the rendering options.
+
+    Args:
+        options: Rendering parameters (see jobs.comparison_options)
+        artifact: 'overlay', 'animation' or 'zoom'
+        longest_side: Optional longest side of the frame; formats that cannot
+            store a frame that large (WebP stops at 16383 pixels) fall back to JPEG
+    """
+    options = options or {}
+    key, _, default = ARTIFACT_FORMATS[artifact]
+    fmt = options.get(key) or default
+    if longest_side and longest_side > OUTPUT_FORMATS[fmt]['max_side']:
+        fmt = 'jpeg'
+    return resolve_encoding(fmt, options.get('encoding_preset') or DEFAULT_PRESET, options.get('encoding_quality'))
+
+def encoding_for_path(path):
+    """Returns the default encoding of the format path's extension (JPEG if unknown)."""
+    ext = os.path.splitext(path)[1].lower().replace('.jpeg', '.jpg')
+    return resolve_encoding(next((f for f, spec in OUTPUT_FORMATS.items() if spec['ext'] == ext), 'jpeg'))
+
+def with_extension(path, encoding):
+    """Returns path with the extension of encoding's format."""
+    return os.path.splitext(path)[0] + OUTPUT_FORMATS[encoding['format']]['ext']
+
+def avif_speed(effort):
+    """AV1 encoder speed (0 slowest to 9 fastest) of an effort; below 5 it takes seconds per megapixel."""
+    return 9 - effort // 2
+
+def imencode_params(encoding):
+    """Returns the cv2.imencode parameters of a still encoding."""
+    fmt, quality, effort = encoding['format'], encoding['quality'], encoding['effort']
+    if fmt == 'jpeg':
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        if effort >= 5:
+            params += [cv2.IMWRITE_JPEG_OPTIMIZE, 1, cv2.IMWRITE_JPEG_PROGRESSIVE, 1]
+        return params
+    if fmt == 'webp':
+        # OpenCV exposes no effort setting for WebP
+        return [cv2.IMWRITE_WEBP_QUALITY, quality]
+    if fmt == 'avif':
+        return [cv2.IMWRITE_AVIF_QUALITY, quality, cv2.IMWRITE_AVIF_SPEED, avif_speed(effort)]
+    if fmt == 'png':
+        return [cv2.IMWRITE_PNG_COMPRESSION, effort]
+    raise ValueError(f"{fmt} cannot store a still image")
+
+def pillow_save_args(encoding):
+    """Returns the Pillow format and save() keywords of an animation (GIF: see image_compare.encode_gif)."""
+    fmt, quality, effort = encoding['format'], encoding['quality'], encoding['effort']
+    if fmt == 'webp':
+        return 'WEBP', {'quality': quality, 'method': round(effort * 6 / 9)}
+    if fmt == 'avif':
+        return 'AVIF', {'quality': quality, 'speed': avif_speed(effort)}
+    if fmt == 'png':
+        return 'PNG', {'compress_level': effort}
+    raise ValueError(f"{fmt} animations are not written with pillow_save_args")
+
+def encode_image(img, encoding):
+    """Encodes a BGR image in memory and returns the file contents as a uint8 array."""
+    ok, data = cv2.imencode(OUTPUT_FORMATS[encoding['format']]['ext'], img, imencode_params(encoding))
+    if not ok:
+        raise OSError(f"Could not encode a {img.shape[1]}x{img.shape[0]} image as {encoding['format']}")
+    return data
+
+def write_image(path, img, encoding=None):
+    """Encodes a BGR image (by default in the format of path's extension) and writes it to path."""
+    data = encode_image(img, encoding or encoding_for_path(path))
+    data.tofile(path)
+    return data.size
@@ -1,81 +1,427 @@
 import cv2
 import numpy as np
-import imageio
+import io
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from PIL import Image
+from delta_e import delta_e_map
+from encoding import OUTPUT_FORMATS, encoding_for_path, pillow_save_args, write_image
+from instrumentation import record_written, stage, submit, timed
+from registration import estimate_transform, is_identity, stored_transform, transform_record, warp_onto
+
+_render_executor = None
+_render_executor_lock = threading.Lock()
+
+# cv2.imread flags that decode at 1/n of the native size (libjpeg scales while decoding)
+REDUCED_DECODE_FLAGS = [
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+]
+
+def read_image_size(image_path):
+    """Returns (width, height) from the image header without decoding it, or None."""
+    try:
+        with Image.open(image_path) as img:
+            return img.size
+    except Exception:
+        return None
+
+@timed('decode')
+def load_image(image_path, max_dim=3000, min_size=None):
+    """
+    Decodes an image at the smallest scale that still covers the target size.
+
+    The decode scale (1/2, 1/4 or 1/8) is picked from the header before any
+    pixel is decoded, so oversized JPEGs never exist at full resolution in
+    memory. The result is then resized once, with INTER_AREA, so that its
+    longest side is at most max_dim.
+
+    Args:
+        image_path: Path to the image
+        max_dim: Longest side of the result in pixels (None keeps the native size)
+        min_size: Optional (width, height) the decode must not go below, used
+            to bring a second image to the exact size of the first one
+
+    Returns:
+        The BGR image, or None if it could not be decoded.
+    """
+    size = read_image_size(image_path)
+    flag = cv2.IMREAD_COLOR
+    if size and (max_dim or min_size):
+        # Compare sides sorted by length so EXIF rotation does not matter
+        native = sorted(size)
+        if min_size:
+            target = sorted(min_size)
+        else:
+            scale = min(1.0, max_dim / native[1])
+            target = [native[0] * scale, native[1] * scale]
+        for factor, reduced_flag in REDUCED_DECODE_FLAGS:
+            if native[0] // factor >= target[0] and native[1] // factor >= target[1]:
+                flag = reduced_flag
+                break
+
+    img = cv2.imread(image_path, flag)
+    if img is None or min_size or not max_dim:
+        return img
 
-def resize_if_large(img, max_dim=3000):
     height, width = img.shape[:2]
-    if height > max_dim or width > max_dim:
-        scale = 0.5
-        img = cv2.resize(img, (int(width * scale), int(height * scale)))
+    if max(height, width) > max_dim:
+        scale = max_dim / max(height, width)
+        img = cv2.resize(img, (max(1, round(width * scale)), max(1, round(height * scale))),
+                         interpolation=cv2.INTER_AREA)
     return img
 
-def visualize_color_difference(image_path1, image_path2):
-    img1 = resize_if_large(cv2.imread(image_path1))
-    img2 = resize_if_large(cv2.imread(image_path2))
-    if img1 is None or img2 is None:
-        return None, None
+def _same_scale_dim(image_path1, image_path2, img1):
+    """Longest side that decodes the second image at the same pixel scale as the decoded first image."""
+    size1, size2 = read_image_size(image_path1), read_image_size(image_path2)
+    if size1 is None or size2 is None:
+        return max(img1.shape[:2])
+    return max(1, round(max(size2) * max(img1.shape[:2]) / max(size1)))
 
-    img1_lab = cv2.cvtColor(img1, cv2.COLOR_BGR2Lab)
-    img2_lab = cv2.cvtColor(img2, cv2.COLOR_BGR2Lab)
+class LoadedPair:
+    """
+    Two images decoded and normalized once, shared by every renderer.
 
-    delta_e = np.sqrt(np.sum((img1_lab - img2_lab) ** 2, axis=2))
-    delta_e_normalized = cv2.normalize(delta_e, None, 0, 255, cv2.NORM_MINMAX)
-    heatmap = cv2.applyColorMap(delta_e_normalized.astype(np.uint8), cv2.COLORMAP_JET)
+    The BGR frames are decoded eagerly, straight at the working resolution
+    (see load_image), and the second image is brought to the exact size of the
+    first so the renderers can diff them pixel for pixel. The Delta-E map is
+    only computed the first time a renderer asks for it and is then reused.
 
-    overlay_img1 = cv2.addWeighted(img1, 0.7, heatmap, 0.3, 0)
-    overlay_img2 = cv2.addWeighted(img2, 0.7, heatmap, 0.3, 0)
+    With registration, the second image is decoded at the pixel scale of the
+    first rather than stretched to its size, so a different crop stays a
+    shift, and is then warped onto the first (see registration.py). It is
+    only stretched when no transform could be estimated. The estimate is kept
+    in registration (see registration.transform_record) and, passed back in
+    as stored, spares a later decode of the same pair from estimating again.
 
-    return overlay_img1, overlay_img2
+    Args:
+        image_path1: Path to the first image
+        image_path2: Path to the second image
+        max_dim: Longest side of the working resolution (None keeps the native size)
+        registration: None, or one of registration.REGISTRATION_MODES
+        stored: Optional transform_record of an earlier estimate for this pair
+    """
 
-def overlay_images_with_diff_and_transparency(image_path1, image_path2, alpha=0.7):
-    img1 = resize_if_large(cv2.imread(image_path1))
-    img2 = resize_if_large(cv2.imread(image_path2))
-    if img1 is None or img2 is None:
-        return None, None
+    def __init__(self, image_path1, image_path2, max_dim=3000, registration=None, stored=None):
+        self.image_path1 = image_path1
+        self.image_path2 = image_path2
+        self.img1 = load_image(image_path1, max_dim)
+        self.img2 = None
+        # Matrix the second image was warped with, if registration moved it
+        self.transform = None
+        self.registration = None
+        if self.img1 is not None:
+            height, width = self.img1.shape[:2]
+            if registration:
+                img2 = load_image(image_path2, _same_scale_dim(image_path1, image_path2, self.img1))
+            else:
+                img2 = load_image(image_path2, min_size=(width, height))
+                if img2 is not None and img2.shape[:2] != (height, width):
+                    img2 = cv2.resize(img2, (width, height), interpolation=cv2.INTER_AREA)
+            if img2 is not None and registration:
+                size1 = read_image_size(image_path1)
+                scale = width / size1[0] if size1 else 1.0
+                found, matrix = stored_transform(stored, registration, scale)
+                if not found:
+                    with stage('registration'):
+                        matrix = estimate_transform(self.img1, img2, registration)
+                self.registration = transform_record(matrix, registration, scale)
+                if matrix is not None and (img2.shape != self.img1.shape or not is_identity(matrix)):
+                    with stage('warp'):
+                        img2 = warp_onto(self.img1, img2, matrix)
+                    self.transform = matrix
+                elif img2.shape != self.img1.shape:
+                    img2 = cv2.resize(img2, (width, height), interpolation=cv2.INTER_AREA)
+            self.img2 = img2
+        self._delta_e = {}
+
+    @classmethod
+    def from_images(cls, img1, img2):
+        """Wraps two BGR frames that are already decoded and the same size (see sequences.compare_set)."""
+        pair = cls.__new__(cls)
+        pair.image_path1 = pair.image_path2 = None
+        pair.img1, pair.img2 = img1, img2
+        pair.transform = None
+        pair.registration = None
+        pair._delta_e = {}
+        return pair
+
+    @property
+    def ok(self):
+        return self.img1 is not None and self.img2 is not None
+
+    def delta_e(self, method='cie76'):
+        """Returns the float32 Delta-E map of the pair, computed once per method."""
+        if method not in self._delta_e:
+            with stage('delta_e'):
+                self._delta_e[method] = delta_e_map(self.img1, self.img2, method)
+        return self._delta_e[method]
+
+def load_pair(image_path1, image_path2, max_dim=3000, registration=None, stored=None):
+    """Decodes both images once and returns a LoadedPair."""
+    return LoadedPair(image_path1, image_path2, max_dim, registration, stored)
+
+# Rows per band for the overlay kernels. Every renderer works band by band, so
+# only the outputs are full-frame; tiled_compare runs the same kernels over
+# rasters read from disk, which is what makes both paths produce identical pixels.
+BAND_ROWS = 256
+
+def scale_delta_e(delta_e, lo, hi, out=None):
+    """Maps Delta-E values from [lo, hi] to 0..255, like cv2.NORM_MINMAX over the whole map."""
+    scale = 255.0 / (hi - lo) if hi > lo else 0.0
+    return cv2.convertScaleAbs(delta_e, out, scale, -lo * scale)
+
+def color_overlay_band(img1, img2, delta_e, lo, hi, out1, out2):
+    """Blends the Delta-E heatmap of one band onto both images, writing into out1/out2."""
+    heatmap = cv2.applyColorMap(scale_delta_e(delta_e, lo, hi), cv2.COLORMAP_JET)
+    cv2.addWeighted(img1, 0.7, heatmap, 0.3, 0, dst=out1)
+    cv2.addWeighted(img2, 0.7, heatmap, 0.3, 0, dst=out2)
+
+def gray_overlay_band(img1, img2, alpha, threshold, out1, out2):
+    """
+    Swaps changed pixels of one band for the faded pixels of the other image.
 
+    Pixels whose grayscale difference is above threshold show the other image
+    scaled by alpha; all other pixels are copied unchanged.
+    """
     diff = cv2.absdiff(img1, img2)
     gray_diff = cv2.cvtColor(diff, cv2.COLOR_BGR2GRAY)
-    _, thresh = cv2.threshold(gray_diff, 50, 255, cv2.THRESH_BINARY)
-    mask = cv2.cvtColor(thresh, cv2.COLOR_GRAY2BGR)
+    _, thresh = cv2.threshold(gray_diff, threshold, 255, cv2.THRESH_BINARY)
+    mask = (thresh == 255)[..., np.newaxis]
+
+    np.copyto(out1, img1)
+    np.copyto(out2, img2)
+    np.copyto(out1, cv2.addWeighted(img2, alpha, img2, 0, 0), where=mask)
+    np.copyto(out2, cv2.addWeighted(img1, alpha, img1, 0, 0), where=mask)
+
+def visualize_color_difference(image_path1, image_path2, pair=None, delta_e_method="cie76"):
+    if pair is None:
+        pair = load_pair(image_path1, image_path2)
+    if not pair.ok:
+        return None, None
+
+    img1, img2 = pair.img1, pair.img2
+
+    delta_e = pair.delta_e(delta_e_method)
+    lo, hi, _, _ = cv2.minMaxLoc(delta_e)
+
+    overlay_img1 = np.empty_like(img1)
+    overlay_img2 = np.empty_like(img2)
+    with stage('color_overlay'):
+        for top in range(0, img1.shape[0], BAND_ROWS):
+            rows = slice(top, top + BAND_ROWS)
+            color_overlay_band(img1[rows], img2[rows], delta_e[rows], lo, hi, overlay_img1[rows], overlay_img2[rows])
+
+    return overlay_img1, overlay_img2
 
-    img1_overlayed = img1.copy()
-    img2_overlayed = img2.copy()
+def overlay_images_with_diff_and_transparency(image_path1, image_path2, alpha=0.7, pair=None, threshold=50):
+    if pair is None:
+        pair = load_pair(image_path1, image_path2)
+    if not pair.ok:
+        return None, None
 
-    img1_transparent = cv2.addWeighted(img1, alpha, np.zeros_like(img1), 0, 0)
-    img2_transparent = cv2.addWeighted(img2, alpha, np.zeros_like(img2), 0, 0)
+    img1, img2 = pair.img1, pair.img2
 
-    img1_overlayed[mask == 255] = img2_transparent[mask == 255]
-    img2_overlayed[mask == 255] = img1_transparent[mask == 255]
+    img1_overlayed = np.empty_like(img1)
+    img2_overlayed = np.empty_like(img2)
+    with stage('gray_overlay'):
+        for top in range(0, img1.shape[0], BAND_ROWS):
+            rows = slice(top, top + BAND_ROWS)
+            gray_overlay_band(img1[rows], img2[rows], alpha, threshold, img1_overlayed[rows], img2_overlayed[rows])
 
     return img1_overlayed, img2_overlayed
 
-def compare_images(image_path1, image_path2, output_path1, output_path2, mode="both", alpha=0.7):
+def compare_images(image_path1, image_path2, output_path1, output_path2, mode="both", alpha=0.7, pair=None,
+                   gif_output_path=None, executor=None, delta_e_method="cie76", threshold=50, gif_duration=1000.0,
+                   overlay_encoding=None, animation_encoding=None):
+    """
+    Renders the color and/or grayscale overlays (and optionally the GIF) for a pair.
+
+    Without an executor the renderers run one after the other. With one (see
+    get_render_executor) the color, grayscale and GIF renderers run at the same
+    time, and each overlay is written to disk as soon as it is ready, so the
+    cv2.imwrite and GIF encoding overlap with the remaining computation. Must
+    not be called from a thread of that same executor.
+
+    Args:
+        image_path1: Path to the first image
+        image_path2: Path to the second image
+        output_path1: Base path for the overlays of the first image ("out1.jpg" gives "out1_color1.jpg", ...)
+        output_path2: Base path for the overlays of the second image
+        mode: "both", "color" or "grayscale"
+        alpha: Transparency used by the grayscale overlay
+        pair: Optional LoadedPair to reuse instead of decoding the images again
+        gif_output_path: Optional path for the alternating animation
+        executor: Optional concurrent.futures executor to render in parallel
+        delta_e_method: "cie76" or "ciede2000" for the color heatmap
+        threshold: Grayscale difference above which a pixel counts as changed
+        gif_duration: Duration of each GIF frame in milliseconds
+        overlay_encoding: Optional encoding of the overlays (see encoding.artifact_encoding);
+            it replaces the extension of the output paths. By default the
+            extension of output_path1 picks the format.
+        animation_encoding: Optional encoding of the animation (see create_gif_from_images)
+    """
     results = {}
+    if pair is None:
+        pair = load_pair(image_path1, image_path2)
 
+    renderers = {}
     if mode in ["both", "color"]:
-        color_overlay1, color_overlay2 = visualize_color_difference(image_path1, image_path2)
-        if color_overlay1 is not None and color_overlay2 is not None:
-            path1 = output_path1.replace(".jpg", "_color1.jpg")
-            path2 = output_path2.replace(".jpg", "_color2.jpg")
-            cv2.imwrite(path1, color_overlay1)
-            cv2.imwrite(path2, color_overlay2)
-            results["color1"] = path1
-            results["color2"] = path2
-
+        renderers["color"] = lambda: visualize_color_difference(image_path1, image_path2, pair=pair,
+                                                                delta_e_method=delta_e_method)
     if mode in ["both", "grayscale"]:
-        gray_overlay1, gray_overlay2 = overlay_images_with_diff_and_transparency(image_path1, image_path2, alpha)
-        if gray_overlay1 is not None and gray_overlay2 is not None:
-            path1 = output_path1.replace(".jpg", "_gray1.jpg")
-            path2 = output_path2.replace(".jpg", "_gray2.jpg")
-            cv2.imwrite(path1, gray_overlay1)
-            cv2.imwrite(path2, gray_overlay2)
-            results["gray1"] = path1
-            results["gray2"] = path2
-
+        renderers["gray"] = lambda: overlay_images_with_diff_and_transparency(image_path1, image_path2, alpha, pair=pair,
+                                                                              threshold=threshold)
+
+    overlay_encoding = overlay_encoding or encoding_for_path(output_path1)
+    ext = OUTPUT_FORMATS[overlay_encoding['format']]['ext']
+
+    def output_paths(kind):
+        return (f"{os.path.splitext(output_path1)[0]}_{kind}1{ext}",
+                f"{os.path.splitext(output_path2)[0]}_{kind}2{ext}")
+
+    if executor is None:
+        for kind, render in renderers.items():
+            overlay1, overlay2 = render()
+            if overlay1 is not None and overlay2 is not None:
+                path1, path2 = output_paths(kind)
+                write_overlay(path1, overlay1, overlay_encoding)
+                write_overlay(path2, overlay2, overlay_encoding)
+                results[f"{kind}1"] = path1
+                results[f"{kind}2"] = path2
+        if gif_output_path:
+            results["gif"] = create_gif_from_images(image_path1, image_path2, gif_output_path, gif_duration, pair=pair,
+                                                    encoding=animation_encoding)
+        return results
+
+    gif_future = None
+    if gif_output_path:
+        gif_future = submit(executor, create_gif_from_images, image_path1, image_path2, gif_output_path,
+                            gif_duration, pair=pair, encoding=animation_encoding)
+    render_futures = {submit(executor, render): kind for kind, render in renderers.items()}
+
+    writes = []
+    for future in as_completed(render_futures):
+        overlay1, overlay2 = future.result()
+        if overlay1 is None or overlay2 is None:
+            continue
+        kind = render_futures[future]
+        path1, path2 = output_paths(kind)
+        writes.append(submit(executor, write_overlay, path1, overlay1, overlay_encoding))
+        writes.append(submit(executor, write_overlay, path2, overlay2, overlay_encoding))
+        results[f"{kind}1"] = path1
+        results[f"{kind}2"] = path2
+
+    for future in writes:
+        future.result()
+    if gif_future is not None:
+        results["gif"] = gif_future.result()
     return results
 
+def write_overlay(path, overlay, encoding=None):
+    """Encodes an overlay to path, by default in the format of its extension (see encoding.write_image)."""
+    with stage('write'):
+        write_image(path, overlay, encoding)
+    record_written('overlay', path)
+    return True
+
+def get_render_executor(max_workers=3):
+    """
+    Returns the thread pool shared by all comparisons in this process.
+
+    OpenCV releases the GIL inside its kernels, so threads are enough to run
+    the renderers side by side. The pool is created on first use with
+    max_workers threads and reused afterwards.
+    """
+    global _render_executor
+    with _render_executor_lock:
+        if _render_executor is None:
+            _render_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='render')
+        return _render_executor
+
+@timed('gif')
+def encode_gif(frames, output=None, duration=1000.0, resize_factor=0.5, colors=256, optimize=False, loop=0):
+    """
+    Encodes decoded BGR frames as an animated GIF with one shared palette.
+
+    The frames are resized once and quantized together as a single stacked
+    image, so they share one global palette, pixels that are equal in two
+    frames get the same index, and the GIF encoder can store later frames as
+    small deltas. Nothing touches the disk except the output itself.
+
+    Args:
+        frames: uint8 BGR arrays of the same size (e.g. pair.img1, pair.img2)
+        output: Path or writable binary file object; None returns the GIF as bytes
+        duration: Duration each frame is displayed in milliseconds
+        resize_factor: Factor to resize the frames (0.5 = half size)
+        colors: Number of colors in the shared palette (at most 256)
+        optimize: Let Pillow drop unused palette entries
+        loop: Number of loops, 0 = forever
+
+    Returns:
+        output, or the encoded bytes when output is None.
+    """
+    rgb, size = _stacked_rgb(frames, resize_factor)
+    stacked = Image.fromarray(rgb).quantize(colors, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+    indices = np.asarray(stacked)
+    palette = stacked.getpalette()
+    images = []
+    for n in range(len(frames)):
+        image = Image.fromarray(indices[n * size[1]:(n + 1) * size[1]], mode='P')
+        image.putpalette(palette)
+        images.append(image)
+
+    target = io.BytesIO() if output is None else output
+    images[0].save(target, format='GIF', save_all=True, append_images=images[1:], duration=duration, loop=loop,
+                   optimize=optimize)
+    return target.getvalue() if output is None else output
+
+def _stacked_rgb(frames, resize_factor):
+    """Resizes BGR frames once into one RGB array, stacked vertically; returns it and the (width, height) of a frame."""
+    height, width = frames[0].shape[:2]
+    size = (max(1, int(width * resize_factor)), max(1, int(height * resize_factor)))
+    rgb = np.empty((len(frames) * size[1], size[0], 3), dtype=np.uint8)
+    for n, frame in enumerate(frames):
+        if frame.shape[:2] != (height, width):
+            raise ValueError(f"All frames must have the same size, got {frame.shape[:2]} and {(height, width)}")
+        rows = rgb[n * size[1]:(n + 1) * size[1]]
+        small = frame if size == (width, height) else cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(small, cv2.COLOR_BGR2RGB, dst=rows)
+    return rgb, size
+
+def encode_animation(frames, output=None, encoding=None, duration=1000.0, resize_factor=0.5, loop=0):
+    """
+    Encodes decoded BGR frames as an animation in any animated output format.
+
+    GIFs go through encode_gif (256 shared colors; effort 5 and up lets
+    Pillow optimize the palette). WebP, AVIF and PNG (APNG) animations keep
+    full color and are written by Pillow from the same resized frames.
+
+    Args:
+        frames: uint8 BGR arrays of the same size
+        output: Path or writable binary file object; None returns the file as bytes
+        encoding: Encoding of the animation (see encoding.artifact_encoding); defaults
+            to the format of output's extension, or GIF
+        duration: Duration each frame is displayed in milliseconds
+        resize_factor: Factor to resize the frames (0.5 = half size)
+        loop: Number of loops, 0 = forever
+    """
+    if encoding is None:
+        encoding = encoding_for_path(output) if isinstance(output, str) else {'format': 'gif', 'effort': 0}
+    if encoding['format'] == 'gif':
+        return encode_gif(frames, output, duration, resize_factor, optimize=encoding['effort'] >= 5, loop=loop)
+
+    with stage('animation'):
+        rgb, size = _stacked_rgb(frames, resize_factor)
+        images = [Image.fromarray(rgb[n * size[1]:(n + 1) * size[1]]) for n in range(len(frames))]
+        fmt, params = pillow_save_args(encoding)
+        target = io.BytesIO() if output is None else output
+        images[0].save(target, format=fmt, save_all=True, append_images=images[1:], duration=round(duration),
+                       loop=loop, **params)
+    return target.getvalue() if output is None else output
+
 def create_optimized_gif(image_path1, image_path2, gif_output_path, duration=1000, resize_factor=0.5, optimize=True):
     """
     Creates an optimized GIF alternating between two images.
@@ -88,60 +434,14 @@ def create_optimized_gif(image_path1, image_path2, gif_output_path, duration=100
         resize_factor: Factor to resize images (0.5 = half size)
         optimize: Whether to apply GIF optimization
     """
-    img1 = cv2.imread(image_path1)
-    img2 = cv2.imread(image_path2)
-
-    if img1 is None or img2 is None:
+    pair = load_pair(image_path1, image_path2, max_dim=None)
+    if not pair.ok:
         return None
-
-    # Resize images to reduce file size
-    height, width = img1.shape[:2]
-    new_width = int(width * resize_factor)
-    new_height = int(height * resize_factor)
-    img1 = cv2.resize(img1, (new_width, new_height))
-    img2 = cv2.resize(img2, (new_width, new_height))
-
-    # Convert to RGB
-    img1_rgb = cv2.cvtColor(img1, cv2.COLOR_BGR2RGB)
-    img2_rgb = cv2.cvtColor(img2, cv2.COLOR_BGR2RGB)
-
-    # Convert to PIL Images and reduce colors
-    pil_img1 = Image.fromarray(img1_rgb).convert('P', palette=Image.ADAPTIVE, colors=128)
-    pil_img2 = Image.fromarray(img2_rgb).convert('P', palette=Image.ADAPTIVE, colors=128)
-
-    # Save as temporary files
-    temp_path1 = "temp_img1.png"
-    temp_path2 = "temp_img2.png"
-    pil_img1.save(temp_path1)
-    pil_img2.save(temp_path2)
-
-    # Create GIF with optimizations
-    frames = []
-    frames.append(imageio.imread(temp_path1))
-    frames.append(imageio.imread(temp_path2))
-
-    imageio.mimsave(
-        gif_output_path,
-        frames,
-        duration=duration,
-        loop=0,
-        optimize=optimize,
-        quantizer='nq',  # neuquant quantizer for better color reduction
-        palettesize=128  # Reduce palette size
-    )
-
-    # Clean up temporary files
-    try:
-        os.remove(temp_path1)
-        os.remove(temp_path2)
-    except:
-        pass
-
-    return gif_output_path
+    return encode_gif([pair.img1, pair.img2], gif_output_path, duration, resize_factor, colors=128, optimize=optimize)
 
 def create_pillow_gif(image_path1, image_path2, gif_output_path, duration=1000, resize_factor=0.5, colors=64):
     """
-    Creates an optimized GIF using Pillow library for better compression.
+    Creates a small GIF with a reduced shared palette.
 
     Args:
         image_path1: Path to the first image
@@ -151,62 +451,32 @@ def create_pillow_gif(image_path1, image_path2, gif_output_path, duration=1000,
         resize_factor: Factor to resize images (0.5 = half size)
         colors: Number of colors in the palette (lower = smaller file)
     """
-    # Load images with PIL for better optimization
-    img1 = Image.open(image_path1)
-    img2 = Image.open(image_path2)
-
-    # Resize to reduce file size
-    new_width = int(img1.width * resize_factor)
-    new_height = int(img1.height * resize_factor)
-    img1 = img1.resize((new_width, new_height), Image.LANCZOS)
-    img2 = img2.resize((new_width, new_height), Image.LANCZOS)
-
-    # Convert to P mode (palette) with reduced colors for GIF efficiency
-    img1 = img1.convert('P', palette=Image.ADAPTIVE, colors=colors)
-    img2 = img2.convert('P', palette=Image.ADAPTIVE, colors=colors)
-
-    # Save as GIF with optimizations
-    img1.save(
-        gif_output_path,
-        save_all=True,
-        append_images=[img2],
-        optimize=True,
-        duration=duration,
-        loop=0
-    )
-
-    return gif_output_path
-# Add this function back to your image_compare.py file:
+    pair = load_pair(image_path1, image_path2, max_dim=None)
+    if not pair.ok:
+        return None
+    return encode_gif([pair.img1, pair.img2], gif_output_path, duration, resize_factor, colors=colors, optimize=True)
 
-def create_gif_from_images(image_path1, image_path2, gif_output_path, duration=1000.0):
+def create_gif_from_images(image_path1, image_path2, gif_output_path, duration=1000.0, pair=None, encoding=None):
     """
-    Creates a GIF alternating between two images with the specified duration.
+    Creates an animation alternating between two images with the specified duration.
 
     Args:
         image_path1: Path to the first image
         image_path2: Path to the second image
-        gif_output_path: Path where the GIF will be saved
+        gif_output_path: Path where the animation will be saved
         duration: Duration each frame is displayed in milliseconds (default: 1000 milliseconds)
+        pair: Optional LoadedPair to reuse instead of decoding the images again
+        encoding: Optional encoding (see encode_animation); by default the
+            extension of gif_output_path picks the format
     """
-    img1 = resize_if_large(cv2.imread(image_path1))
-    img2 = resize_if_large(cv2.imread(image_path2))
-    if img1 is None or img2 is None:
+    if pair is None:
+        pair = load_pair(image_path1, image_path2)
+    if not pair.ok:
         return None
 
-    # Convert to RGB (GIFs use RGB)
-    img1_rgb = cv2.cvtColor(img1, cv2.COLOR_BGR2RGB)
-    img2_rgb = cv2.cvtColor(img2, cv2.COLOR_BGR2RGB)
-
-    # Create a smaller version for the GIF (50% of original size)
-    height, width = img1_rgb.shape[:2]
-    new_width = int(width * 0.5)
-    new_height = int(height * 0.5)
-    img1_small = cv2.resize(img1_rgb, (new_width, new_height))
-    img2_small = cv2.resize(img2_rgb, (new_width, new_height))
-
-    # Create the animation
-    imageio.mimsave(gif_output_path, [img1_small, img2_small], duration=duration, loop=0)
-
+    # Half-size frames (sharing one palette in a GIF)
+    encode_animation([pair.img1, pair.img2], gif_output_path, encoding, duration)
+    record_written('gif', gif_output_path)
     return gif_output_path
 # Example usage:
 # compare_results = compare_images("image1.jpg", "image2.jpg", "output1.jpg", "output2.jpg")
@@ -0,0 +1,346 @@
+# instrumentation.py - Stage timers, memory samples and the /metrics endpoint
+#
+# Every expensive step of the pipeline (decode, registration, Delta-E with its
+# Lab conversion, the overlay kernels, metrics, regions, writes, GIF encoding,
+# and the upload and database commit of /compare) runs inside stage(name),
+# which times it and samples the resident set size when it ends; loops over
+# bands sum their time and report it once through record_stage. The
+# observations go into a small in-process registry that /metrics renders in
+# the Prometheus text format, together with request latency, input
+# megapixels, bytes written and the job queue depth.
+#
+# Comparison jobs run in worker processes, whose registry nobody scrapes. A job
+# therefore runs inside traced(): its observations are collected in a Trace,
+# returned with the job result and replayed into the web process's registry
+# by observe_trace. With PROFILE_SLOW_SECONDS set, requests and jobs also run
+# under cProfile, and the ones slower than that are dumped to PROFILE_DIR for
+# snakeviz or pstats.
+import bisect
+import contextlib
+import contextvars
+import cProfile
+import datetime
+import functools
+import os
+import re
+import threading
+import time
+from flask import g, request
+
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+MEGAPIXEL_BUCKETS = (0.25, 0.5, 1.0, 2.0, 5.0, 12.0, 24.0, 50.0, 100.0, 250.0)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """Base of the registry's metric types: one value (or histogram) per label combination."""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}']
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_max(self, value, **labels):
+        """Keeps the largest value ever set for labels."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = max(value, self._values.get(key, value))
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=STAGE_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket plus +Inf, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def _render_value(self, key, counts):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, key, [('le', _format_value(float(bound)))])
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f'{self.name}_sum{labels} {_format_value(counts[-1])}')
+        lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+STAGE_SECONDS = Histogram('imgcmp_stage_seconds', 'Wall time of one pipeline stage.', ['stage'])
+STAGE_RSS = Gauge('imgcmp_stage_max_rss_bytes', 'Largest resident set size seen at the end of a stage.', ['stage'])
+REQUEST_SECONDS = Histogram('imgcmp_request_seconds', 'Latency of HTTP requests by endpoint.',
+                            ['endpoint', 'method'], REQUEST_BUCKETS)
+INPUT_MEGAPIXELS = Histogram('imgcmp_input_megapixels', 'Size of each compared input image.',
+                             buckets=MEGAPIXEL_BUCKETS)
+BYTES_WRITTEN = Counter('imgcmp_bytes_written_total', 'Bytes of images written, by kind of output.', ['kind'])
+PROFILES = Counter('imgcmp_slow_profiles_total', 'cProfile dumps of slow requests written by this process.',
+                   ['source'])
+PEAK_RSS = Gauge('imgcmp_process_peak_rss_bytes', 'Peak resident set size of the web process.')
+JOBS = Gauge('imgcmp_jobs', 'Comparison jobs by status (pending is the queue depth).', ['status'])
+
+METRICS = (STAGE_SECONDS, STAGE_RSS, REQUEST_SECONDS, INPUT_MEGAPIXELS, BYTES_WRITTEN, PROFILES, PEAK_RSS, JOBS)
+
+def _read_status(field):
+    """Returns a VmRSS/VmHWM-style field of /proc/self/status in bytes, or None where there is no procfs."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def current_rss():
+    return _read_status('VmRSS')
+
+def peak_rss():
+    return _read_status('VmHWM')
+
+class Trace:
+    """The observations of one job, collected where they happen and replayed elsewhere."""
+
+    def __init__(self):
+        self.stages = []  # [stage, seconds, rss]
+        self.bytes_written = {}
+        self.megapixels = []
+        self._lock = threading.Lock()
+
+    def as_dict(self):
+        with self._lock:
+            return {'stages': list(self.stages), 'bytes_written': dict(self.bytes_written),
+                    'megapixels': list(self.megapixels), 'peak_rss': peak_rss()}
+
+_trace = contextvars.ContextVar('instrumentation_trace', default=None)
+
+@contextlib.contextmanager
+def traced():
+    """Collects the observations made inside the block in a Trace instead of the registry."""
+    trace = Trace()
+    token = _trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _trace.reset(token)
+
+def observe_trace(data):
+    """Replays a Trace.as_dict() from a worker process into this process's registry."""
+    if not data:
+        return
+    for name, seconds, rss in data.get('stages', []):
+        STAGE_SECONDS.observe(seconds, stage=name)
+        if rss is not None:
+            STAGE_RSS.set_max(rss, stage=name)
+    for kind, size in data.get('bytes_written', {}).items():
+        BYTES_WRITTEN.inc(size, kind=kind)
+    for megapixels in data.get('megapixels', []):
+        INPUT_MEGAPIXELS.observe(megapixels)
+
+def record_stage(name, seconds):
+    """Records one run of stage name that took seconds (e.g. summed over the bands of a loop) and samples the RSS."""
+    rss = current_rss()
+    trace = _trace.get()
+    if trace is not None:
+        with trace._lock:
+            trace.stages.append([name, seconds, rss])
+    else:
+        STAGE_SECONDS.observe(seconds, stage=name)
+        if rss is not None:
+            STAGE_RSS.set_max(rss, stage=name)
+
+@contextlib.contextmanager
+def stage(name):
+    """Times the block as one run of stage name and samples the RSS when it ends."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+def timed(name):
+    """Decorator form of stage."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def record_written(kind, *paths):
+    """Counts the size of files just written as output of kind."""
+    size = sum(os.path.getsize(path) for path in paths
+               if isinstance(path, (str, os.PathLike)) and os.path.exists(path))
+    trace = _trace.get()
+    if trace is not None:
+        with trace._lock:
+            trace.bytes_written[kind] = trace.bytes_written.get(kind, 0) + size
+    else:
+        BYTES_WRITTEN.inc(size, kind=kind)
+
+def record_input(width, height):
+    """Counts one input image of width x height pixels."""
+    megapixels = width * height / 1e6
+    trace = _trace.get()
+    if trace is not None:
+        with trace._lock:
+            trace.megapixels.append(megapixels)
+    else:
+        INPUT_MEGAPIXELS.observe(megapixels)
+
+def submit(executor, fn, *args, **kwargs):
+    """executor.submit that runs fn in the caller's context, so its stages land in the caller's trace."""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+@contextlib.contextmanager
+def profiled(directory, name, min_seconds):
+    """
+    Runs the block under cProfile and dumps the stats when it took at least min_seconds.
+
+    Does nothing when directory or min_seconds is None, or when another
+    profiler is already active in this thread.
+    """
+    if not directory or min_seconds is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        seconds = time.perf_counter() - start
+        if seconds >= min_seconds:
+            os.makedirs(directory, exist_ok=True)
+            stamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+            safe = re.sub(r'[^A-Za-z0-9_.-]+', '_', name)
+            profiler.dump_stats(os.path.join(directory, f"{stamp}_{safe}_{int(seconds * 1000)}ms.prof"))
+            PROFILES.inc(source=safe.split('_')[0])
+
+class Instrumentation:
+    """
+    Times every request and renders the registry for /metrics.
+
+    Request latency is recorded per endpoint. The job queue depth is read from
+    the job table when /metrics is scraped, so it is right across processes.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.db = None
+        self.job_model = None
+
+    def init_app(self, app, db, job_model):
+        app.config.setdefault('METRICS_TOKEN', None)
+        app.config.setdefault('PROFILE_SLOW_SECONDS', None)
+        app.config.setdefault('PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+        self.app = app
+        self.db = db
+        self.job_model = job_model
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+        app.extensions['instrumentation'] = self
+
+    def _before_request(self):
+        g.instrumentation_start = time.perf_counter()
+        directory, min_seconds = self.app.config.get('PROFILE_DIR'), self.app.config.get('PROFILE_SLOW_SECONDS')
+        if min_seconds is not None:
+            g.instrumentation_profile = profiled(directory, f"request_{request.endpoint}", min_seconds)
+            g.instrumentation_profile.__enter__()
+
+    def _teardown_request(self, exc):
+        profile = g.pop('instrumentation_profile', None)
+        if profile is not None:
+            profile.__exit__(None, None, None)
+        start = g.pop('instrumentation_start', None)
+        if start is not None:
+            REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=request.endpoint or 'unknown',
+                                    method=request.method)
+
+    def authorized(self):
+        """True when the request may read /metrics (always, unless METRICS_TOKEN is set)."""
+        token = self.app.config['METRICS_TOKEN']
+        return not token or request.headers.get('Authorization') == f'Bearer {token}'
+
+    def render(self):
+        """Returns the registry in the Prometheus text exposition format."""
+        Job = self.job_model
+        JOBS.clear()
+        for status, count in self.db.session.query(Job.status, self.db.func.count(Job.id)).group_by(Job.status):
+            JOBS.set(count, status=status)
+        rss = peak_rss()
+        if rss is not None:
+            PEAK_RSS.set(rss)
+        lines = []
+        for metric in METRICS:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+instrumentation = Instrumentation()
@@ -0,0 +1,447 @@
+# jobs.py - Background processing of comparison jobs
+#
+# /compare only stores the uploads and queues a ComparisonJob row. A JobRunner
+# owned by the web process claims pending rows from the database and hands the
+# OpenCV work to a local process pool, so request threads never block on image
+# processing. SQLite and the local filesystem are the only moving parts: the
+# job table is the queue, and claiming a row is an atomic UPDATE, so several
+# web processes can share one database without a broker.
+import atexit
+import datetime
+import filecmp
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from derivatives import make_comparison_derivatives
+from encoding import ENCODING_CONFIG, OUTPUT_FORMATS, artifact_encoding, encoding_options
+from image_compare import compare_images, create_gif_from_images, get_render_executor, load_pair, read_image_size
+from instrumentation import observe_trace, profiled, record_input, traced
+from metrics import apply_metrics, identical_metrics, is_within_tolerance, measure_pair
+from regions import find_regions
+from sequences import apply_candidates, compare_set, first_frame, is_multi_frame
+from sharding import shard_directory
+from tiled_compare import compare_images_tiled
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+logger = logging.getLogger(__name__)
+
+# Rendering parameters used outside the app (see comparison_options)
+DEFAULT_OPTIONS = {
+    'mode': 'both',
+    'alpha': 0.7,
+    'delta_e_method': 'cie76',
+    'threshold': 50,
+    'gif_duration': 1000.0,
+    'max_dim': 3000,
+    'tolerance_delta_e': 2.3,
+    'tolerance_changed_ratio': 0.0,
+    'registration': None,
+}
+
+def comparison_options(config, overrides=None):
+    """
+    Returns every configured parameter that changes the rendered output.
+
+    Args:
+        config: The app config
+        overrides: Optional encoding options chosen for one comparison (see
+            encoding.parse_encoding), applied over the configured ones
+    """
+    options = {
+        'mode': config['COMPARE_MODE'],
+        'alpha': config['COMPARE_ALPHA'],
+        'delta_e_method': config['DELTA_E_METHOD'],
+        'threshold': config['DIFF_THRESHOLD'],
+        'gif_duration': config['GIF_DURATION'],
+        'max_dim': config['MAX_IMAGE_DIM'],
+        'tolerance_delta_e': config['TOLERANCE_MAX_DELTA_E'],
+        'tolerance_changed_ratio': config['TOLERANCE_CHANGED_RATIO'],
+    }
+    # Only present when enabled, so cache keys of unregistered comparisons stay the same
+    if config.get('REGISTRATION'):
+        options['registration'] = config['REGISTRATION']
+    # Likewise, output formats and presets only appear when they differ from the defaults
+    encoding = {key: config.get(name) for key, name in ENCODING_CONFIG.items()}
+    encoding.update(overrides or {})
+    options.update(encoding_options(encoding))
+    return options
+
+def overlay_encoding(options, image_path1):
+    """Returns the encoding of the overlays of a pair (see encoding.artifact_encoding)."""
+    size = read_image_size(image_path1)
+    max_dim = (options or {}).get('max_dim', 3000)
+    longest_side = size and (max(size) if max_dim is None else min(max(size), max_dim))
+    return artifact_encoding(options, 'overlay', longest_side)
+
+def use_tiled_engine(image_path1, image_path2, max_dim, tiled_min_pixels):
+    """True when a pair is compared at native size and is large enough for the tiled engine."""
+    if max_dim is not None or not tiled_min_pixels:
+        return False
+    size1, size2 = read_image_size(image_path1), read_image_size(image_path2)
+    return size1 is not None and size1 == size2 and size1[0] * size1[1] >= tiled_min_pixels
+
+def run_comparison(image_path1, image_path2, output_folder, uid, options=None, render_workers=0,
+                   tiled_min_pixels=None, render=True, derivatives=False, profile=None, candidates=None):
+    """
+    Measures one comparison and renders its artifacts. Runs inside a worker process.
+
+    The metrics come first (see metrics.measure_pair); a pair within tolerance
+    is not rendered at all. Tiled pairs are measured on the reduced preview
+    decode and are never registered (see registration.py).
+
+    With more candidates than image_path2, or multi-frame inputs, every frame
+    of every candidate is measured against the baseline (see
+    sequences.compare_set) and the metrics are the worst of them all. The
+    artifacts and regions still show the first frames of image_path1 and
+    image_path2, rendered whenever the set is out of tolerance.
+
+    Args:
+        image_path1: Path to the first uploaded image (the baseline)
+        image_path2: Path to the second uploaded image (the first candidate)
+        output_folder: Folder where the overlays and GIF are written
+        uid: Unique prefix for the output file names
+        options: Rendering parameters (see comparison_options)
+        render_workers: Threads used to run the renderers in parallel (0 runs them in sequence)
+        tiled_min_pixels: Pairs of at least this many pixels compared at native size
+            (max_dim None) go through the memory-bounded tiled engine
+        render: False only measures the pair and leaves the artifacts to
+            artifacts.ArtifactStore, which renders them when first viewed
+        derivatives: Also write thumbnails and previews of the inputs and
+            overlays (see derivatives.make_derivatives)
+        profile: Optional (directory, min_seconds): the job runs under
+            cProfile and is dumped to directory when it takes at least
+            min_seconds (see instrumentation.profiled)
+        candidates: Optional paths of further candidates
+
+    Returns:
+        The result dict of compare_images, including the 'gif' entry, plus
+        'metrics' and 'regions' (see regions.find_regions). Pairs within
+        tolerance only have 'metrics', and every other pair has only
+        'metrics' and 'regions' when render is False. With derivatives,
+        'derivatives' maps each image kind to the sizes of its derivatives.
+        'trace' always holds the stage timings, input sizes and bytes written
+        (see instrumentation.observe_trace). Sets and multi-frame pairs also
+        have 'candidates', the results of each candidate. Registered pairs
+        have 'registration', the estimated transform (see
+        registration.transform_record).
+    """
+    directory, min_seconds = profile or (None, None)
+    sources = [image_path2, *(candidates or ())]
+    with traced() as trace, profiled(directory, f"job_{uid}", min_seconds):
+        for path in [image_path1, *sources]:
+            size = read_image_size(path)
+            if size:
+                record_input(*size)
+        sequence = None
+        if len(sources) > 1 or is_multi_frame(image_path1) or is_multi_frame(image_path2):
+            options = dict(options or {})
+            sequence = compare_set(image_path1, sources, options.get('delta_e_method', 'cie76'),
+                                   options.get('threshold', 50), options.get('max_dim', 3000),
+                                   options.get('tolerance_delta_e'), options.get('tolerance_changed_ratio'),
+                                   workers=render_workers)
+            if sequence['metrics']['within_tolerance'] is False:
+                # The first frames of the first candidate may match while later ones do not
+                options.update(tolerance_delta_e=None, tolerance_changed_ratio=None)
+        results = _compare_with_derivatives(first_frame(image_path1), first_frame(image_path2), output_folder, uid,
+                                            options, render_workers, tiled_min_pixels, render, derivatives)
+        if sequence is not None:
+            results['metrics'] = sequence['metrics']
+            results['candidates'] = sequence['candidates']
+    results['trace'] = trace.as_dict()
+    return results
+
+def _compare_with_derivatives(image_path1, image_path2, output_folder, uid, options, render_workers,
+                              tiled_min_pixels, render, derivatives):
+    results, pair = _measure_and_render(image_path1, image_path2, output_folder, uid, options, render_workers,
+                                        tiled_min_pixels, render)
+    if pair is not None and pair.registration is not None:
+        results['registration'] = pair.registration
+    if derivatives:
+        paths = {'image1': image_path1, 'image2': image_path2}
+        paths.update((kind, results.get(kind)) for kind in ('color1', 'color2', 'gray1', 'gray2'))
+        images = {}
+        if pair is not None:
+            # The second image was resized to the first one's size (and maybe warped onto it),
+            # so it is only reused when that was a no-op
+            images['image1'] = pair.img1
+            if pair.transform is None and read_image_size(image_path1) == read_image_size(image_path2):
+                images['image2'] = pair.img2
+        results['derivatives'] = make_comparison_derivatives(paths, images)
+    return results
+
+def _measure_and_render(image_path1, image_path2, output_folder, uid, options, render_workers, tiled_min_pixels,
+                        render):
+    """Does the work of run_comparison; returns its results and the decoded pair (None if nothing was decoded)."""
+    options = dict(options or {})
+    encodings = overlay_encoding(options, image_path1), artifact_encoding(options, 'animation')
+    for key in ENCODING_CONFIG:
+        options.pop(key, None)
+    max_dim = options.pop('max_dim', 3000)
+    registration = options.pop('registration', None)
+    tolerance = {
+        'max_delta_e': options.pop('tolerance_delta_e', None),
+        'max_changed_ratio': options.pop('tolerance_changed_ratio', None),
+    }
+    measure = {
+        'delta_e_method': options.get('delta_e_method', 'cie76'),
+        'threshold': options.get('threshold', 50),
+    }
+    overlay_ext, animation_ext = (OUTPUT_FORMATS[encoding['format']]['ext'] for encoding in encodings)
+    out1 = os.path.join(output_folder, f"{uid}_out1{overlay_ext}")
+    out2 = os.path.join(output_folder, f"{uid}_out2{overlay_ext}")
+    gif_path = os.path.join(output_folder, f"{uid}_output{animation_ext}")
+
+    # Byte-identical inputs are settled without decoding anything
+    if filecmp.cmp(image_path1, image_path2, shallow=False):
+        metrics = identical_metrics(is_within_tolerance(identical_metrics(), **tolerance))
+        if metrics['within_tolerance']:
+            return {'metrics': metrics}, None
+
+    if use_tiled_engine(image_path1, image_path2, max_dim, tiled_min_pixels):
+        # The GIF and the metrics only need a reduced decode
+        preview = load_pair(image_path1, image_path2, 3000)
+        if not preview.ok:
+            raise ValueError('One of the uploaded files could not be read as an image')
+        metrics = measure_pair(preview, **measure, **tolerance)
+        metrics['scale'] *= preview.img1.shape[1] / read_image_size(image_path1)[0]
+        regions = find_regions(preview.img1, preview.img2, **measure)
+        if not render:
+            return {'metrics': metrics, 'regions': regions}, preview
+        gif_duration = options.pop('gif_duration', 1000.0)
+        results = compare_images_tiled(image_path1, image_path2, out1, out2, workdir=output_folder,
+                                       overlay_encoding=encodings[0], **options)
+        create_gif_from_images(image_path1, image_path2, gif_path, gif_duration, pair=preview, encoding=encodings[1])
+        results["gif"] = gif_path
+        results["metrics"] = metrics
+        results["regions"] = regions
+        return results, preview
+
+    pair = load_pair(image_path1, image_path2, max_dim, registration)
+    if not pair.ok:
+        raise ValueError('One of the uploaded files could not be read as an image')
+
+    metrics = measure_pair(pair, **measure, **tolerance)
+    if metrics['within_tolerance']:
+        return {'metrics': metrics}, pair
+    regions = find_regions(pair.img1, pair.img2, **measure)
+    if not render:
+        return {'metrics': metrics, 'regions': regions}, pair
+
+    executor = get_render_executor(render_workers) if render_workers else None
+
+    results = compare_images(image_path1, image_path2, out1, out2, pair=pair, gif_output_path=gif_path,
+                             executor=executor, overlay_encoding=encodings[0], animation_encoding=encodings[1],
+                             **options)
+    results["metrics"] = metrics
+    results["regions"] = regions
+    return results, pair
+
+def extra_candidates(comparison):
+    """Returns the paths of the candidates of comparison after the first one (image2_path)."""
+    return [row.path for row in comparison.inputs if row.position > 1]
+
+class JobRunner:
+    """
+    Drains the ComparisonJob table into a process pool.
+
+    The runner starts lazily the first time it is woken up, so importing the
+    app (or forking worker processes) never spawns a pool by accident.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.db = None
+        self.job_model = None
+        self.comparison_model = None
+        self._executor = None
+        self._thread = None
+        self._slots = None
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._completion_hooks = []
+
+    def init_app(self, app, db, job_model, comparison_model):
+        app.config.setdefault('COMPARISON_WORKERS', os.cpu_count() or 1)
+        app.config.setdefault('COMPARISON_JOBS_SYNC', False)
+        app.config.setdefault('RENDER_WORKERS', 0)
+        app.config.setdefault('COMPARE_MODE', 'both')
+        app.config.setdefault('COMPARE_ALPHA', 0.7)
+        app.config.setdefault('DELTA_E_METHOD', 'cie76')
+        app.config.setdefault('DIFF_THRESHOLD', 50)
+        app.config.setdefault('GIF_DURATION', 1000.0)
+        app.config.setdefault('MAX_IMAGE_DIM', 3000)
+        app.config.setdefault('TILED_COMPARE_MIN_PIXELS', 50 * 10 ** 6)
+        app.config.setdefault('TOLERANCE_MAX_DELTA_E', 2.3)
+        app.config.setdefault('TOLERANCE_CHANGED_RATIO', 0.0)
+        app.config.setdefault('REGISTRATION', None)
+        for name in ENCODING_CONFIG.values():
+            app.config.setdefault(name, None)
+        app.config.setdefault('RENDER_ARTIFACTS_EAGERLY', False)
+        app.config.setdefault('JOB_POLL_INTERVAL', 2.0)
+        app.config.setdefault('JOB_STALE_SECONDS', 3600)
+        self.app = app
+        self.db = db
+        self.job_model = job_model
+        self.comparison_model = comparison_model
+        app.extensions['job_runner'] = self
+
+    @property
+    def profile(self):
+        """(directory, min_seconds) for profiling slow jobs in the pool (see instrumentation.profiled)."""
+        return self.app.config.get('PROFILE_DIR'), self.app.config.get('PROFILE_SLOW_SECONDS')
+
+    def enqueue(self, comparison, uid):
+        """Adds a pending job for comparison to the current session."""
+        job = self.job_model(comparison=comparison, uid=uid, status=PENDING)
+        self.db.session.add(job)
+        return job
+
+    def on_complete(self, hook):
+        """Registers hook(comparison), called before a successful job is committed."""
+        self._completion_hooks.append(hook)
+        return hook
+
+    def wake(self):
+        """Tells the dispatcher that new jobs are waiting, starting it if needed."""
+        if self.app.config['COMPARISON_JOBS_SYNC']:
+            self._run_pending_inline()
+            return
+        self._ensure_started()
+        self._wakeup.set()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            workers = max(1, int(self.app.config['COMPARISON_WORKERS']))
+            self._executor = ProcessPoolExecutor(max_workers=workers)
+            self._slots = threading.Semaphore(workers)
+            self._thread = threading.Thread(target=self._dispatch_loop, name='comparison-jobs', daemon=True)
+            self._thread.start()
+            atexit.register(self._executor.shutdown, wait=False, cancel_futures=True)
+
+    def _dispatch_loop(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    self._requeue_stale()
+                    while self._slots.acquire(blocking=False):
+                        job = self._claim_next()
+                        if job is None:
+                            self._slots.release()
+                            break
+                        self._submit(job)
+            except Exception:
+                logger.exception('Comparison job dispatcher failed')
+            self._wakeup.wait(self.app.config['JOB_POLL_INTERVAL'])
+            self._wakeup.clear()
+
+    def _claim_next(self):
+        """Atomically moves the oldest pending job to running and returns it."""
+        Job = self.job_model
+        while True:
+            job = Job.query.filter_by(status=PENDING).order_by(Job.id).first()
+            if job is None:
+                return None
+            claimed = Job.query.filter_by(id=job.id, status=PENDING).update(
+                {'status': RUNNING, 'started_at': datetime.datetime.utcnow()},
+                synchronize_session=False
+            )
+            self.db.session.commit()
+            if claimed:
+                self.db.session.refresh(job)
+                return job
+
+    def _submit(self, job):
+        comparison = job.comparison
+        output_folder = shard_directory(self.app.config['OUTPUT_FOLDER'], job.uid)
+        args = (comparison.image1_path, comparison.image2_path, output_folder, job.uid,
+                comparison_options(self.app.config, comparison.output_encoding), self.app.config['RENDER_WORKERS'],
+                self.app.config['TILED_COMPARE_MIN_PIXELS'], self.app.config['RENDER_ARTIFACTS_EAGERLY'], True,
+                self.profile, extra_candidates(comparison))
+        try:
+            future = self._executor.submit(run_comparison, *args)
+        except Exception as exc:
+            self._slots.release()
+            self._finish(job.id, error=exc)
+            return
+        job_id = job.id
+
+        def on_done(fut):
+            self._slots.release()
+            try:
+                self._finish(job_id, results=fut.result())
+            except Exception as exc:
+                self._finish(job_id, error=exc)
+            self._wakeup.set()
+
+        future.add_done_callback(on_done)
+
+    def _finish(self, job_id, results=None, error=None):
+        with self.app.app_context():
+            job = self.db.session.get(self.job_model, job_id)
+            if job is None:
+                return
+            job.finished_at = datetime.datetime.utcnow()
+            if error is not None:
+                logger.warning('Comparison job %s failed: %s', job_id, error)
+                job.status = FAILED
+                job.error = str(error)
+            else:
+                observe_trace(results.pop('trace', None))
+                comparison = job.comparison
+                comparison.gif_path = results.get('gif')
+                comparison.color_diff1_path = results.get('color1')
+                comparison.color_diff2_path = results.get('color2')
+                comparison.gray_diff1_path = results.get('gray1')
+                comparison.gray_diff2_path = results.get('gray2')
+                comparison.derivatives = results.get('derivatives')
+                comparison.regions = results.get('regions')
+                comparison.registration = results.get('registration')
+                apply_metrics(comparison, results.get('metrics', {}))
+                # A plain pair's only candidate has the pair's own results
+                apply_candidates(comparison.inputs, results.get('candidates') or [
+                    dict(results.get('metrics', {}), frames_compared=1, worst_frame=0)])
+                for hook in self._completion_hooks:
+                    hook(comparison)
+                job.status = DONE
+                job.error = None
+            self.db.session.commit()
+
+    def _requeue_stale(self):
+        """Returns jobs whose worker vanished (crash, restart) to the queue."""
+        Job = self.job_model
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.app.config['JOB_STALE_SECONDS'])
+        stale = Job.query.filter(Job.status == RUNNING, Job.started_at < cutoff).update(
+            {'status': PENDING, 'started_at': None}, synchronize_session=False
+        )
+        if stale:
+            logger.warning('Requeued %d stale comparison jobs', stale)
+        self.db.session.commit()
+
+    def _run_pending_inline(self):
+        """Processes pending jobs in the calling thread (COMPARISON_JOBS_SYNC)."""
+        while True:
+            job = self._claim_next()
+            if job is None:
+                return
+            comparison = job.comparison
+            try:
+                results = run_comparison(comparison.image1_path, comparison.image2_path,
+                                         shard_directory(self.app.config['OUTPUT_FOLDER'], job.uid), job.uid,
+                                         comparison_options(self.app.config, comparison.output_encoding),
+                                         self.app.config['RENDER_WORKERS'],
+                                         self.app.config['TILED_COMPARE_MIN_PIXELS'],
+                                         self.app.config['RENDER_ARTIFACTS_EAGERLY'], derivatives=True,
+                                         profile=self.profile, candidates=extra_candidates(comparison))
+            except Exception as exc:
+                self._finish(job.id, error=exc)
+            else:
+                self._finish(job.id, results=results)
+
+job_runner = JobRunner()
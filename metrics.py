@@ -0,0 +1,164 @@
+# metrics.py - Numeric difference metrics for an image pair
+#
+# The metrics run before anything is rendered so that pairs without a visible
+# difference can skip the overlays and the GIF. They are computed on a
+# downsampled pyramid level first. Downsampling averages color differences
+# away rather than creating them, so a coarse max Delta-E that is already over
+# the tolerance settles the verdict, and the full resolution is only measured
+# when the pair may be within tolerance. The changed-pixel ratio has no such
+# bound (averaging can push a sparse pattern over the threshold everywhere),
+# so it is always counted at full resolution.
+import math
+import cv2
+import numpy as np
+from delta_e import delta_e_map
+from image_compare import BAND_ROWS
+from instrumentation import timed
+
+# Longest side of the coarse pyramid level
+COARSE_DIM = 512
+
+# SSIM constants (Wang et al. 2004) for 8-bit images
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+SSIM_SIGMA = 1.5
+SSIM_HALO = 5  # rows of context the 11x11 Gaussian window needs around a band
+
+# Comparison column for every metric
+METRIC_COLUMNS = {
+    'max_delta_e': 'max_delta_e',
+    'mean_delta_e': 'mean_delta_e',
+    'changed_ratio': 'changed_ratio',
+    'ssim': 'ssim',
+    'psnr': 'psnr',
+    'scale': 'metrics_scale',
+    'within_tolerance': 'within_tolerance',
+}
+
+def identical_metrics(within_tolerance=True):
+    """Metrics of two identical images (PSNR is None, i.e. infinite)."""
+    return {'max_delta_e': 0.0, 'mean_delta_e': 0.0, 'changed_ratio': 0.0, 'ssim': 1.0, 'psnr': None,
+            'scale': 1.0, 'within_tolerance': within_tolerance}
+
+def changed_ratio(img1, img2, threshold=50):
+    """Fraction of pixels whose grayscale difference is above threshold, as in the grayscale overlay."""
+    changed = 0
+    for top in range(0, img1.shape[0], BAND_ROWS):
+        rows = slice(top, top + BAND_ROWS)
+        gray_diff = cv2.cvtColor(cv2.absdiff(img1[rows], img2[rows]), cv2.COLOR_BGR2GRAY)
+        changed += cv2.countNonZero(cv2.threshold(gray_diff, threshold, 255, cv2.THRESH_BINARY)[1])
+    return changed / (img1.shape[0] * img1.shape[1])
+
+def psnr(img1, img2):
+    """Peak signal-to-noise ratio in dB, or None for identical images."""
+    mse = cv2.norm(img1, img2, cv2.NORM_L2SQR) / img1.size
+    return 10 * math.log10(255.0 ** 2 / mse) if mse else None
+
+def ssim(gray1, gray2, band_rows=BAND_ROWS):
+    """
+    Mean structural similarity of two grayscale images.
+
+    Computed in bands with a few rows of context on each side, so the float
+    temporaries stay band-sized and the result equals the full-frame SSIM.
+    """
+    def blur(a):
+        return cv2.GaussianBlur(a, (11, 11), SSIM_SIGMA)
+
+    height = gray1.shape[0]
+    total = 0.0
+    for top in range(0, height, band_rows):
+        bottom = min(top + band_rows, height)
+        lo, hi = max(top - SSIM_HALO, 0), min(bottom + SSIM_HALO, height)
+        x = gray1[lo:hi].astype(np.float32)
+        y = gray2[lo:hi].astype(np.float32)
+        mu_x, mu_y = blur(x), blur(y)
+        mu_xx, mu_yy, mu_xy = mu_x * mu_x, mu_y * mu_y, mu_x * mu_y
+        sigma_xx = blur(x * x) - mu_xx
+        sigma_yy = blur(y * y) - mu_yy
+        sigma_xy = blur(x * y) - mu_xy
+        ssim_map = ((2 * mu_xy + SSIM_C1) * (2 * sigma_xy + SSIM_C2)
+                    / ((mu_xx + mu_yy + SSIM_C1) * (sigma_xx + sigma_yy + SSIM_C2)))
+        total += float(ssim_map[top - lo:bottom - lo].sum(dtype=np.float64))
+    return total / (height * gray1.shape[1])
+
+def image_metrics(img1, img2, delta_e_method="cie76", threshold=50, delta_e=None):
+    """
+    Computes every metric of two BGR images of the same size.
+
+    Args:
+        img1: First uint8 BGR image
+        img2: Second uint8 BGR image
+        delta_e_method: 'cie76' or 'ciede2000'
+        threshold: Grayscale difference that counts as a changed pixel
+        delta_e: Optional precomputed Delta-E map of the images
+    """
+    if delta_e is None:
+        delta_e = delta_e_map(img1, img2, delta_e_method)
+    _, max_delta_e, _, _ = cv2.minMaxLoc(delta_e)
+    return {
+        'max_delta_e': float(max_delta_e),
+        'mean_delta_e': float(cv2.mean(delta_e)[0]),
+        'changed_ratio': changed_ratio(img1, img2, threshold),
+        'ssim': ssim(cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY), cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)),
+        'psnr': psnr(img1, img2),
+    }
+
+def is_within_tolerance(metrics, max_delta_e=None, max_changed_ratio=None):
+    """True if the metrics are within both tolerances, None when no tolerance is set."""
+    if max_delta_e is None and max_changed_ratio is None:
+        return None
+    return ((max_delta_e is None or metrics['max_delta_e'] <= max_delta_e)
+            and (max_changed_ratio is None or metrics['changed_ratio'] <= max_changed_ratio))
+
+@timed('metrics')
+def measure_pair(pair, delta_e_method="cie76", threshold=50, max_delta_e=None, max_changed_ratio=None,
+                 coarse_dim=COARSE_DIM):
+    """
+    Measures a LoadedPair, coarse level first.
+
+    Pixel-identical pairs return immediately. Otherwise, with a Delta-E
+    tolerance, the metrics are computed on the first pyramid level no larger
+    than coarse_dim; if its max Delta-E is already over the tolerance its
+    metrics are returned (with scale < 1, and changed_ratio counted at full
+    resolution), else the pair is measured again at full working resolution,
+    reusing the pair's cached Delta-E map.
+
+    Args:
+        pair: LoadedPair of the two images
+        delta_e_method: 'cie76' or 'ciede2000'
+        threshold: Grayscale difference that counts as a changed pixel
+        max_delta_e: Largest max Delta-E that is within tolerance (None: no limit)
+        max_changed_ratio: Largest changed-pixel fraction that is within tolerance (None: no limit)
+        coarse_dim: Longest side of the coarse level
+
+    Returns:
+        dict with max_delta_e, mean_delta_e, changed_ratio, ssim, psnr, scale
+        (of the level the Delta-E, SSIM and PSNR were measured at, relative
+        to the working resolution) and within_tolerance (None when no
+        tolerance is set).
+    """
+    img1, img2 = pair.img1, pair.img2
+    if cv2.norm(img1, img2, cv2.NORM_INF) == 0:
+        return identical_metrics(is_within_tolerance(identical_metrics(), max_delta_e, max_changed_ratio))
+
+    coarse1, coarse2, scale = img1, img2, 1.0
+    while max(coarse1.shape[:2]) > coarse_dim:
+        coarse1, coarse2, scale = cv2.pyrDown(coarse1), cv2.pyrDown(coarse2), scale / 2
+
+    if scale < 1 and max_delta_e is not None:
+        metrics = image_metrics(coarse1, coarse2, delta_e_method, threshold)
+        if metrics['max_delta_e'] > max_delta_e:
+            metrics['changed_ratio'] = changed_ratio(img1, img2, threshold)
+            metrics['scale'] = scale
+            metrics['within_tolerance'] = False
+            return metrics
+
+    metrics = image_metrics(img1, img2, delta_e_method, threshold, delta_e=pair.delta_e(delta_e_method))
+    metrics['scale'] = 1.0
+    metrics['within_tolerance'] = is_within_tolerance(metrics, max_delta_e, max_changed_ratio)
+    return metrics
+
+def apply_metrics(comparison, metrics):
+    """Copies a metrics dict onto the metric columns of a Comparison."""
+    for key, column in METRIC_COLUMNS.items():
+        setattr(comparison, column, metrics.get(key))
@@ -0,0 +1,77 @@
+# migrations.py - In-place schema upgrades for existing databases
+#
+# db.create_all() only creates missing tables. When a model gains a column or
+# an index, upgrade_schema adds it to databases created by older versions of
+# the app, so deployments keep working without a separate migration tool.
+import logging
+import uuid
+from sqlalchemy import exists, inspect, insert, literal, select, update
+
+logger = logging.getLogger(__name__)
+
+def add_missing_columns(db):
+    """Adds columns that exist on the models but not yet in the database."""
+    engine = db.engine
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}')
+                logger.info('Added column %s.%s', table.name, column.name)
+
+def add_missing_indexes(db):
+    """Creates indexes declared on the models that the database does not have yet."""
+    engine = db.engine
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+def backfill_comparison_inputs(db, comparison_model, input_model, metric_columns):
+    """
+    Adds the input rows of comparisons from before ComparisonInput existed.
+
+    Their first image becomes the baseline (position 0) and their second
+    image the only candidate (position 1), carrying the comparison's metrics.
+    """
+    comparisons, inputs = comparison_model.__table__, input_model.__table__
+    fields = ('path', 'sha256', 'format', 'width', 'height')
+    with db.engine.begin() as conn:
+        for position in (0, 1):
+            source = [comparisons.c[f'image{position + 1}_{field}'] for field in fields]
+            columns = ['comparison_id', 'position', *fields]
+            if position:
+                source += [comparisons.c[column] for column in metric_columns]
+                columns += list(metric_columns)
+            missing = ~exists().where(inputs.c.comparison_id == comparisons.c.id, inputs.c.position == position)
+            query = select(comparisons.c.id, literal(position), *source).where(missing)
+            added = conn.execute(insert(inputs).from_select(columns, query)).rowcount
+            if added:
+                logger.info('Added %d comparison inputs at position %d', added, position)
+
+def backfill_comparison_uids(db, comparison_model, job_model):
+    """
+    Gives comparisons from before Comparison.uid existed the uid of their latest job.
+
+    Comparisons without a job (reused from the result cache) get a new uid.
+    """
+    comparisons, jobs = comparison_model.__table__, job_model.__table__
+    latest = select(jobs.c.uid).where(jobs.c.comparison_id == comparisons.c.id).order_by(
+        jobs.c.id.desc()).limit(1).scalar_subquery()
+    with db.engine.begin() as conn:
+        added = conn.execute(update(comparisons).where(comparisons.c.uid.is_(None)).values(uid=latest)).rowcount
+        for comparison_id in conn.execute(select(comparisons.c.id).where(comparisons.c.uid.is_(None))).scalars():
+            conn.execute(update(comparisons).where(comparisons.c.id == comparison_id).values(uid=uuid.uuid4().hex))
+        if added:
+            logger.info('Added the uid of %d comparisons', added)
+
+def upgrade_schema(db):
+    add_missing_columns(db)
+    add_missing_indexes(db)
@@ -0,0 +1,65 @@
+# pagination.py - Keyset pagination of comparison listings
+#
+# Listings are ordered newest first on (created_at, id). Instead of OFFSET,
+# which makes the database walk every skipped row, a page starts right after
+# the last row of the previous one: the client gets an opaque cursor naming
+# that row, and the next query filters on it, so every page costs the same no
+# matter how deep it is.
+import base64
+import datetime
+
+DEFAULT_PER_PAGE = 50
+MAX_PER_PAGE = 200
+
+def encode_cursor(created_at, row_id):
+    """Returns the opaque cursor of a row."""
+    raw = f"{created_at.isoformat()}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    """
+    Returns the (created_at, id) named by a cursor.
+
+    Raises:
+        ValueError: if the cursor is malformed.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        created_at, row_id = raw.rsplit('|', 1)
+        return datetime.datetime.fromisoformat(created_at), int(row_id)
+    except (UnicodeDecodeError, ValueError, TypeError) as exc:
+        raise ValueError(f"Invalid cursor {cursor!r}") from exc
+
+class Page:
+    """One page of a listing and the cursor of the page after it (None on the last page)."""
+
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    @property
+    def has_more(self):
+        return self.next_cursor is not None
+
+def keyset_page(query, model, cursor=None, per_page=DEFAULT_PER_PAGE):
+    """
+    Returns one page of query, newest first.
+
+    Args:
+        query: Query selecting model rows (filters, joins and loader options applied)
+        model: Mapped class with created_at and id columns
+        cursor: Cursor of the last row of the previous page (None for the first page)
+        per_page: Rows per page, capped at MAX_PER_PAGE
+
+    Raises:
+        ValueError: if the cursor is malformed.
+    """
+    per_page = max(1, min(int(per_page or DEFAULT_PER_PAGE), MAX_PER_PAGE))
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        query = query.filter((model.created_at < created_at)
+                             | ((model.created_at == created_at) & (model.id < row_id)))
+    rows = query.order_by(model.created_at.desc(), model.id.desc()).limit(per_page + 1).all()
+    items = rows[:per_page]
+    next_cursor = encode_cursor(items[-1].created_at, items[-1].id) if len(rows) > per_page else None
+    return Page(items, next_cursor)
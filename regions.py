@@ -0,0 +1,137 @@
+# regions.py - Changed regions of a pair as bounding boxes and zoomed crops
+#
+# The overlays show a change somewhere in the full frame; on a large image a
+# reviewer still has to find it. find_regions starts from the grayscale
+# overlay's threshold mask, removes speckle with a morphological opening,
+# joins blobs closer than MERGE_DISTANCE by dilating before labelling the
+# connected components, and returns the tight bounding box of each region with
+# its changed-pixel area and mean Delta-E. The boxes are stored on the
+# Comparison; render_zoom turns one of them into a small side-by-side crop at
+# full working resolution, which artifacts.ArtifactStore writes on demand.
+import glob
+import os
+import cv2
+import numpy as np
+from delta_e import delta_e_map
+from image_compare import BAND_ROWS
+from instrumentation import timed
+
+OPEN_SIZE = 3  # kernel of the opening that removes isolated changed pixels
+MERGE_DISTANCE = 24  # blobs closer than this many pixels form one region
+MIN_AREA = 16  # regions with fewer changed pixels are dropped
+MAX_REGIONS = 50  # largest regions kept per comparison
+
+ZOOM_PADDING = 24  # context around a box in the zoom image
+ZOOM_MIN_SIDE = 160  # smaller crops are enlarged (nearest neighbour) to this
+ZOOM_MAX_SIDE = 800  # larger crops are reduced to this
+ZOOM_GUTTER = 8  # white pixels between the two crops
+ZOOM_BOX_COLOR = (0, 0, 255)
+
+def change_mask(img1, img2, threshold=50):
+    """Returns the uint8 mask (255 = changed) of the grayscale overlay, computed in bands."""
+    mask = np.empty(img1.shape[:2], np.uint8)
+    for top in range(0, img1.shape[0], BAND_ROWS):
+        rows = slice(top, top + BAND_ROWS)
+        gray_diff = cv2.cvtColor(cv2.absdiff(img1[rows], img2[rows]), cv2.COLOR_BGR2GRAY)
+        cv2.threshold(gray_diff, threshold, 255, cv2.THRESH_BINARY, dst=mask[rows])
+    return mask
+
+@timed('regions')
+def find_regions(img1, img2, threshold=50, delta_e_method='cie76', merge_distance=MERGE_DISTANCE,
+                 min_area=MIN_AREA, max_regions=MAX_REGIONS):
+    """
+    Finds the changed regions of two BGR images of the same size.
+
+    Args:
+        img1: First uint8 BGR image
+        img2: Second uint8 BGR image
+        threshold: Grayscale difference that counts as a changed pixel
+        delta_e_method: 'cie76' or 'ciede2000' for the mean Delta-E of each region
+        merge_distance: Blobs closer than this many pixels are merged
+        min_area: Smallest number of changed pixels a region may have
+        max_regions: Number of regions kept, largest first
+
+    Returns:
+        {'frame': [width, height], 'total': regions found before max_regions
+        was applied, 'boxes': [{'x', 'y', 'width', 'height', 'area',
+        'mean_delta_e'}, ...]}, largest area first, in pixels of img1.
+    """
+    height, width = img1.shape[:2]
+    mask = change_mask(img1, img2, threshold)
+    if OPEN_SIZE > 1:
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, np.ones((OPEN_SIZE, OPEN_SIZE), np.uint8))
+    result = {'frame': [width, height], 'total': 0, 'boxes': []}
+    if not cv2.countNonZero(mask):
+        return result
+
+    # Dilating by half the merge distance joins blobs up to that far apart
+    grow = merge_distance // 2
+    grown = cv2.dilate(mask, np.ones((2 * grow + 1, 2 * grow + 1), np.uint8)) if grow else mask
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(grown, connectivity=8)
+    areas = np.bincount(labels[mask > 0], minlength=count)
+    areas[0] = 0
+    kept = [label for label in np.argsort(areas)[::-1] if areas[label] >= min_area]
+    result['total'] = len(kept)
+
+    for label in kept[:max_regions]:
+        x, y, w, h = (int(v) for v in stats[label, :4])
+        changed = ((labels[y:y + h, x:x + w] == label) & (mask[y:y + h, x:x + w] > 0)).astype(np.uint8)
+        # The grown component's box is up to grow pixels too large on each side
+        bx, by, bw, bh = cv2.boundingRect(changed)
+        box = (slice(y + by, y + by + bh), slice(x + bx, x + bx + bw))
+        delta_e = delta_e_map(img1[box], img2[box], delta_e_method)
+        result['boxes'].append({
+            'x': x + bx, 'y': y + by, 'width': bw, 'height': bh,
+            'area': int(areas[label]),
+            'mean_delta_e': round(float(cv2.mean(delta_e, mask=changed[by:by + bh, bx:bx + bw])[0]), 3),
+        })
+    return result
+
+def scale_box(box, frame, size):
+    """Returns (x, y, width, height) of box, found in a frame of frame (width, height), in a frame of size."""
+    sx, sy = size[0] / frame[0], size[1] / frame[1]
+    x, y = int(box['x'] * sx), int(box['y'] * sy)
+    return x, y, max(1, round(box['width'] * sx)), max(1, round(box['height'] * sy))
+
+def render_zoom(img1, img2, box, padding=ZOOM_PADDING):
+    """
+    Renders one region as the two crops side by side, with the box outlined.
+
+    Args:
+        img1: First BGR image
+        img2: Second BGR image, the same size as img1
+        box: (x, y, width, height) of the region in img1
+        padding: Pixels of context around the box
+    """
+    height, width = img1.shape[:2]
+    x, y, w, h = box
+    left, top = max(0, x - padding), max(0, y - padding)
+    right, bottom = min(width, x + w + padding), min(height, y + h + padding)
+
+    crops = []
+    for img in (img1, img2):
+        crop = img[top:bottom, left:right].copy()
+        cv2.rectangle(crop, (x - left, y - top), (x - left + w - 1, y - top + h - 1), ZOOM_BOX_COLOR, 1)
+        crops.append(crop)
+
+    longest = max(right - left, bottom - top)
+    if longest > ZOOM_MAX_SIDE:
+        scale, interpolation = ZOOM_MAX_SIDE / longest, cv2.INTER_AREA
+    elif longest < ZOOM_MIN_SIDE:
+        scale, interpolation = ZOOM_MIN_SIDE // longest, cv2.INTER_NEAREST
+    else:
+        scale, interpolation = 1, None
+    if interpolation is not None:
+        size = (max(1, round((right - left) * scale)), max(1, round((bottom - top) * scale)))
+        crops = [cv2.resize(crop, size, interpolation=interpolation) for crop in crops]
+
+    gutter = np.full((crops[0].shape[0], ZOOM_GUTTER, 3), 255, np.uint8)
+    return cv2.hconcat([crops[0], gutter, crops[1]])
+
+def region_zoom_path(output_folder, name, index, ext='.jpg'):
+    """Returns the content-addressed path of the zoom image of one region."""
+    return os.path.join(output_folder, f"{name}_region{index}{ext}")
+
+def region_zoom_paths(output_folder, name):
+    """Returns the zoom images written for name so far."""
+    return glob.glob(os.path.join(glob.escape(output_folder), f"{glob.escape(name)}_region[0-9]*.*"))
@@ -0,0 +1,182 @@
+# registration.py - Aligns the second image of a pair onto the first before diffing
+#
+# The renderers diff pixel for pixel, so a one-pixel shift or a slightly
+# different crop shows up as a change over the whole frame. With registration
+# enabled, LoadedPair estimates how the second image maps onto the first and
+# warps it into the first image's frame before any renderer runs.
+#
+# Estimation never touches the working-resolution frames: it runs on a
+# grayscale pyramid of copies at most FINE_DIM pixels long. 'translation'
+# phase-correlates from the coarsest level to the finest, each level refining
+# the shift found by the one below. 'similarity' (shift, rotation, uniform
+# scale) and 'homography' fit ORB feature matches with RANSAC, and the shift
+# is then polished by phase correlation at the finest level. The job stores
+# each estimate on its comparison (see transform_record), and the artifact
+# groups and region zooms rendered on demand later (see artifacts.py) reuse
+# it rather than estimate again in the web process.
+import cv2
+import numpy as np
+
+REGISTRATION_MODES = ('translation', 'similarity', 'homography')
+
+FINE_DIM = 1024  # longest side of the finest pyramid level
+COARSE_DIM = 128  # levels stop halving below this
+MIN_RESPONSE = 0.05  # phase correlation peaks below this are noise
+ORB_FEATURES = 2000
+MIN_INLIERS = 12
+RANSAC_THRESHOLD = 3.0  # pixels at the finest level
+
+def _scaling(scale):
+    return np.diag([scale, scale, 1.0])
+
+def _rescale(matrix, scale):
+    """Expresses a transform between frames scaled by scale (coordinates multiply by scale)."""
+    return _scaling(scale) @ matrix @ _scaling(1.0 / scale)
+
+def _pyramid(gray, count):
+    """Returns count levels of a Gaussian pyramid of gray, coarsest first, with each level's scale."""
+    levels = [(gray, 1.0)]
+    while len(levels) < count:
+        level, scale = levels[-1]
+        levels.append((cv2.pyrDown(level), scale / 2))
+    return levels[::-1]
+
+def _refine_translation(fixed, moving, matrix, window):
+    """
+    Refines the shift of matrix at one pyramid level by phase correlation.
+
+    Returns the refined matrix and the correlation peak, or (matrix, peak)
+    unchanged when the peak is too weak to trust.
+    """
+    height, width = fixed.shape
+    warped = cv2.warpPerspective(moving, matrix, (width, height), flags=cv2.INTER_LINEAR,
+                                 borderMode=cv2.BORDER_REFLECT)
+    (dx, dy), response = cv2.phaseCorrelate(fixed, warped, window)
+    if response < MIN_RESPONSE:
+        return matrix, response
+    shift = np.array([[1.0, 0.0, -dx], [0.0, 1.0, -dy], [0.0, 0.0, 1.0]])
+    return shift @ matrix, response
+
+def _match_features(fixed, moving, mode):
+    """Fits a similarity or homography mapping moving onto fixed from ORB matches, or returns None."""
+    orb = cv2.ORB_create(ORB_FEATURES)
+    keypoints1, descriptors1 = orb.detectAndCompute(fixed, None)
+    keypoints2, descriptors2 = orb.detectAndCompute(moving, None)
+    if descriptors1 is None or descriptors2 is None or len(keypoints1) < MIN_INLIERS or len(keypoints2) < MIN_INLIERS:
+        return None
+
+    matches = cv2.BFMatcher(cv2.NORM_HAMMING).knnMatch(descriptors2, descriptors1, k=2)
+    # Lowe's ratio test drops ambiguous matches before RANSAC sees them
+    good = [pair[0] for pair in matches if len(pair) == 2 and pair[0].distance < 0.75 * pair[1].distance]
+    if len(good) < MIN_INLIERS:
+        return None
+    source = np.float32([keypoints2[m.queryIdx].pt for m in good])
+    target = np.float32([keypoints1[m.trainIdx].pt for m in good])
+
+    if mode == 'homography':
+        matrix, inliers = cv2.findHomography(source, target, cv2.RANSAC, RANSAC_THRESHOLD)
+    else:
+        affine, inliers = cv2.estimateAffinePartial2D(source, target, method=cv2.RANSAC,
+                                                      ransacReprojThreshold=RANSAC_THRESHOLD)
+        matrix = None if affine is None else np.vstack([affine, [0.0, 0.0, 1.0]])
+    if matrix is None or inliers is None or int(inliers.sum()) < MIN_INLIERS:
+        return None
+    return matrix
+
+def estimate_transform(img1, img2, mode='translation'):
+    """
+    Estimates the transform that maps img2 onto img1.
+
+    Args:
+        img1: BGR baseline image
+        img2: BGR candidate image, at the same pixel scale as img1 but
+            possibly shifted, cropped or (for 'similarity' and 'homography')
+            rotated and rescaled
+        mode: One of REGISTRATION_MODES
+
+    Returns:
+        A 3x3 float64 matrix for cv2.warpPerspective(img2, matrix, img1's size),
+        or None when the images could not be registered.
+    """
+    if mode not in REGISTRATION_MODES:
+        raise ValueError(f"Unknown registration mode {mode!r}")
+
+    scale = min(1.0, FINE_DIM / max(img1.shape[:2]))
+    grays = []
+    for img in (img1, img2):
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        if scale < 1.0:
+            gray = cv2.resize(gray, (max(1, round(gray.shape[1] * scale)), max(1, round(gray.shape[0] * scale))),
+                              interpolation=cv2.INTER_AREA)
+        grays.append(np.float32(gray))
+    fixed, moving = grays
+
+    matrix = np.eye(3)
+    if mode != 'translation':
+        matrix = _match_features(np.uint8(fixed), np.uint8(moving), mode)
+        if matrix is None:
+            return None
+
+    count = 1
+    while max(fixed.shape) >> count >= COARSE_DIM:
+        count += 1
+    levels = list(zip(_pyramid(fixed, count), _pyramid(moving, count)))
+    if mode != 'translation':
+        # Features already settle the coarse alignment; only polish the shift
+        levels = levels[-1:]
+    for index, ((fixed_level, level_scale), (moving_level, _)) in enumerate(levels):
+        window = cv2.createHanningWindow(fixed_level.shape[::-1], cv2.CV_32F)
+        refined, response = _refine_translation(fixed_level, moving_level, _rescale(matrix, level_scale), window)
+        if index == 0 and mode == 'translation' and response < MIN_RESPONSE:
+            return None
+        matrix = _rescale(refined, 1.0 / level_scale)
+
+    return _rescale(matrix, 1.0 / scale)
+
+def is_identity(matrix, tolerance=0.25):
+    """True when matrix moves no pixel of a frame of FINE_DIM by more than tolerance pixels."""
+    corners = np.float32([[0, 0], [FINE_DIM, 0], [0, FINE_DIM], [FINE_DIM, FINE_DIM]]).reshape(-1, 1, 2)
+    moved = cv2.perspectiveTransform(corners, matrix)
+    return float(np.abs(moved - corners).max()) <= tolerance
+
+def warp_onto(img1, img2, matrix):
+    """
+    Warps img2 into the frame of img1.
+
+    Pixels of img1 that img2 does not cover have nothing to be compared with;
+    they are filled from img1 so they do not count as changes.
+    """
+    height, width = img1.shape[:2]
+    warped = cv2.warpPerspective(img2, matrix, (width, height), flags=cv2.INTER_LINEAR,
+                                 borderMode=cv2.BORDER_CONSTANT)
+    coverage = cv2.warpPerspective(np.full(img2.shape[:2], 255, np.uint8), matrix, (width, height),
+                                   flags=cv2.INTER_NEAREST, borderMode=cv2.BORDER_CONSTANT)
+    np.copyto(warped, img1, where=(coverage == 0)[..., np.newaxis])
+    return warped
+
+def transform_record(matrix, mode, scale):
+    """
+    Returns the JSON-serializable record of an estimate (see Comparison.registration).
+
+    The matrix is stored in native pixels, so frames decoded at any working
+    resolution can reuse it (see stored_transform).
+
+    Args:
+        matrix: Estimate of estimate_transform, or None when it failed
+        mode: Registration mode it was estimated with
+        scale: Working size of the frames it was estimated on over their native size
+    """
+    return {'mode': mode, 'matrix': None if matrix is None else _rescale(matrix, 1.0 / scale).tolist()}
+
+def stored_transform(record, mode, scale):
+    """
+    Returns (found, matrix) for frames scale times the native size from a transform_record.
+
+    found is False when record is missing or was estimated with another mode;
+    matrix is None when the stored estimate failed.
+    """
+    if not record or record.get('mode') != mode:
+        return False, None
+    if record.get('matrix') is None:
+        return True, None
+    return True, _rescale(np.array(record['matrix'], dtype=np.float64), scale)
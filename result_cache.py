@@ -0,0 +1,363 @@
+# result_cache.py - Content-addressed cache of comparison results
+#
+# A comparison is keyed on the SHA-256 of both inputs plus every parameter that
+# changes the rendered output. Identical uploads reuse the inputs and artifacts
+# of the first comparison instead of running the pipeline again, so several
+# Comparison rows can point at the same files. Files are only removed once no
+# row uses them any more, and the rendered outputs of the least recently used
+# entries are evicted when the outputs directory grows over its budget (the
+# inputs are kept so an evicted entry can be rendered again). Comparisons of a
+# baseline against several candidates are not cached.
+import datetime
+import hashlib
+import json
+import logging
+import os
+from derivatives import DERIVATIVE_COLUMNS, derivative_paths
+from metrics import METRIC_COLUMNS
+from regions import region_zoom_paths
+from sequences import CANDIDATE_COLUMNS
+from sharding import shard_directory
+
+# Bump when the renderers change so old entries stop matching
+CACHE_VERSION = 1
+
+INPUT_COLUMNS = ('image1_path', 'image2_path')
+OUTPUT_COLUMNS = ('gif_path', 'color_diff1_path', 'color_diff2_path', 'gray_diff1_path', 'gray_diff2_path')
+PATH_COLUMNS = INPUT_COLUMNS + OUTPUT_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """Returns the hex SHA-256 of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def artifact_name(comparison):
+    """
+    Returns the name the lazily rendered artifacts and region zooms of comparison are written under.
+
+    Cached comparisons share them under their cache key; the others use
+    their own uid, never the row id, which SQLite hands out again once the
+    newest row is deleted.
+    """
+    return comparison.cache_key or comparison.uid
+
+def cache_key(hash1, hash2, params):
+    """Returns the cache key for two input hashes and the comparison parameters."""
+    payload = json.dumps({'v': CACHE_VERSION, 'inputs': [hash1, hash2], 'params': params}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def comparison_key(hashes, params, multi_frame=False):
+    """
+    Returns the cache key of a comparison of the input hashes[0] against hashes[1:].
+
+    Comparisons with more than one candidate get None. Multi-frame pairs are
+    measured over all their frames, so their keys differ from those of the
+    same files measured on the first frame only, as older versions did.
+    """
+    if len(hashes) != 2:
+        return None
+    if multi_frame:
+        params = dict(params, frames='all')
+    return cache_key(hashes[0], hashes[1], params)
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as exc:
+        logger.warning('Could not remove %s: %s', path, exc)
+
+def remove_image(path):
+    """Removes an input or output file together with its thumbnails and previews."""
+    remove_file(path)
+    for derivative in derivative_paths(path):
+        remove_file(derivative)
+
+def _without_outputs(derivatives):
+    """Returns the derivative sizes of a row without those of its outputs."""
+    if not derivatives:
+        return derivatives
+    outputs = {kind for kind, column in DERIVATIVE_COLUMNS.items() if column in OUTPUT_COLUMNS}
+    return {kind: sizes for kind, sizes in derivatives.items() if kind not in outputs}
+
+class ResultCache:
+    """
+    Shares inputs and artifacts between Comparison rows with the same cache key.
+
+    Entries live in their own table; refcount mirrors the number of Comparison
+    rows carrying the key and last_used_at drives LRU eviction.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.db = None
+        self.entry_model = None
+        self.comparison_model = None
+
+    def init_app(self, app, db, entry_model, comparison_model):
+        app.config.setdefault('RESULT_CACHE_MAX_BYTES', 5 * 1024 ** 3)
+        self.app = app
+        self.db = db
+        self.entry_model = entry_model
+        self.comparison_model = comparison_model
+        app.extensions['result_cache'] = self
+
+    def lookup(self, key):
+        """
+        Returns the entry for key if its inputs are still on disk.
+
+        Outputs may be missing (never rendered, or evicted); they are rendered
+        again on demand by artifacts.ArtifactStore.
+        """
+        entry = self.db.session.get(self.entry_model, key)
+        if entry is None:
+            return None
+        if not all(getattr(entry, column) and os.path.exists(getattr(entry, column)) for column in INPUT_COLUMNS):
+            return None
+        return entry
+
+    def attach(self, comparison, entry):
+        """Points comparison at the files and metrics of entry and counts the new reference."""
+        for column in PATH_COLUMNS:
+            path = getattr(entry, column)
+            setattr(comparison, column, path if path and os.path.exists(path) else None)
+        comparison.cache_key = entry.key
+        sibling = self.comparison_model.query.filter_by(cache_key=entry.key).first()
+        if sibling is not None:
+            for column in METRIC_COLUMNS.values():
+                setattr(comparison, column, getattr(sibling, column))
+            comparison.derivatives = sibling.derivatives
+            comparison.regions = sibling.regions
+            comparison.registration = sibling.registration
+            theirs = {row.position: row for row in sibling.inputs}
+            for row in comparison.inputs:
+                if row.position in theirs:
+                    for column in CANDIDATE_COLUMNS:
+                        setattr(row, column, getattr(theirs[row.position], column))
+        self._sync_inputs(comparison)
+        self.db.session.add(comparison)
+        self.db.session.flush()
+        self._recount(entry)
+        entry.last_used_at = datetime.datetime.utcnow()
+
+    def store(self, comparison):
+        """
+        Records the results of comparison under its cache key.
+
+        Called when a job finishes, whether or not it rendered anything. For
+        every file the entry already has on disk, comparison adopts it and its
+        own duplicate is removed; every file the entry lacks (never rendered,
+        or evicted) is taken from comparison, and every row sharing the key is
+        pointed at it.
+        """
+        key = comparison.cache_key
+        if not key:
+            return
+        entry = self.db.session.get(self.entry_model, key)
+        if entry is None:
+            entry = self.entry_model(key=key, created_at=datetime.datetime.utcnow())
+            for column in PATH_COLUMNS:
+                setattr(entry, column, getattr(comparison, column))
+            self.db.session.add(entry)
+        else:
+            duplicates = []
+            taken = {}
+            for column in PATH_COLUMNS:
+                ours, theirs = getattr(comparison, column), getattr(entry, column)
+                if theirs and os.path.exists(theirs):
+                    if ours != theirs:
+                        duplicates.append(ours)
+                    setattr(comparison, column, theirs)
+                elif ours:
+                    taken[column] = ours
+            self._sync_inputs(comparison)
+            self.db.session.flush()
+            for path in duplicates:
+                if path and not self.is_shared(path, comparison):
+                    remove_image(path)
+            if taken:
+                self._point_rows(entry, taken, comparison.derivatives)
+
+        self._finish_update(entry)
+
+    def record_outputs(self, comparison, outputs, derivatives=None):
+        """
+        Records outputs rendered after the fact (see artifacts.ArtifactStore).
+
+        Args:
+            comparison: Comparison the outputs were rendered for
+            outputs: dict mapping output columns to the rendered paths
+            derivatives: Optional sizes of their derivatives, by kind
+        """
+        for column, path in outputs.items():
+            setattr(comparison, column, path)
+        if derivatives:
+            comparison.derivatives = dict(comparison.derivatives or {}, **derivatives)
+        entry = self.db.session.get(self.entry_model, comparison.cache_key) if comparison.cache_key else None
+        if entry is None:
+            return
+        self._point_rows(entry, outputs, derivatives)
+        self._finish_update(entry)
+
+    def touch(self, comparison, min_interval=60):
+        """Marks the entry of comparison as used, at most once per min_interval seconds."""
+        if not comparison.cache_key:
+            return
+        entry = self.db.session.get(self.entry_model, comparison.cache_key)
+        now = datetime.datetime.utcnow()
+        if entry and (entry.last_used_at is None or (now - entry.last_used_at).total_seconds() > min_interval):
+            entry.last_used_at = now
+            self.db.session.commit()
+
+    def is_shared(self, path, comparison):
+        """True if a Comparison row other than comparison still uses path."""
+        Comparison = self.comparison_model
+        columns = [getattr(Comparison, column) == path for column in PATH_COLUMNS]
+        return Comparison.query.filter(
+            Comparison.id != comparison.id, self.db.or_(*columns)
+        ).first() is not None
+
+    def release(self, comparison):
+        """
+        Removes the files of comparison that no other row uses, before it is deleted.
+
+        The entry goes away with its last reference.
+        """
+        for column in PATH_COLUMNS:
+            path = getattr(comparison, column)
+            if path and not self.is_shared(path, comparison):
+                remove_image(path)
+        # Further candidates are never cached, so nothing else uses them
+        for row in comparison.inputs:
+            if row.position >= len(INPUT_COLUMNS) and row.path:
+                remove_image(row.path)
+
+        if comparison.cache_key:
+            entry = self.db.session.get(self.entry_model, comparison.cache_key)
+            if entry is not None:
+                remaining = self.comparison_model.query.filter(
+                    self.comparison_model.cache_key == entry.key,
+                    self.comparison_model.id != comparison.id
+                ).count()
+                if remaining:
+                    entry.refcount = remaining
+                else:
+                    for column in PATH_COLUMNS:
+                        path = getattr(entry, column)
+                        if path and not self.is_shared(path, comparison):
+                            remove_image(path)
+                    self._remove_region_zooms(entry.key)
+                    self.db.session.delete(entry)
+        else:
+            self._remove_region_zooms(artifact_name(comparison))
+
+    def evict(self, keep=None):
+        """
+        Evicts the outputs of least recently used entries until under RESULT_CACHE_MAX_BYTES.
+
+        The entry with key keep (typically the one just stored) is never evicted.
+        """
+        limit = self.app.config['RESULT_CACHE_MAX_BYTES']
+        if limit is None:
+            return
+        Entry = self.entry_model
+        total = self.db.session.query(self.db.func.coalesce(self.db.func.sum(Entry.size_bytes), 0)).scalar()
+        if total <= limit:
+            return
+
+        for entry in Entry.query.filter(Entry.size_bytes > 0, Entry.key != keep).order_by(Entry.last_used_at):
+            if total <= limit:
+                break
+            total -= self.evict_entry(entry)
+
+    def expire(self, before):
+        """
+        Evicts the outputs of entries last used before the datetime before (see storage.Storage.collect).
+
+        Rows without a cache key, from before the cache existed, lose the
+        outputs they were created with before that time. Returns the number of
+        entries and rows whose outputs were removed.
+        """
+        Entry, Comparison = self.entry_model, self.comparison_model
+        has_outputs = [getattr(Entry, column).isnot(None) for column in OUTPUT_COLUMNS]
+        expired = 0
+        for entry in Entry.query.filter(Entry.last_used_at < before, self.db.or_(*has_outputs)).all():
+            self.evict_entry(entry)
+            expired += 1
+
+        has_outputs = [getattr(Comparison, column).isnot(None) for column in OUTPUT_COLUMNS]
+        for comparison in Comparison.query.filter(Comparison.cache_key.is_(None), Comparison.created_at < before,
+                                                  self.db.or_(*has_outputs)).all():
+            for column in OUTPUT_COLUMNS:
+                path = getattr(comparison, column)
+                if path and not self.is_shared(path, comparison):
+                    remove_image(path)
+                setattr(comparison, column, None)
+            self._remove_region_zooms(artifact_name(comparison))
+            comparison.derivatives = _without_outputs(comparison.derivatives)
+            expired += 1
+        return expired
+
+    def evict_entry(self, entry):
+        """Removes the rendered outputs of entry, keeping its inputs. Returns the bytes freed."""
+        for column in OUTPUT_COLUMNS:
+            path = getattr(entry, column)
+            if path:
+                remove_image(path)
+            setattr(entry, column, None)
+        self._remove_region_zooms(entry.key)
+        self._drop_outputs(entry)
+        logger.info('Evicted cached outputs of %s (%d bytes)', entry.key, entry.size_bytes or 0)
+        freed, entry.size_bytes = entry.size_bytes or 0, 0
+        return freed
+
+    def _point_rows(self, entry, paths, derivatives=None):
+        """Sets columns of entry and of every row sharing its key, merging in the derivatives of those columns."""
+        for column, path in paths.items():
+            setattr(entry, column, path)
+        self.comparison_model.query.filter_by(cache_key=entry.key).update(paths, synchronize_session=False)
+        kinds = {kind: sizes for kind, sizes in (derivatives or {}).items() if DERIVATIVE_COLUMNS[kind] in paths}
+        if kinds:
+            for row in self.comparison_model.query.filter_by(cache_key=entry.key):
+                row.derivatives = dict(row.derivatives or {}, **kinds)
+
+    def _drop_outputs(self, entry):
+        """Clears the evicted outputs, and their derivatives, from every row sharing the key of entry."""
+        self.comparison_model.query.filter_by(cache_key=entry.key).update(
+            {column: None for column in OUTPUT_COLUMNS}, synchronize_session=False
+        )
+        for row in self.comparison_model.query.filter_by(cache_key=entry.key):
+            row.derivatives = _without_outputs(row.derivatives)
+
+    def _remove_region_zooms(self, name):
+        """Removes the zoom images of the regions (see artifacts.ArtifactStore.region_zoom) rendered for name."""
+        folder = self.app.config['OUTPUT_FOLDER']
+        # Zooms rendered before the outputs were sharded sit in the folder itself
+        for directory in (shard_directory(folder, name, create=False), folder):
+            for path in region_zoom_paths(directory, name):
+                remove_file(path)
+
+    def _finish_update(self, entry):
+        entry.size_bytes = sum(os.path.getsize(getattr(entry, column)) for column in OUTPUT_COLUMNS
+                               if getattr(entry, column) and os.path.exists(getattr(entry, column)))
+        entry.last_used_at = datetime.datetime.utcnow()
+        self.db.session.flush()
+        self._recount(entry)
+        self.evict(keep=entry.key)
+
+    def _sync_inputs(self, comparison):
+        """Points the input rows of the baseline and first candidate at the files comparison now uses."""
+        for row in comparison.inputs:
+            if row.position < len(INPUT_COLUMNS):
+                row.path = getattr(comparison, INPUT_COLUMNS[row.position])
+
+    def _recount(self, entry):
+        entry.refcount = self.comparison_model.query.filter_by(cache_key=entry.key).count()
+
+result_cache = ResultCache()
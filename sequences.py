@@ -0,0 +1,202 @@
+# sequences.py - One baseline against many candidates, frame by frame
+#
+# A comparison has a baseline and any number of candidates (the
+# ComparisonInput rows of app.py), and each of them may be a still image, an
+# animated GIF, WebP or PNG, or a directory of frame files. compare_set walks
+# the frames of the baseline once: every frame is decoded a single time,
+# diffed against the same frame of every candidate on the shared render
+# thread pool (see image_compare.get_render_executor), and dropped before the
+# next one is read. Only one frame per input is in memory at a time, however
+# long the sequences are. A candidate gets the worst value of each metric over
+# its frames, and the set gets the worst over its candidates.
+import os
+import cv2
+import numpy as np
+from PIL import Image, ImageSequence
+from image_compare import LoadedPair, get_render_executor, load_image
+from instrumentation import stage, submit, timed
+from metrics import METRIC_COLUMNS, apply_metrics, is_within_tolerance, measure_pair
+
+FRAME_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tif', '.tiff', '.webp')
+
+# ComparisonInput columns holding the results of a candidate
+CANDIDATE_COLUMNS = tuple(METRIC_COLUMNS.values()) + ('frames_compared', 'worst_frame')
+
+def frame_paths(directory):
+    """Returns the frame files of a directory in name order."""
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.lower().endswith(FRAME_EXTENSIONS) and not name.startswith('.'))
+
+def frame_count(source):
+    """Returns the number of frames of an image file or frame directory, or None if it cannot be read."""
+    if os.path.isdir(source):
+        return len(frame_paths(source))
+    try:
+        with Image.open(source) as img:
+            return getattr(img, 'n_frames', 1)
+    except Exception:
+        return None
+
+def is_multi_frame(source):
+    """True for frame directories and animated images."""
+    return os.path.isdir(source) or (frame_count(source) or 1) > 1
+
+def first_frame(source):
+    """Returns a file holding the first frame of source: source itself, or the first file of a directory."""
+    if not os.path.isdir(source):
+        return source
+    paths = frame_paths(source)
+    if not paths:
+        raise ValueError(f"{source} holds no frames")
+    return paths[0]
+
+def fit_frame(img, max_dim=None, size=None):
+    """Resizes a frame to size (width, height), or so that its longest side is at most max_dim."""
+    height, width = img.shape[:2]
+    if size is None:
+        if not max_dim or max(height, width) <= max_dim:
+            return img
+        scale = max_dim / max(height, width)
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    if tuple(size) == (width, height):
+        return img
+    return cv2.resize(img, tuple(size), interpolation=cv2.INTER_AREA)
+
+def iter_frames(source, max_dim=3000):
+    """
+    Yields the frames of source as BGR images, one at a time.
+
+    Stills and frame files are decoded with load_image (at a reduced scale
+    where the format allows it); animations are read frame by frame with
+    Pillow, which composites each frame onto the ones before it.
+
+    Args:
+        source: Still or animated image file, or directory of frame files
+        max_dim: Longest side of each frame (None keeps the native size)
+
+    Raises:
+        ValueError: for a frame that cannot be decoded.
+    """
+    if os.path.isdir(source):
+        for index, path in enumerate(frame_paths(source)):
+            img = load_image(path, max_dim)
+            if img is None:
+                raise ValueError(f"Frame {index} of {source} could not be read")
+            yield img
+        return
+
+    if frame_count(source) == 1:
+        img = load_image(source, max_dim)
+        if img is None:
+            raise ValueError(f"{os.path.basename(source)} could not be read as an image")
+        yield img
+        return
+
+    with Image.open(source) as animation:
+        for frame in ImageSequence.Iterator(animation):
+            with stage('decode'):
+                img = fit_frame(cv2.cvtColor(np.asarray(frame.convert('RGB')), cv2.COLOR_RGB2BGR), max_dim)
+            yield img
+
+def worst_metrics(a, b):
+    """Combines two metrics dicts (see metrics.measure_pair) into the worst value of each; a may be None."""
+    if a is None:
+        return dict(b)
+    psnrs = [value for value in (a['psnr'], b['psnr']) if value is not None]  # None is infinite
+    if a['within_tolerance'] is None and b['within_tolerance'] is None:
+        within = None
+    else:
+        within = a['within_tolerance'] is not False and b['within_tolerance'] is not False
+    return {
+        'max_delta_e': max(a['max_delta_e'], b['max_delta_e']),
+        'mean_delta_e': max(a['mean_delta_e'], b['mean_delta_e']),
+        'changed_ratio': max(a['changed_ratio'], b['changed_ratio']),
+        'ssim': min(a['ssim'], b['ssim']),
+        'psnr': min(psnrs) if psnrs else None,
+        'scale': min(a['scale'], b['scale']),
+        'within_tolerance': within,
+    }
+
+def _measure_next(reader, frame, measure):
+    """Reads the next frame of a candidate and measures it against frame; None once the candidate has ended."""
+    other = next(reader, None)
+    if other is None:
+        return None
+    return measure_pair(LoadedPair.from_images(frame, fit_frame(other, size=frame.shape[1::-1])), **measure)
+
+@timed('sequence')
+def compare_set(baseline, candidates, delta_e_method='cie76', threshold=50, max_dim=3000, max_delta_e=None,
+                max_changed_ratio=None, workers=0):
+    """
+    Measures every candidate against the baseline, frame by frame.
+
+    Frame n of a candidate is compared with frame n of the baseline, brought
+    to its size; registration does not apply.
+
+    Args:
+        baseline: Still or animated image file, or directory of frame files
+        candidates: Sources like baseline
+        delta_e_method: 'cie76' or 'ciede2000'
+        threshold: Grayscale difference that counts as a changed pixel
+        max_dim: Longest side of the frames (None keeps the native size)
+        max_delta_e: Largest max Delta-E that is within tolerance (None: no limit)
+        max_changed_ratio: Largest changed-pixel fraction that is within tolerance (None: no limit)
+        workers: Threads measuring the candidates of a frame side by side (0 measures them in turn)
+
+    Returns:
+        {'metrics': the worst metrics of the set, 'candidates': [...]}, with
+        the worst metrics of each candidate over its frames plus frame_count,
+        frames_compared and worst_frame (the frame with the largest max
+        Delta-E), in the order of candidates. A candidate whose frame count
+        differs from the baseline's is never within tolerance.
+    """
+    measure = {'delta_e_method': delta_e_method, 'threshold': threshold, 'max_delta_e': max_delta_e,
+               'max_changed_ratio': max_changed_ratio}
+    readers = [iter_frames(source, max_dim) for source in candidates]
+    results = [{'metrics': None, 'frames_compared': 0, 'worst_frame': None} for _ in candidates]
+    executor = get_render_executor(workers) if workers else None
+
+    baseline_frames = 0
+    try:
+        for index, frame in enumerate(iter_frames(baseline, max_dim)):
+            baseline_frames += 1
+            if executor is None:
+                measured = [_measure_next(reader, frame, measure) for reader in readers]
+            else:
+                futures = [submit(executor, _measure_next, reader, frame, measure) for reader in readers]
+                measured = [future.result() for future in futures]
+            for result, metrics in zip(results, measured):
+                if metrics is None:
+                    continue
+                if result['metrics'] is None or metrics['max_delta_e'] > result['metrics']['max_delta_e']:
+                    result['worst_frame'] = index
+                result['metrics'] = worst_metrics(result['metrics'], metrics)
+                result['frames_compared'] += 1
+    finally:
+        for reader in readers:
+            reader.close()
+    if not baseline_frames:
+        raise ValueError(f"{os.path.basename(baseline)} holds no frames")
+
+    summary = None
+    report = []
+    for source, result in zip(candidates, results):
+        count = frame_count(source)
+        metrics = result['metrics']
+        if metrics is None:
+            raise ValueError(f"{os.path.basename(source)} holds no frames")
+        if count != baseline_frames and is_within_tolerance(metrics, max_delta_e, max_changed_ratio) is not None:
+            metrics['within_tolerance'] = False
+        summary = worst_metrics(summary, metrics)
+        report.append(dict(metrics, frame_count=count, frames_compared=result['frames_compared'],
+                           worst_frame=result['worst_frame']))
+    return {'metrics': summary, 'candidates': report}
+
+def apply_candidates(inputs, candidates):
+    """Copies the results of compare_set onto the ComparisonInput rows of the candidates (positions 1 and up)."""
+    for row in inputs:
+        if 1 <= row.position <= len(candidates):
+            result = candidates[row.position - 1]
+            apply_metrics(row, result)
+            row.frames_compared = result.get('frames_compared')
+            row.worst_frame = result.get('worst_frame')
@@ -0,0 +1,40 @@
+# serving.py - Cacheable delivery of uploads, artifacts and derivatives
+#
+# Every file under the upload and output folders is named after a random job
+# uid or a content-addressed cache key, so a URL never changes content and can
+# be cached by browsers for good. send_artifact adds an ETag the caller derives
+# from what the database already knows (the stored SHA-256 of an upload, or the
+# name of a file), so no file is read to tag it. It answers conditional
+# requests with 304 and Range requests with 206, and leaves the body to the
+# WSGI server's file wrapper (sendfile(2) under gunicorn) or, with
+# USE_X_SENDFILE, to the front-end web server.
+import os
+from flask import send_file
+
+# One year, the longest lifetime caches honour
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+def send_artifact(path, etag=None, immutable=False, private=False, download_name=None):
+    """
+    Sends a file with an ETag and caching headers.
+
+    Args:
+        path: Path to the file
+        etag: Strong ETag naming its content; without one, the tag is
+            derived from the file's mtime and size
+        immutable: The URL always names this exact content, so clients may
+            cache it for a year without revalidating
+        private: Only the client may cache the response, not shared proxies
+        download_name: Optional file name suggested to the client
+    """
+    response = send_file(os.path.abspath(path), etag=etag or True, conditional=True,
+                         download_name=download_name, max_age=IMMUTABLE_MAX_AGE if immutable else None)
+    if immutable:
+        response.cache_control.immutable = True
+    else:
+        # Cached, but revalidated with If-None-Match on every use (a cheap 304)
+        response.cache_control.no_cache = True
+    if private:
+        response.cache_control.public = False
+        response.cache_control.private = True
+    return response
@@ -0,0 +1,30 @@
+# sharding.py - Hash-prefix directory layout of uploads and outputs
+#
+# Flat folders with millions of entries make every lookup in them slow.
+# Uploads and outputs are spread over two levels of sub-directories named by
+# the first hex digits of the file's name ("ab/cd/abcd..._img1.png"): uids and
+# cache keys are random hex already, and other names (e.g. "comparison12")
+# use a hash of the name, so no directory grows past a few thousand entries.
+# Files written by older versions stay where they are; rows keep full paths,
+# so both layouts work side by side.
+import hashlib
+import os
+import re
+
+SHARD_LEVELS = 2  # directory levels, each named by two hex digits
+
+HEX_PREFIX = re.compile(r'[0-9a-f]{%d}' % (2 * SHARD_LEVELS))
+
+def shard_key(name):
+    """Returns the hex digits name is sharded by: its own leading ones, or those of its SHA-1."""
+    if not HEX_PREFIX.match(name):
+        name = hashlib.sha1(name.encode('utf-8')).hexdigest()
+    return name[:2 * SHARD_LEVELS]
+
+def shard_directory(folder, name, create=True):
+    """Returns the directory under folder that files named after name (a uid or cache key) go in."""
+    key = shard_key(name)
+    directory = os.path.join(folder, *(key[n:n + 2] for n in range(0, len(key), 2)))
+    if create:
+        os.makedirs(directory, exist_ok=True)
+    return directory
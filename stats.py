@@ -0,0 +1,112 @@
+# stats.py - Aggregate statistics for the admin API
+#
+# The admin UI polls /api/admin/stats. Every figure comes from a handful of
+# grouped aggregate queries (one GROUP BY date for the whole activity series)
+# and the result is kept in a short-lived in-process cache, so a page left
+# open by several admins does not keep the database busy.
+import datetime
+import threading
+import time
+
+class TTLCache:
+    """Caches values by key for ttl seconds. Thread-safe; values are computed outside the lock."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, compute):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._values.get(key)
+            if cached is not None and cached[0] > now:
+                return cached[1]
+        value = compute()
+        with self._lock:
+            self._values[key] = (now + self.ttl, value)
+            # Drop expired keys so a range of ?days= values cannot grow the cache without bound
+            for stale in [k for k, (expires, _) in self._values.items() if expires <= now]:
+                del self._values[stale]
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+def admin_stats(db, user_model, comparison_model, days=7, top_users=5):
+    """
+    Computes the admin statistics with four aggregate queries.
+
+    Args:
+        db: Flask-SQLAlchemy instance
+        user_model: User model
+        comparison_model: Comparison model
+        days: Length of the activity window: "recent" counts the last days * 24
+            hours, the daily series the last days calendar days, ending today
+        top_users: Number of most active users to list
+    """
+    User, Comparison = user_model, comparison_model
+    now = datetime.datetime.utcnow()
+    today = now.date()
+    recent_since = now - datetime.timedelta(days=days)
+    window_start = datetime.datetime.combine(today - datetime.timedelta(days=days - 1), datetime.time())
+
+    def count_if(condition):
+        return db.func.coalesce(db.func.sum(db.case((condition, 1), else_=0)), 0)
+
+    total, public, recent = db.session.query(
+        db.func.count(Comparison.id),
+        count_if(Comparison.is_public.is_(True)),
+        count_if(Comparison.created_at >= recent_since)
+    ).one()
+
+    total_users, admin_users = db.session.query(
+        db.func.count(User.id),
+        count_if(User.role == 'admin')
+    ).one()
+
+    day = db.func.date(Comparison.created_at)
+    per_day = dict(db.session.query(day, db.func.count(Comparison.id)).filter(
+        Comparison.created_at >= window_start
+    ).group_by(day).all())
+
+    # Most recent day first, with empty days filled in
+    daily_activity = []
+    for i in range(days):
+        date = today - datetime.timedelta(days=i)
+        daily_activity.append({
+            'date': date.strftime('%Y-%m-%d'),
+            'day': date.strftime('%a'),
+            'count': per_day.get(date.strftime('%Y-%m-%d'), per_day.get(date, 0))
+        })
+
+    top = db.session.query(
+        User.username,
+        db.func.count(Comparison.id).label('count')
+    ).join(
+        Comparison, User.id == Comparison.user_id
+    ).group_by(
+        User.username
+    ).order_by(
+        db.func.count(Comparison.id).desc()
+    ).limit(top_users).all()
+
+    return {
+        'comparison_stats': {
+            'total': total,
+            'public': public,
+            'private': total - public
+        },
+        'user_stats': {
+            'total': total_users,
+            'admin': admin_users,
+            'regular': total_users - admin_users
+        },
+        'activity': {
+            'days': days,
+            'recent': recent,
+            'daily': daily_activity
+        },
+        'top_users': [{'username': username, 'count': count} for username, count in top]
+    }
@@ -0,0 +1,283 @@
+# storage.py - Per-user quotas and garbage collection of uploads and outputs
+#
+# Every Comparison row carries the bytes its files take on disk
+# (storage_bytes), and a user's usage is the sum over their rows; uploads are
+# refused once a user is over their quota. Files shared through the result
+# cache count for every row that uses them.
+#
+# collect() reconciles the folders with the database: it drops the rendered
+# outputs that are past OUTPUT_RETENTION_DAYS (the inputs are kept, so the
+# outputs are rendered again when asked for), clears output paths whose files
+# are gone, removes every file no row, cache entry or unfinished job refers to
+# (failed jobs, half-finished uploads, deletes that could not remove a file)
+# and re-counts storage_bytes. A daemon thread runs it every
+# STORAGE_GC_INTERVAL seconds, at most one process at a time.
+#
+# Usage:
+#   python storage.py  (one collection pass, printed as JSON)
+import datetime
+import json
+import logging
+import os
+import re
+import threading
+import time
+from derivatives import derivative_paths
+from jobs import PENDING, RUNNING
+from regions import region_zoom_paths
+from result_cache import INPUT_COLUMNS, OUTPUT_COLUMNS, PATH_COLUMNS, artifact_name
+from sharding import shard_directory
+
+try:
+    import fcntl
+except ImportError:  # Windows: passes are not serialized across processes
+    fcntl = None
+
+REGION_ZOOM_NAME = re.compile(r'(.+)_region[0-9]+\.[^.]+$')
+
+logger = logging.getLogger(__name__)
+
+def file_size(path):
+    """Returns the size of the file at path, or 0 if there is none."""
+    try:
+        return os.path.getsize(path) if path else 0
+    except OSError:
+        return 0
+
+def _files(folder):
+    """Yields a DirEntry for every file under folder, skipping hidden directories (.locks)."""
+    try:
+        entries = list(os.scandir(folder))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if not entry.name.startswith('.'):
+                yield from _files(entry.path)
+        elif entry.is_file(follow_symlinks=False):
+            yield entry
+
+class Storage:
+    """
+    Accounts the disk usage of comparisons and collects files nothing refers to.
+
+    The collector thread starts with the first request, so importing the app
+    (or forking worker processes) never starts it by accident.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.db = None
+        self.comparison_model = None
+        self.input_model = None
+        self.entry_model = None
+        self.job_model = None
+        self.result_cache = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app, db, comparison_model, input_model, entry_model, job_model, result_cache):
+        app.config.setdefault('STORAGE_QUOTA_BYTES', None)
+        app.config.setdefault('STORAGE_GC_INTERVAL', None)
+        app.config.setdefault('STORAGE_GC_GRACE_SECONDS', 3600)
+        app.config.setdefault('OUTPUT_RETENTION_DAYS', None)
+        self.app = app
+        self.db = db
+        self.comparison_model = comparison_model
+        self.input_model = input_model
+        self.entry_model = entry_model
+        self.job_model = job_model
+        self.result_cache = result_cache
+        app.before_request(self._ensure_started)
+        app.extensions['storage'] = self
+
+    def usage(self, user_id):
+        """Returns the bytes the comparisons of a user take on disk."""
+        Comparison = self.comparison_model
+        return self.db.session.query(self.db.func.coalesce(self.db.func.sum(Comparison.storage_bytes), 0)).filter(
+            Comparison.user_id == user_id
+        ).scalar()
+
+    def quota(self, user):
+        """Returns the quota of user in bytes (their own, else STORAGE_QUOTA_BYTES), or None for no limit."""
+        if user.storage_quota is not None:
+            return user.storage_quota
+        return self.app.config['STORAGE_QUOTA_BYTES']
+
+    def allows(self, user, incoming=0):
+        """True if user may store incoming more bytes."""
+        quota = self.quota(user)
+        return quota is None or self.usage(user.id) + incoming <= quota
+
+    def account(self, comparison):
+        """Sets comparison.storage_bytes to the size of its files, their derivatives and its region zooms."""
+        extra = [row.path for row in comparison.inputs if row.position >= len(INPUT_COLUMNS) and row.path]
+        paths = set(self._paths_of(comparison, extra))
+        paths.update(region_zoom_paths(self._zoom_directory(comparison), artifact_name(comparison)))
+        paths.update(region_zoom_paths(self.app.config['OUTPUT_FOLDER'], artifact_name(comparison)))
+        comparison.storage_bytes = sum(file_size(path) for path in paths)
+
+    def collect(self):
+        """
+        Runs one collection pass and returns what it did.
+
+        Files younger than STORAGE_GC_GRACE_SECONDS are never removed, so a
+        comparison that is being uploaded or rendered right now keeps its
+        files even before its row or job points at them.
+
+        Returns:
+            dict with the number of comparisons whose outputs expired, output
+            paths cleared because their file was gone, rows missing an input,
+            orphaned files removed and their bytes, and rows accounted.
+        """
+        stats = {'expired': 0, 'dangling': 0, 'missing_inputs': 0, 'orphans': 0, 'orphan_bytes': 0,
+                 'accounted': 0}
+        days = self.app.config['OUTPUT_RETENTION_DAYS']
+        if days is not None:
+            stats['expired'] = self.result_cache.expire(datetime.datetime.utcnow() - datetime.timedelta(days=days))
+            self.db.session.commit()
+
+        # Paths are read before the folders are walked: a file written in between is within the grace period
+        referenced, zoom_names = self._referenced()
+        prefixes = tuple(f"{job.uid}_" for job in self.job_model.query.filter(
+            self.job_model.status.in_((PENDING, RUNNING))))
+        cutoff = time.time() - self.app.config['STORAGE_GC_GRACE_SECONDS']
+        sizes, zoom_bytes = {}, {}
+        for folder in (self.app.config['UPLOAD_FOLDER'], self.app.config['OUTPUT_FOLDER']):
+            for entry in _files(folder):
+                path = os.path.normpath(entry.path)
+                stat = entry.stat(follow_symlinks=False)
+                zoom = REGION_ZOOM_NAME.match(entry.name)
+                if path in referenced or (zoom and zoom.group(1) in zoom_names):
+                    sizes[path] = stat.st_size
+                    if zoom:
+                        zoom_bytes[zoom.group(1)] = zoom_bytes.get(zoom.group(1), 0) + stat.st_size
+                # ctime too: a batch input hard-linked in just now keeps the mtime of its source
+                elif max(stat.st_mtime, stat.st_ctime) < cutoff and not entry.name.startswith(prefixes):
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        continue
+                    except OSError as exc:
+                        logger.warning('Could not remove %s: %s', entry.path, exc)
+                        continue
+                    stats['orphans'] += 1
+                    stats['orphan_bytes'] += stat.st_size
+
+        self._reconcile(sizes, zoom_bytes, stats)
+        self.db.session.commit()
+        return stats
+
+    def _paths_of(self, row, extra=()):
+        """Yields the files a Comparison row or cache entry refers to, and extra, with every derivative they may have."""
+        for path in [getattr(row, column) for column in PATH_COLUMNS] + list(extra):
+            if path:
+                yield path
+                yield from derivative_paths(path)
+
+    def _extra_inputs(self):
+        """Returns the paths of the candidates after the first one (see ComparisonInput), by comparison id."""
+        Input = self.input_model
+        extra = {}
+        query = self.db.session.query(Input.comparison_id, Input.path).filter(
+            Input.position >= len(INPUT_COLUMNS), Input.path.isnot(None))
+        for comparison_id, path in query:
+            extra.setdefault(comparison_id, []).append(path)
+        return extra
+
+    def _zoom_directory(self, comparison):
+        return shard_directory(self.app.config['OUTPUT_FOLDER'], artifact_name(comparison), create=False)
+
+    def _referenced(self):
+        """Returns the normalized paths rows and cache entries refer to, and the names their region zooms use."""
+        referenced = set()
+        zoom_names = set()
+        extra = self._extra_inputs()
+        for model in (self.comparison_model, self.entry_model):
+            for row in model.query.yield_per(1000):
+                if model is self.entry_model:
+                    referenced.update(os.path.normpath(path) for path in self._paths_of(row))
+                    zoom_names.add(row.key)
+                else:
+                    referenced.update(os.path.normpath(path) for path in self._paths_of(row, extra.get(row.id, ())))
+                    zoom_names.add(artifact_name(row))
+        return referenced, zoom_names
+
+    def _reconcile(self, sizes, zoom_bytes, stats):
+        """Clears output paths whose file is gone and re-counts storage_bytes from the sizes found on disk."""
+        def exists(path):
+            return os.path.normpath(path) in sizes or os.path.exists(path)
+
+        for entry in self.entry_model.query.yield_per(1000):
+            gone = [column for column in OUTPUT_COLUMNS if getattr(entry, column) and not exists(getattr(entry, column))]
+            for column in gone:
+                setattr(entry, column, None)
+            stats['dangling'] += len(gone)
+
+        extra = self._extra_inputs()
+        for comparison in self.comparison_model.query.yield_per(1000):
+            inputs = [getattr(comparison, column) for column in INPUT_COLUMNS] + extra.get(comparison.id, [])
+            gone = [column for column in OUTPUT_COLUMNS
+                    if getattr(comparison, column) and not exists(getattr(comparison, column))]
+            for column in gone:
+                setattr(comparison, column, None)
+            stats['dangling'] += len(gone)
+            if any(path and not exists(path) for path in inputs):
+                logger.warning('Comparison %s is missing an input image', comparison.id)
+                stats['missing_inputs'] += 1
+            paths = {os.path.normpath(path) for path in self._paths_of(comparison, extra.get(comparison.id, ()))}
+            total = sum(sizes.get(path, 0) for path in paths) + zoom_bytes.get(artifact_name(comparison), 0)
+            if comparison.storage_bytes != total:
+                comparison.storage_bytes = total
+            stats['accounted'] += 1
+
+    def _ensure_started(self):
+        if self.app.config['STORAGE_GC_INTERVAL'] is None:
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._collect_loop, name='storage-gc', daemon=True)
+            self._thread.start()
+
+    def _collect_loop(self):
+        while True:
+            time.sleep(self.app.config['STORAGE_GC_INTERVAL'])
+            try:
+                with self.app.app_context():
+                    stats = self._collect_exclusively()
+                    if stats is not None:
+                        logger.info('Storage collection: %s', stats)
+            except Exception:
+                logger.exception('Storage collection failed')
+
+    def _collect_exclusively(self):
+        """Runs collect() unless another process is already running it; returns its stats or None."""
+        if fcntl is None:
+            return self.collect()
+        lock_dir = os.path.join(self.app.config['OUTPUT_FOLDER'], '.locks')
+        os.makedirs(lock_dir, exist_ok=True)
+        with open(os.path.join(lock_dir, 'gc.lock'), 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            try:
+                return self.collect()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+storage = Storage()
+
+def main():
+    # Imported here so the module can be imported by the app itself
+    from app import app
+    with app.app_context():
+        stats = storage._collect_exclusively()
+    if stats is None:
+        print('Another collection pass is running', flush=True)
+    else:
+        print(json.dumps(stats, indent=2))
+
+if __name__ == '__main__':
+    main()
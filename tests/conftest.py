@@ -0,0 +1,30 @@
+# tests/conftest.py - The app on a scratch SQLite database, with comparisons run inline
+# and its upload and output folders under each test's tmp_path
+import os
+import tempfile
+import pytest
+
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='image-compare-tests-'), 'app.db')
+os.environ['COMPARISON_JOBS_SYNC'] = '1'
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """The Flask app, with empty tables and its static folders in tmp_path."""
+    monkeypatch.chdir(tmp_path)
+    import app as module
+    for folder in (module.app.config['UPLOAD_FOLDER'], module.app.config['OUTPUT_FOLDER']):
+        os.makedirs(folder, exist_ok=True)
+    with module.app.app_context():
+        module.db.session.remove()
+        module.db.drop_all()
+        module.db.create_all()
+    module.admin_stats_cache.clear()
+    return module
+
+@pytest.fixture
+def client(app):
+    """A test client logged in as 'alice', the first (admin) user."""
+    client = app.app.test_client()
+    client.post('/register', data={'username': 'alice', 'email': 'alice@example.com', 'password': 'secret'})
+    client.post('/login', data={'username': 'alice', 'password': 'secret'})
+    return client
@@ -0,0 +1,38 @@
+# tests/helpers.py - Images and uploads shared by the tests that drive the app
+import datetime
+import io
+import uuid
+import cv2
+import numpy as np
+
+def png_bytes(changed=(), size=(400, 300)):
+    """A noisy PNG, with each (top, left, bottom, right) box in changed painted red."""
+    rng = np.random.default_rng(0)
+    img = cv2.resize(rng.integers(0, 256, (30, 40, 3), dtype=np.uint8), size)
+    for top, left, bottom, right in changed:
+        img[top:bottom, left:right] = (0, 0, 255)
+    return cv2.imencode('.png', img)[1].tobytes()
+
+def upload(client, *images, **form):
+    """POSTs images (PNG bytes) to /compare as the baseline and its candidates."""
+    data = {'title': 'pair', 'description': '', 'is_public': 'on'}
+    data.update(form)
+    data['image1'] = (io.BytesIO(images[0]), 'baseline.png')
+    data['image2'] = [(io.BytesIO(image), f"candidate{n}.png") for n, image in enumerate(images[1:], 1)]
+    return client.post('/compare', data=data, content_type='multipart/form-data')
+
+def add_user(app, username, role='user'):
+    """Adds a user (password 'secret') and commits it. Needs an app context."""
+    user = app.User(username=username, email=f"{username}@example.com", role=role)
+    user.set_password('secret')
+    app.db.session.add(user)
+    app.db.session.commit()
+    return user
+
+def add_comparisons(app, user, count, start, step=datetime.timedelta(hours=1), is_public=False):
+    """Adds count comparisons of user without files, created step apart from start. Returns their ids."""
+    comparisons = [app.Comparison(user_id=user.id, title=f"{user.username} {n}", uid=uuid.uuid4().hex,
+                                  created_at=start + n * step, is_public=is_public) for n in range(count)]
+    app.db.session.add_all(comparisons)
+    app.db.session.commit()
+    return [comparison.id for comparison in comparisons]
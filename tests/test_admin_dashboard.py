@@ -0,0 +1,56 @@
+# tests/test_admin_dashboard.py - Aggregate counts and paged listings of the admin dashboard
+import datetime
+import re
+from helpers import add_comparisons, add_user
+
+START = datetime.datetime(2026, 1, 1)
+
+def dashboard_pages(client, url):
+    """Follows the "Older comparisons" links from url; returns each page's titles and the first page's HTML."""
+    titles, first = [], None
+    while url:
+        html = client.get(url).get_data(as_text=True)
+        first = first or html
+        titles.append(re.findall(r'<td>((?:alice|bob) \d+)</td>', html))
+        more = re.search(r'href="(/admin/dashboard\?[^"]*cursor=[^"]+)"', html)
+        url = more.group(1).replace('&amp;', '&') if more else None
+    return titles, first
+
+def test_dashboard_counts_and_pages_through_every_comparison(app, client, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'LISTING_PAGE_SIZE', 2)
+    with app.app.app_context():
+        alice = app.User.query.filter_by(username='alice').one()
+        add_comparisons(app, alice, 2, START)
+        add_comparisons(app, add_user(app, 'bob'), 3, START + datetime.timedelta(minutes=30), is_public=True)
+
+    titles, html = dashboard_pages(client, '/admin/dashboard')
+    assert titles == [['bob 2', 'bob 1'], ['alice 1', 'bob 0'], ['alice 0']]
+    counts = [int(count) for count in re.findall(r'class="card-text display-6">(\d+)<', html)]
+    assert counts == [5, 2, 3, 2]  # comparisons, users, public, private
+
+    titles, _ = dashboard_pages(client, '/admin/dashboard?visibility=private')
+    assert titles == [['alice 1', 'alice 0']]
+
+def test_user_comparisons_api_pages_with_cursors(app, client):
+    with app.app.app_context():
+        bob = add_user(app, 'bob')
+        ids = add_comparisons(app, bob, 5, START)
+        url = f"/api/admin/users/{bob.id}/comparisons"
+
+    pages, cursor = [], None
+    while True:
+        data = client.get(url, query_string={'per_page': 2, 'cursor': cursor}).get_json()
+        pages.append([comparison['id'] for comparison in data['comparisons']])
+        cursor = data['next_cursor']
+        if cursor is None:
+            break
+    assert pages == [ids[:2:-1], ids[2:0:-1], ids[:1]]
+    assert client.get(url, query_string={'cursor': 'not-a-cursor'}).status_code == 400
+
+def test_dashboard_is_for_admins_only(app, client):
+    with app.app.app_context():
+        add_user(app, 'bob')
+    client.get('/logout')
+    client.post('/login', data={'username': 'bob', 'password': 'secret'})
+    assert client.get('/admin/dashboard').status_code != 200
+    assert client.get('/api/admin/users/1/comparisons').status_code == 403
@@ -0,0 +1,31 @@
+# tests/test_admin_stats.py - The admin statistics and their activity window
+import datetime
+from helpers import add_comparisons, add_user
+
+def test_recent_counts_a_rolling_window(app, client):
+    now = datetime.datetime.utcnow()
+    with app.app.app_context():
+        bob = add_user(app, 'bob')
+        for age in (datetime.timedelta(hours=1), datetime.timedelta(days=7, hours=-1),
+                    datetime.timedelta(days=7, hours=1), datetime.timedelta(days=30)):
+            add_comparisons(app, bob, 1, now - age, is_public=age < datetime.timedelta(days=7))
+
+    stats = client.get('/api/admin/stats').get_json()
+    assert stats['activity']['recent'] == 2
+    assert stats['comparison_stats'] == {'total': 4, 'public': 2, 'private': 2}
+    assert stats['user_stats'] == {'total': 2, 'admin': 1, 'regular': 1}
+    assert stats['top_users'] == [{'username': 'bob', 'count': 4}]
+    daily = stats['activity']['daily']
+    assert len(daily) == 7
+    assert daily[0]['date'] == now.strftime('%Y-%m-%d')
+
+    stats = client.get('/api/admin/stats', query_string={'days': 31}).get_json()
+    assert (stats['activity']['days'], stats['activity']['recent']) == (31, 4)
+    assert sum(day['count'] for day in stats['activity']['daily']) == 4
+
+def test_stats_are_cached_per_window(app, client):
+    assert client.get('/api/admin/stats').get_json()['comparison_stats']['total'] == 0
+    with app.app.app_context():
+        add_comparisons(app, add_user(app, 'bob'), 1, datetime.datetime.utcnow())
+    assert client.get('/api/admin/stats').get_json()['comparison_stats']['total'] == 0
+    assert client.get('/api/admin/stats?days=2').get_json()['comparison_stats']['total'] == 1
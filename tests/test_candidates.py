@@ -0,0 +1,68 @@
+# tests/test_candidates.py - A baseline against several candidates, and animated inputs frame by frame
+import io
+import os
+import numpy as np
+from PIL import Image
+from helpers import png_bytes, upload
+
+def comparison_id(response):
+    return int(response.headers['Location'].rsplit('/', 1)[1])
+
+def animated_gif(changed_frame=None, frames=3):
+    """A GIF of frames flat gray frames, with a white box on changed_frame."""
+    images = []
+    for n in range(frames):
+        img = np.full((120, 160, 3), 40 * (n + 1), dtype=np.uint8)
+        if n == changed_frame:
+            img[20:60, 30:90] = 255
+        images.append(Image.fromarray(img))
+    buffer = io.BytesIO()
+    images[0].save(buffer, 'GIF', save_all=True, append_images=images[1:], duration=100, loop=0)
+    return buffer.getvalue()
+
+def test_every_candidate_is_measured_against_the_baseline(app, client):
+    baseline = png_bytes()
+    candidates = [png_bytes(), png_bytes([(10, 10, 30, 30)]), png_bytes([(50, 50, 250, 350)])]
+    response = upload(client, baseline, *candidates)
+    with app.app.app_context():
+        comparison = app.db.session.get(app.Comparison, comparison_id(response))
+        inputs = comparison.inputs
+        assert comparison.cache_key is None  # sets are never cached
+        assert [row.position for row in inputs] == [0, 1, 2, 3]
+        assert inputs[0].max_delta_e is None
+        assert inputs[1].max_delta_e == 0 and inputs[1].within_tolerance
+        assert 0 < inputs[2].changed_ratio < inputs[3].changed_ratio
+        assert inputs[3].within_tolerance is False
+        # The set takes the worst of its candidates
+        assert comparison.max_delta_e == max(row.max_delta_e for row in inputs[1:])
+        assert comparison.changed_ratio == inputs[3].changed_ratio
+        assert comparison.within_tolerance is False
+        extra = [row.path for row in inputs[2:]]
+
+    status = client.get(f"/api/comparison/{comparison_id(response)}/status").get_json()
+    assert [candidate['position'] for candidate in status['candidates']] == [1, 2, 3]
+    assert status['candidates'][0]['max_delta_e'] == 0
+
+    client.get(f"/delete/{comparison_id(response)}")
+    assert not any(os.path.exists(path) for path in extra)
+
+def test_animated_inputs_are_compared_frame_by_frame(app, client):
+    response = upload(client, animated_gif(), animated_gif(changed_frame=2))
+    with app.app.app_context():
+        candidate = app.db.session.get(app.Comparison, comparison_id(response)).inputs[1]
+        assert (candidate.frame_count, candidate.frames_compared, candidate.worst_frame) == (3, 3, 2)
+        assert candidate.max_delta_e > 0
+
+def test_candidate_with_missing_frames_is_out_of_tolerance(app, client):
+    response = upload(client, animated_gif(), animated_gif(frames=2))
+    with app.app.app_context():
+        candidate = app.db.session.get(app.Comparison, comparison_id(response)).inputs[1]
+        assert candidate.frames_compared == 2
+        assert candidate.within_tolerance is False
+
+def test_too_many_candidates_are_refused(app, client, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'MAX_CANDIDATES', 2)
+    response = upload(client, png_bytes(), png_bytes(), png_bytes(), png_bytes())
+    assert response.headers['Location'].endswith('/compare')
+    with app.app.app_context():
+        assert app.Comparison.query.count() == 0
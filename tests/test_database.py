@@ -0,0 +1,50 @@
+# tests/test_database.py - Engine settings, SQLite pragmas and the listing indexes
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from database import DEFAULT_SQLITE_PRAGMAS, apply_sqlite_pragmas, database_url, engine_options
+from migrations import upgrade_schema
+
+LISTING_INDEXES = {'ix_comparison_public_created', 'ix_comparison_user_created', 'ix_comparison_created'}
+
+def test_database_url_and_engine_options():
+    assert database_url('postgres://u:p@host/db') == 'postgresql://u:p@host/db'
+    assert database_url('sqlite:///app.db') == 'sqlite:///app.db'
+    assert engine_options('sqlite:///app.db') == {'connect_args': {'timeout': 30.0}}
+    assert engine_options('postgresql://u:p@host/db') == {'pool_pre_ping': True, 'pool_recycle': 1800}
+
+@pytest.mark.parametrize('name, expected', [
+    ('journal_mode', 'wal'),
+    ('synchronous', 1),
+    ('busy_timeout', 30000),
+    ('cache_size', -64000),
+    ('temp_store', 2),
+])
+def test_pragmas_apply_to_every_connection(tmp_path, name, expected):
+    engine = create_engine(f"sqlite:///{tmp_path / 'pragmas.db'}")
+    apply_sqlite_pragmas(engine, DEFAULT_SQLITE_PRAGMAS)
+    for _ in range(2):
+        with engine.connect() as conn:
+            assert conn.exec_driver_sql(f'PRAGMA {name}').scalar() == expected
+        engine.dispose()
+
+def test_app_engine_uses_wal(app):
+    with app.app.app_context():
+        assert app.db.session.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+
+def test_upgrade_adds_missing_listing_indexes(app):
+    with app.app.app_context():
+        with app.db.engine.begin() as conn:
+            for name in LISTING_INDEXES:
+                conn.exec_driver_sql(f'DROP INDEX {name}')
+        upgrade_schema(app.db)
+        indexes = {index['name'] for index in inspect(app.db.engine).get_indexes('comparison')}
+    assert LISTING_INDEXES <= indexes
+
+def test_public_feed_is_read_from_its_index(app):
+    with app.app.app_context():
+        query = app.Comparison.query.filter(app.Comparison.is_public.is_(True)).order_by(
+            app.Comparison.created_at.desc(), app.Comparison.id.desc()).limit(50)
+        sql = str(query.statement.compile(app.db.engine, compile_kwargs={'literal_binds': True}))
+        plan = ' '.join(row[-1] for row in app.db.session.execute(text(f'EXPLAIN QUERY PLAN {sql}')))
+    assert 'ix_comparison_public_created' in plan
+    assert 'TEMP B-TREE' not in plan
@@ -0,0 +1,70 @@
+# tests/test_encoding.py - Output formats, quality presets and their effect on the artifacts
+import os
+import cv2
+import numpy as np
+import pytest
+from encoding import (DEFAULT_PRESET, ENCODING_PRESETS, artifact_encoding, encoding_options, parse_encoding,
+                      resolve_encoding, write_image)
+from helpers import png_bytes, upload
+from jobs import comparison_options
+
+def test_parse_keeps_only_what_was_chosen():
+    assert parse_encoding({'overlay_format': 'WebP', 'animation_format': '', 'encoding_quality': '70'}) == {
+        'overlay_format': 'webp', 'encoding_quality': 70}
+
+@pytest.mark.parametrize('values', [
+    {'overlay_format': 'gif'},  # not a still format
+    {'animation_format': 'jpeg'},
+    {'encoding_preset': 'tiny'},
+    {'encoding_quality': '0'},
+    {'encoding_quality': '101'},
+])
+def test_parse_rejects_bad_values(values):
+    with pytest.raises(ValueError):
+        parse_encoding(values)
+
+def test_defaults_stay_out_of_the_rendering_options(app):
+    assert encoding_options({'overlay_format': 'jpeg', 'animation_format': 'gif',
+                             'encoding_preset': DEFAULT_PRESET}) == {}
+    assert not any('format' in key or 'encoding' in key for key in comparison_options(app.app.config))
+    assert comparison_options(app.app.config, {'encoding_preset': 'small'})['encoding_preset'] == 'small'
+
+@pytest.mark.parametrize('preset', list(ENCODING_PRESETS))
+def test_presets_set_quality_and_effort(preset):
+    encoding = artifact_encoding({'overlay_format': 'webp', 'encoding_preset': preset}, 'overlay')
+    assert encoding == {'format': 'webp', 'quality': ENCODING_PRESETS[preset]['quality']['webp'],
+                        'effort': ENCODING_PRESETS[preset]['effort']}
+    assert artifact_encoding({'encoding_preset': preset, 'encoding_quality': 42}, 'zoom')['quality'] == 42
+
+def test_frames_too_large_for_webp_fall_back_to_jpeg():
+    options = {'overlay_format': 'webp'}
+    assert artifact_encoding(options, 'overlay', longest_side=16383)['format'] == 'webp'
+    assert artifact_encoding(options, 'overlay', longest_side=16384)['format'] == 'jpeg'
+
+def test_smaller_presets_write_smaller_files(tmp_path):
+    img = cv2.imdecode(np.frombuffer(png_bytes([(10, 10, 60, 90)]), np.uint8), cv2.IMREAD_COLOR)
+    sizes = [write_image(str(tmp_path / f"{preset}.jpg"), img, resolve_encoding('jpeg', preset))
+             for preset in ('high', 'balanced', 'small')]
+    assert sizes[0] > sizes[1] > sizes[2]
+    for fmt, ext in (('webp', '.webp'), ('png', '.png')):
+        path = str(tmp_path / f"image{ext}")
+        write_image(path, img, resolve_encoding(fmt))
+        assert cv2.imread(path).shape == img.shape
+
+def test_comparison_renders_in_the_chosen_formats(app, client, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'RENDER_ARTIFACTS_EAGERLY', True)
+    location = upload(client, png_bytes(), png_bytes([(10, 10, 60, 90)]), overlay_format='webp',
+                      animation_format='webp', encoding_preset='small').headers['Location']
+    with app.app.app_context():
+        comparison = app.db.session.get(app.Comparison, int(location.rsplit('/', 1)[1]))
+        assert comparison.output_encoding == {'overlay_format': 'webp', 'animation_format': 'webp',
+                                              'encoding_preset': 'small'}
+        paths = [comparison.color_diff1_path, comparison.gray_diff2_path, comparison.gif_path]
+    assert [os.path.splitext(path)[1] for path in paths] == ['.webp'] * 3
+
+def test_invalid_format_is_rejected_before_anything_is_stored(app, client):
+    response = upload(client, png_bytes(), png_bytes(), overlay_format='bmp')
+    assert response.headers['Location'].endswith('/compare')
+    with app.app.app_context():
+        assert app.Comparison.query.count() == 0
+    assert [name for name in os.listdir(app.app.config['UPLOAD_FOLDER']) if not name.startswith('.')] == []
@@ -0,0 +1,31 @@
+# tests/test_instrumentation.py - Stage timings reach /metrics and slow jobs are profiled
+import os
+import uuid
+from helpers import add_user, png_bytes, upload
+from jobs import DONE, job_runner
+
+def test_metrics_report_the_stages_of_a_comparison(app, client):
+    upload(client, png_bytes(), png_bytes([(10, 10, 60, 90)]))
+    text = client.get('/metrics').get_data(as_text=True)
+    for stage in ('decode', 'lab', 'delta_e', 'metrics', 'regions'):
+        assert f'imgcmp_stage_seconds_count{{stage="{stage}"}}' in text, stage
+    assert 'imgcmp_jobs{status="done"} 1' in text
+
+def test_inline_jobs_are_profiled(app, tmp_path, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'PROFILE_DIR', str(tmp_path / 'profiles'))
+    monkeypatch.setitem(app.app.config, 'PROFILE_SLOW_SECONDS', 0.0)
+    paths = []
+    for n, image in enumerate((png_bytes(), png_bytes([(10, 10, 60, 90)])), 1):
+        paths.append(str(tmp_path / f"image{n}.png"))
+        with open(paths[-1], 'wb') as f:
+            f.write(image)
+    with app.app.app_context():
+        comparison = app.Comparison(user=add_user(app, 'bob'), uid=uuid.uuid4().hex,
+                                    image1_path=paths[0], image2_path=paths[1])
+        uid = comparison.uid
+        job = job_runner.enqueue(comparison, uid)
+        app.db.session.commit()
+        job_runner.wake()
+        app.db.session.expire_all()
+        assert job.status == DONE
+    assert [name for name in os.listdir(tmp_path / 'profiles') if f"job_{uid}" in name]
@@ -0,0 +1,87 @@
+# tests/test_jobs.py - Claiming, failing and requeueing comparison jobs
+import datetime
+import uuid
+import cv2
+import numpy as np
+from sqlalchemy import event, text
+from jobs import DONE, FAILED, PENDING, RUNNING, job_runner
+
+def add_comparison(app, folder, broken=False):
+    """A comparison of two small images written to folder, owned by a fresh user."""
+    user = app.User(username=f"user{app.User.query.count()}")
+    paths = [str(folder / f"image{n}.png") for n in (1, 2)]
+    if not broken:
+        img = np.full((60, 80, 3), 128, dtype=np.uint8)
+        cv2.imwrite(paths[0], img)
+        img[10:30, 10:40] = (0, 0, 255)
+        cv2.imwrite(paths[1], img)
+    comparison = app.Comparison(user=user, title='job', uid=uuid.uuid4().hex,
+                                image1_path=paths[0], image2_path=paths[1])
+    app.db.session.add(comparison)
+    return comparison
+
+def add_job(app, comparison, status=PENDING, started_at=None):
+    job = job_runner.enqueue(comparison, comparison.uid)
+    job.status = status
+    job.started_at = started_at
+    app.db.session.commit()
+    return job
+
+def test_claims_pending_jobs_oldest_first_and_once(app, tmp_path):
+    with app.app.app_context():
+        comparison = add_comparison(app, tmp_path)
+        add_job(app, comparison, status=RUNNING)
+        first, second = add_job(app, comparison), add_job(app, comparison)
+        ids = [first.id, second.id]
+        assert job_runner._claim_next().id == ids[0]
+        assert job_runner._claim_next().id == ids[1]
+        assert job_runner._claim_next() is None
+        statuses = {job.id: job.status for job in app.ComparisonJob.query}
+        assert [statuses[job_id] for job_id in ids] == [RUNNING, RUNNING]
+
+def test_claim_skips_a_job_taken_by_another_worker(app, tmp_path):
+    with app.app.app_context():
+        comparison = add_comparison(app, tmp_path)
+        first, second = add_job(app, comparison), add_job(app, comparison)
+        ids = [first.id, second.id]
+        races = []
+
+        def claim_elsewhere(state):
+            # Another worker claims the job between this one's SELECT and UPDATE
+            if state.is_update and not races:
+                races.append(ids[0])
+                state.session.execute(text("UPDATE comparison_job SET status = 'running' WHERE id = :id"),
+                                      {'id': ids[0]})
+
+        event.listen(app.db.session, 'do_orm_execute', claim_elsewhere)
+        try:
+            job = job_runner._claim_next()
+        finally:
+            event.remove(app.db.session, 'do_orm_execute', claim_elsewhere)
+        assert races == [ids[0]]
+        assert job.id == ids[1]
+
+def test_failed_job_records_the_error(app, tmp_path):
+    with app.app.app_context():
+        job_id = add_job(app, add_comparison(app, tmp_path, broken=True)).id
+        job_runner.wake()
+        app.db.session.expire_all()  # the job was finished in a session of its own
+        job = app.db.session.get(app.ComparisonJob, job_id)
+        assert job.status == FAILED
+        assert job.error
+        assert job.finished_at is not None
+
+def test_stale_running_job_is_requeued_and_rerun(app, tmp_path):
+    with app.app.app_context():
+        stale_since = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=app.app.config['JOB_STALE_SECONDS'] + 60)
+        comparison = add_comparison(app, tmp_path)
+        stale = add_job(app, comparison, status=RUNNING, started_at=stale_since).id
+        fresh = add_job(app, comparison, status=RUNNING, started_at=datetime.datetime.utcnow()).id
+        job_runner._requeue_stale()
+        assert app.db.session.get(app.ComparisonJob, stale).status == PENDING
+        assert app.db.session.get(app.ComparisonJob, fresh).status == RUNNING
+        job_runner.wake()
+        app.db.session.expire_all()  # the job was finished in a session of its own
+        assert app.db.session.get(app.ComparisonJob, stale).status == DONE
+        assert app.db.session.get(app.Comparison, comparison.id).max_delta_e > 0
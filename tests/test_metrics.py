@@ -0,0 +1,23 @@
+# tests/test_metrics.py - Coarse-level shortcuts of measure_pair
+import numpy as np
+from image_compare import LoadedPair
+from metrics import measure_pair
+
+def striped_pair(size=1024):
+    """A black image and a copy with every third column white."""
+    img1 = np.zeros((size, size, 3), dtype=np.uint8)
+    img2 = img1.copy()
+    img2[:, ::3] = 255
+    return LoadedPair.from_images(img1, img2)
+
+def test_changed_ratio_is_measured_at_full_resolution():
+    metrics = measure_pair(striped_pair(), threshold=30, max_changed_ratio=0.5)
+    assert metrics['scale'] == 1.0
+    assert abs(metrics['changed_ratio'] - 342 / 1024) < 1e-9
+    assert metrics['within_tolerance'] is True
+
+def test_coarse_delta_e_settles_the_verdict():
+    metrics = measure_pair(striped_pair(), threshold=30, max_delta_e=2.3, max_changed_ratio=0.5)
+    assert metrics['scale'] < 1
+    assert metrics['within_tolerance'] is False
+    assert abs(metrics['changed_ratio'] - 342 / 1024) < 1e-9
@@ -0,0 +1,52 @@
+# tests/test_pagination.py - Keyset pages at their boundaries
+import datetime
+import pytest
+from helpers import add_comparisons, add_user
+from pagination import MAX_PER_PAGE, decode_cursor, encode_cursor, keyset_page
+
+START = datetime.datetime(2026, 1, 1, 12, 30, 15, 250000)
+
+def all_pages(app, per_page):
+    pages, cursor = [], None
+    while True:
+        page = keyset_page(app.Comparison.query, app.Comparison, cursor, per_page)
+        pages.append([comparison.id for comparison in page.items])
+        cursor = page.next_cursor
+        if not page.has_more:
+            return pages
+
+def test_cursor_round_trips():
+    assert decode_cursor(encode_cursor(START, 42)) == (START, 42)
+
+@pytest.mark.parametrize('cursor', ['', '!!!', encode_cursor(START, 1)[:-3], 'MjAyNi0wMS0wMQ'])
+def test_malformed_cursor_is_rejected(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+def test_rows_sharing_a_timestamp_are_split_across_pages(app):
+    with app.app.app_context():
+        ids = add_comparisons(app, add_user(app, 'bob'), 5, START, step=datetime.timedelta(0))
+        assert all_pages(app, 2) == [ids[:2:-1], ids[2:0:-1], ids[:1]]
+
+@pytest.mark.parametrize('count, per_page, sizes', [
+    (0, 2, [0]),
+    (4, 2, [2, 2]),  # a full last page has no cursor after it
+    (5, 5, [5]),
+    (6, 5, [5, 1]),
+])
+def test_last_page_has_no_cursor(app, count, per_page, sizes):
+    with app.app.app_context():
+        ids = add_comparisons(app, add_user(app, 'bob'), count, START)
+        pages = all_pages(app, per_page)
+    assert [len(page) for page in pages] == sizes
+    assert sum(pages, []) == ids[::-1]
+
+def test_per_page_is_clamped(app):
+    with app.app.app_context():
+        add_comparisons(app, add_user(app, 'bob'), MAX_PER_PAGE + 1, START)
+        assert len(keyset_page(app.Comparison.query, app.Comparison, per_page=0).items) == 50
+        assert len(keyset_page(app.Comparison.query, app.Comparison, per_page=10 ** 6).items) == MAX_PER_PAGE
+
+def test_bad_cursor_is_a_bad_request(app, client):
+    assert client.get('/', query_string={'cursor': '!!!'}).status_code == 400
+    assert client.get('/dashboard', query_string={'cursor': '!!!'}).status_code == 400
@@ -0,0 +1,56 @@
+# tests/test_regions.py - Changed regions: boxes, merging, limits and zoom images
+import cv2
+import numpy as np
+from helpers import png_bytes, upload
+from regions import ZOOM_GUTTER, ZOOM_MIN_SIDE, find_regions, render_zoom, scale_box
+
+def changed(img, *boxes):
+    img = img.copy()
+    for x, y, w, h in boxes:
+        img[y:y + h, x:x + w] = 255
+    return img
+
+BLACK = np.zeros((300, 400, 3), dtype=np.uint8)
+
+def test_regions_are_tight_boxes_largest_first():
+    result = find_regions(BLACK, changed(BLACK, (20, 30, 10, 10), (200, 100, 60, 40)))
+    assert result['frame'] == [400, 300]
+    assert result['total'] == 2
+    assert [(b['x'], b['y'], b['width'], b['height'], b['area']) for b in result['boxes']] == [
+        (200, 100, 60, 40, 2400), (20, 30, 10, 10, 100)]
+    assert all(b['mean_delta_e'] > 50 for b in result['boxes'])
+
+def test_nearby_blobs_merge_and_speckle_is_dropped():
+    img2 = changed(BLACK, (50, 50, 10, 10), (70, 50, 10, 10), (300, 200, 1, 1), (350, 250, 3, 3))
+    boxes = find_regions(BLACK, img2)['boxes']
+    assert [(b['x'], b['y'], b['width'], b['height'], b['area']) for b in boxes] == [(50, 50, 30, 10, 200)]
+
+def test_identical_images_have_no_regions():
+    assert find_regions(BLACK, BLACK) == {'frame': [400, 300], 'total': 0, 'boxes': []}
+
+def test_max_regions_keeps_the_largest_and_counts_all():
+    boxes = [(x, 20, 4 + x // 40, 10) for x in range(0, 400, 40)]
+    result = find_regions(BLACK, changed(BLACK, *boxes), max_regions=3)
+    assert result['total'] == 10
+    assert [b['x'] for b in result['boxes']] == [360, 320, 280]
+
+def test_boxes_scale_to_another_frame_and_zoom():
+    box = {'x': 100, 'y': 50, 'width': 20, 'height': 10}
+    assert scale_box(box, [400, 300], (800, 600)) == (200, 100, 40, 20)
+    zoom = render_zoom(BLACK, changed(BLACK, (100, 50, 20, 10)), (100, 50, 20, 10))
+    # A 68x58 crop (the box and its padding) is enlarged by a whole factor towards ZOOM_MIN_SIDE
+    scale = ZOOM_MIN_SIDE // 68
+    assert zoom.shape == (58 * scale, 2 * 68 * scale + ZOOM_GUTTER, 3)
+    assert zoom[:, 68 * scale:68 * scale + ZOOM_GUTTER].min() == 255
+
+def test_comparison_stores_regions_and_serves_their_zooms(app, client):
+    location = upload(client, png_bytes(), png_bytes([(40, 60, 100, 160), (200, 250, 260, 330)])).headers['Location']
+    with app.app.app_context():
+        regions = app.db.session.get(app.Comparison, int(location.rsplit('/', 1)[1])).regions
+    assert regions['total'] == 2
+    assert {(b['x'], b['y'], b['width'], b['height']) for b in regions['boxes']} == {(60, 40, 100, 60),
+                                                                                       (250, 200, 80, 60)}
+    response = client.get(f"{location}/region/1")
+    assert response.status_code == 200
+    assert cv2.imdecode(np.frombuffer(response.data, np.uint8), cv2.IMREAD_COLOR) is not None
+    assert client.get(f"{location}/region/2").status_code == 404
@@ -0,0 +1,67 @@
+# tests/test_registration.py - Registration estimates are stored with the comparison and reused
+import io
+import cv2
+import numpy as np
+import image_compare
+from image_compare import load_pair
+
+SHIFT = (7, -5)
+
+def shifted_pair(folder):
+    """A textured baseline and a copy shifted by SHIFT with a red box painted on."""
+    rng = np.random.default_rng(0)
+    img1 = cv2.resize(rng.integers(0, 256, (60, 80, 3), dtype=np.uint8), (400, 300), interpolation=cv2.INTER_CUBIC)
+    img2 = cv2.warpAffine(img1, np.float32([[1, 0, SHIFT[0]], [0, 1, SHIFT[1]]]), (400, 300),
+                          borderMode=cv2.BORDER_REFLECT)
+    img2[100:160, 150:250] = (0, 0, 255)
+    paths = [str(folder / f"img{n}.png") for n in (1, 2)]
+    for path, img in zip(paths, (img1, img2)):
+        cv2.imwrite(path, img)
+    return paths
+
+def refuse_estimate(*args):
+    raise AssertionError('the stored estimate was not used')
+
+def test_stored_estimate_applies_at_any_working_size(tmp_path, monkeypatch):
+    paths = shifted_pair(tmp_path)
+    estimated = load_pair(*paths, 200, 'translation')
+    assert estimated.registration['mode'] == 'translation'
+    matrix = np.array(estimated.registration['matrix'])
+    assert np.allclose(matrix[:2, 2], [-SHIFT[0], -SHIFT[1]], atol=1.0)  # native pixels
+    assert np.allclose(estimated.transform[:2, 2], matrix[:2, 2] / 2)
+
+    monkeypatch.setattr(image_compare, 'estimate_transform', refuse_estimate)
+    reused = load_pair(*paths, None, 'translation', estimated.registration)
+    assert reused.img1.shape == (300, 400, 3)
+    assert np.allclose(reused.transform, matrix)
+    assert reused.registration == estimated.registration
+
+def test_estimate_of_another_mode_is_not_reused(tmp_path):
+    paths = shifted_pair(tmp_path)
+    stored = load_pair(*paths, 200, 'translation').registration
+    assert load_pair(*paths, 200, 'similarity', stored).registration['mode'] == 'similarity'
+
+def test_failed_estimate_is_stored_too(tmp_path, monkeypatch):
+    paths = shifted_pair(tmp_path)
+    monkeypatch.setattr(image_compare, 'estimate_transform', refuse_estimate)
+    pair = load_pair(*paths, 200, 'translation', {'mode': 'translation', 'matrix': None})
+    assert pair.transform is None
+    assert pair.img2.shape == pair.img1.shape
+
+def test_artifacts_reuse_the_estimate_of_the_job(app, client, tmp_path, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'REGISTRATION', 'translation')
+    images = []
+    for path in shifted_pair(tmp_path):
+        with open(path, 'rb') as f:
+            images.append((io.BytesIO(f.read()), 'image.png'))
+    location = client.post('/compare', data={'title': 'shifted', 'image1': images[0], 'image2': images[1]},
+                           content_type='multipart/form-data').headers['Location']
+    with app.app.app_context():
+        comparison = app.db.session.get(app.Comparison, int(location.rsplit('/', 1)[1]))
+        assert comparison.registration['mode'] == 'translation'
+        assert comparison.registration['matrix'] is not None
+
+    monkeypatch.setattr(image_compare, 'estimate_transform', refuse_estimate)
+    for kind in ('color1', 'gray2', 'gif'):
+        assert client.get(f"{location}/artifact/{kind}").status_code == 200
+    assert client.get(f"{location}/region/0").status_code == 200
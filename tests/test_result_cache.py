@@ -0,0 +1,49 @@
+# tests/test_result_cache.py - Shared results are counted, released and evicted
+import os
+from helpers import png_bytes, upload
+from result_cache import INPUT_COLUMNS, OUTPUT_COLUMNS
+
+def comparison_id(response):
+    return int(response.headers['Location'].rsplit('/', 1)[1])
+
+def test_identical_uploads_share_files_until_the_last_is_deleted(app, client):
+    pair = (png_bytes(), png_bytes([(10, 10, 60, 90)]))
+    first, second = comparison_id(upload(client, *pair)), comparison_id(upload(client, *pair))
+    with app.app.app_context():
+        rows = [app.db.session.get(app.Comparison, id) for id in (first, second)]
+        key = rows[0].cache_key
+        assert key and rows[1].cache_key == key
+        inputs = [getattr(rows[0], column) for column in INPUT_COLUMNS]
+        assert [getattr(rows[1], column) for column in INPUT_COLUMNS] == inputs
+        assert app.db.session.get(app.ResultCacheEntry, key).refcount == 2
+
+    client.get(f"/delete/{first}")
+    with app.app.app_context():
+        assert app.db.session.get(app.ResultCacheEntry, key).refcount == 1
+    assert all(os.path.exists(path) for path in inputs)
+
+    client.get(f"/delete/{second}")
+    with app.app.app_context():
+        assert app.db.session.get(app.ResultCacheEntry, key) is None
+    assert not any(os.path.exists(path) for path in inputs)
+
+def test_least_recently_used_outputs_are_evicted_over_budget(app, client, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'RENDER_ARTIFACTS_EAGERLY', True)
+    old = comparison_id(upload(client, png_bytes(), png_bytes([(10, 10, 60, 90)])))
+    with app.app.app_context():
+        old_key = app.db.session.get(app.Comparison, old).cache_key
+        size = app.db.session.get(app.ResultCacheEntry, old_key).size_bytes
+    assert size > 0
+    monkeypatch.setitem(app.app.config, 'RESULT_CACHE_MAX_BYTES', size * 3 // 2)
+
+    new = comparison_id(upload(client, png_bytes(), png_bytes([(150, 200, 250, 350)])))
+    with app.app.app_context():
+        old_entry = app.db.session.get(app.ResultCacheEntry, old_key)
+        new_entry = app.db.session.get(app.ResultCacheEntry, app.db.session.get(app.Comparison, new).cache_key)
+        assert old_entry.size_bytes == 0
+        assert all(getattr(old_entry, column) is None for column in OUTPUT_COLUMNS)
+        assert all(getattr(app.db.session.get(app.Comparison, old), column) is None for column in OUTPUT_COLUMNS)
+        # The inputs stay, so the evicted outputs can be rendered again
+        assert all(os.path.exists(getattr(old_entry, column)) for column in INPUT_COLUMNS)
+        assert new_entry.size_bytes > 0
+        assert all(os.path.exists(getattr(new_entry, column)) for column in OUTPUT_COLUMNS)
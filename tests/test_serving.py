@@ -0,0 +1,27 @@
+# tests/test_serving.py - Files are tagged from stored hashes and names, and revalidate with 304
+import hashlib
+import os
+from helpers import png_bytes, upload
+
+def test_upload_is_tagged_with_its_stored_hash(app, client):
+    baseline = png_bytes()
+    response = upload(client, baseline, png_bytes([(10, 10, 60, 90)]))
+    with app.app.test_request_context():
+        comparison = app.db.session.get(app.Comparison, int(response.headers['Location'].rsplit('/', 1)[1]))
+        url = app.file_url(comparison.image1_path)
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.get_etag() == (hashlib.sha256(baseline).hexdigest(), False)
+    assert 'immutable' in response.headers['Cache-Control']
+    assert client.get(url, headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+def test_artifact_is_tagged_with_its_name(app, client):
+    location = upload(client, png_bytes(), png_bytes([(10, 10, 60, 90)])).headers['Location']
+    response = client.get(f"{location}/artifact/color2")
+    assert response.status_code == 200
+    with app.app.app_context():
+        comparison = app.db.session.get(app.Comparison, int(location.rsplit('/', 1)[1]))
+        assert response.get_etag() == (os.path.basename(comparison.color_diff2_path), False)
+    assert client.get(f"{location}/artifact/color2",
+                      headers={'If-None-Match': response.headers['ETag']}).status_code == 304
@@ -0,0 +1,52 @@
+# tests/test_storage.py - Storage quotas are enforced on what the upload actually writes
+import os
+from helpers import png_bytes, upload
+from storage import storage
+
+def stored_files(app):
+    folder = app.app.config['UPLOAD_FOLDER']
+    return [name for _, _, names in os.walk(folder) for name in names if not name.startswith('.')]
+
+def set_quota(app, quota):
+    with app.app.app_context():
+        app.User.query.filter_by(username='alice').one().storage_quota = quota
+        app.db.session.commit()
+
+def test_upload_over_quota_is_refused(app, client):
+    set_quota(app, 1000)
+    response = upload(client, png_bytes(), png_bytes([(10, 10, 60, 90)]))
+    assert response.headers['Location'].endswith('/compare')
+    with app.app.app_context():
+        assert app.Comparison.query.count() == 0
+    assert stored_files(app) == []
+
+def test_usage_counts_against_the_quota(app, client):
+    first = upload(client, png_bytes(), png_bytes([(10, 10, 60, 90)]))
+    with app.app.app_context():
+        used = app.db.session.get(app.Comparison, int(first.headers['Location'].rsplit('/', 1)[1])).storage_bytes
+    assert used > 0
+    set_quota(app, used + 1000)
+    assert upload(client, png_bytes(), png_bytes([(150, 200, 250, 350)])).headers['Location'].endswith('/compare')
+    with app.app.app_context():
+        assert app.Comparison.query.count() == 1
+
+def test_upload_without_a_length_is_refused(app, client):
+    response = client.post('/compare', data=b'x' * 1000, headers={'Transfer-Encoding': 'chunked'},
+                           content_type='multipart/form-data; boundary=x')
+    assert response.status_code == 411
+    assert stored_files(app) == []
+
+def test_quota_is_checked_again_on_the_ingested_sizes(app, client, monkeypatch):
+    # Another upload of the same user fills the quota while this one is being written
+    checks = []
+    def allows(user, incoming=0):
+        checks.append(incoming)
+        return len(checks) == 1
+    monkeypatch.setattr(storage, 'allows', allows)
+    baseline, candidate = png_bytes(), png_bytes([(10, 10, 60, 90)])
+    response = upload(client, baseline, candidate)
+    assert response.headers['Location'].endswith('/compare')
+    assert checks[1] == len(baseline) + len(candidate) < checks[0]
+    with app.app.app_context():
+        assert app.Comparison.query.count() == 0
+    assert stored_files(app) == []
@@ -0,0 +1,57 @@
+# tests/test_tiled_compare.py - The tiled engine renders the same pixels as the in-memory one
+import os
+import cv2
+import numpy as np
+import pytest
+from encoding import resolve_encoding
+from image_compare import compare_images
+from tiled_compare import compare_images_tiled, open_raster
+
+def make_pair(folder, ext):
+    rng = np.random.default_rng(0)
+    img1 = cv2.resize(rng.integers(0, 256, (30, 40, 3), dtype=np.uint8), (400, 300))
+    img2 = img1.copy()
+    img2[50:120, 60:200] = (0, 0, 255)
+    img2[200:260, 10:90] //= 2
+    paths = [str(folder / f"img{n}{ext}") for n in (1, 2)]
+    for path, img in zip(paths, (img1, img2)):
+        cv2.imwrite(path, img)
+    return paths
+
+@pytest.mark.parametrize('ext', ['.png', '.jpg', '.bmp', '.tif'])
+def test_decoded_bands_match_imread(tmp_path, ext):
+    path, _ = make_pair(tmp_path, ext)
+    source = open_raster(path, str(tmp_path), 'input1')
+    try:
+        bands = [source.read(top, min(top + 64, source.shape[0])) for top in range(0, source.shape[0], 64)]
+    finally:
+        source.close()
+    assert np.array_equal(np.vstack(bands), cv2.imread(path))
+
+@pytest.mark.parametrize('ext', ['.png', '.jpg'])
+@pytest.mark.parametrize('method', ['cie76', 'ciede2000'])
+def test_tiled_overlays_match_in_memory(tmp_path, ext, method):
+    path1, path2 = make_pair(tmp_path, ext)
+    encoding = resolve_encoding('png')
+    expected = compare_images(path1, path2, str(tmp_path / 'mem1.png'), str(tmp_path / 'mem2.png'),
+                              delta_e_method=method, overlay_encoding=encoding)
+    actual = compare_images_tiled(path1, path2, str(tmp_path / 'tiled1.png'), str(tmp_path / 'tiled2.png'),
+                                  delta_e_method=method, band_rows=256, workdir=str(tmp_path),
+                                  overlay_encoding=encoding)
+    assert sorted(actual) == ['color1', 'color2', 'gray1', 'gray2']
+    for kind in actual:
+        assert np.array_equal(cv2.imread(actual[kind]), cv2.imread(expected[kind])), kind
+
+def test_inputs_with_the_same_basename_keep_their_own_pixels(tmp_path):
+    paths = make_pair(tmp_path, '.png')
+    for n, path in enumerate(paths, 1):
+        (tmp_path / f"dir{n}").mkdir()
+        paths[n - 1] = str(tmp_path / f"dir{n}" / 'same.png')
+        os.replace(path, paths[n - 1])
+    encoding = resolve_encoding('png')
+    expected = compare_images(*paths, str(tmp_path / 'mem1.png'), str(tmp_path / 'mem2.png'),
+                              overlay_encoding=encoding)
+    actual = compare_images_tiled(*paths, str(tmp_path / 'tiled1.png'), str(tmp_path / 'tiled2.png'),
+                                  band_rows=256, workdir=str(tmp_path), overlay_encoding=encoding)
+    for kind in actual:
+        assert np.array_equal(cv2.imread(actual[kind]), cv2.imread(expected[kind])), kind
@@ -0,0 +1,50 @@
+# tests/test_uploads.py - Uploads are hashed while they are written and checked from their header
+import hashlib
+import io
+import os
+import pytest
+from werkzeug.datastructures import FileStorage
+from helpers import png_bytes, upload
+from uploads import HashingFile, UploadError, ingest_upload
+
+def test_hashing_file_hashes_and_measures_what_is_written(tmp_path):
+    data = png_bytes()
+    spooled = HashingFile(str(tmp_path))
+    for start in range(0, len(data), 1000):
+        spooled.write(memoryview(data)[start:start + 1000])
+    spooled.flush()
+    assert spooled.hexdigest() == hashlib.sha256(data).hexdigest()
+    assert spooled.size == len(data)
+    assert spooled.header == data[:64]
+    with open(spooled.name, 'rb') as f:
+        assert f.read() == data
+    spooled.close()
+    assert os.listdir(tmp_path) == []
+
+def test_ingest_moves_a_valid_image_into_place(tmp_path):
+    data = png_bytes(size=(120, 80))
+    info = ingest_upload(FileStorage(io.BytesIO(data), 'photo.png'), str(tmp_path), 'abc_img1')
+    assert info['path'] == str(tmp_path / 'abc_img1.png')
+    assert (info['sha256'], info['size']) == (hashlib.sha256(data).hexdigest(), len(data))
+    assert (info['format'], info['width'], info['height'], info['frames']) == ('PNG', 120, 80, 1)
+    assert os.listdir(tmp_path) == ['abc_img1.png']
+
+@pytest.mark.parametrize('data, limits', [
+    (b'not an image at all', {}),
+    (png_bytes(size=(120, 80)), {'max_pixels': 5000}),
+    (png_bytes(size=(120, 80)), {'max_dimension': 100}),
+])
+def test_rejected_upload_leaves_nothing_behind(tmp_path, data, limits):
+    with pytest.raises(UploadError):
+        ingest_upload(FileStorage(io.BytesIO(data), 'photo.png'), str(tmp_path), 'abc_img1', **limits)
+    assert os.listdir(tmp_path) == []
+
+def test_streamed_upload_stores_its_hash(app, client):
+    baseline, candidate = png_bytes(), png_bytes([(10, 10, 60, 90)])
+    response = upload(client, baseline, candidate)
+    with app.app.app_context():
+        comparison = app.db.session.get(app.Comparison, int(response.headers['Location'].rsplit('/', 1)[1]))
+        assert comparison.image1_sha256 == hashlib.sha256(baseline).hexdigest()
+        assert comparison.image2_sha256 == hashlib.sha256(candidate).hexdigest()
+        with open(comparison.image2_path, 'rb') as f:
+            assert f.read() == candidate
@@ -0,0 +1,333 @@
+# tiled_compare.py - Memory-bounded comparison of very large images
+#
+# Satellite scenes and print proofs are too large to hold several full-frame
+# copies in memory. This engine reads both inputs in row bands from raw
+# rasters on disk and writes the color and grayscale overlays band by band to
+# raw scratch files, using the same band kernels as the in-memory renderers in
+# image_compare, so both paths produce identical pixels. Resident memory stays
+# at a few bands whatever the image size, until the final encode.
+#
+# PNG, JPEG and BMP inputs are decoded by Pillow straight into a raw file on
+# disk (see decode_to_raw), so uploads never need a full-frame decode either;
+# other formats are decoded once with OpenCV and spilled (see spill_to_raw).
+import mmap
+import os
+import tempfile
+import cv2
+import numpy as np
+from PIL import Image
+from delta_e import delta_e_map
+from encoding import OUTPUT_FORMATS, encoding_for_path, write_image
+from image_compare import BAND_ROWS, color_overlay_band, gray_overlay_band
+from instrumentation import timed
+
+class RawRaster:
+    """
+    Row-band reader and writer over an uncompressed raster file.
+
+    Bands are read and written with plain file I/O rather than through a
+    memory map, so pages of the full frame never accumulate in the process.
+    """
+
+    def __init__(self, path, shape, dtype=np.uint8, offset=0, mode='rb'):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.offset = offset
+        self.row_shape = self.shape[1:]
+        self.row_bytes = int(np.prod(self.row_shape)) * self.dtype.itemsize
+        self._file = open(path, mode)
+
+    @classmethod
+    def open_npy(cls, path):
+        with open(path, 'rb') as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+        if fortran_order:
+            raise ValueError(f"{path} is stored in Fortran order")
+        return cls(path, shape, dtype, offset)
+
+    @classmethod
+    def create_npy(cls, path, shape, dtype=np.uint8):
+        """Creates an .npy file of the given shape that can be filled band by band."""
+        with open(path, 'wb') as f:
+            np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                                     'fortran_order': False, 'shape': tuple(shape)})
+            offset = f.tell()
+            f.truncate(offset + int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        return cls(path, shape, dtype, offset, mode='r+b')
+
+    def read(self, top, bottom):
+        self._file.seek(self.offset + top * self.row_bytes)
+        band = np.fromfile(self._file, dtype=self.dtype, count=(bottom - top) * self.row_bytes // self.dtype.itemsize)
+        return band.reshape((bottom - top,) + self.row_shape)
+
+    def write(self, top, band):
+        self._file.seek(self.offset + top * self.row_bytes)
+        self._file.write(np.ascontiguousarray(band, dtype=self.dtype).data)
+
+    def close(self):
+        self._file.close()
+
+class ArraySource(RawRaster):
+    """Band reader over a raw uint8 BGR .npy file."""
+
+    def __init__(self, path, shape, dtype=np.uint8, offset=0, mode='rb'):
+        if len(shape) != 3 or shape[2] != 3 or np.dtype(dtype) != np.uint8:
+            raise ValueError(f"Expected a uint8 BGR array, got {np.dtype(dtype)} {tuple(shape)}")
+        super().__init__(path, shape, dtype, offset, mode)
+
+class PPMSource(RawRaster):
+    """Band reader over a binary 8-bit PPM (P6) file."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            head = f.read(1024)
+        fields = []
+        pos = 0
+        while len(fields) < 4:
+            while head[pos:pos + 1].isspace():
+                pos += 1
+            if head[pos:pos + 1] == b'#':
+                pos = head.index(b'\n', pos) + 1
+                continue
+            end = pos
+            while not head[end:end + 1].isspace():
+                end += 1
+            fields.append(head[pos:end])
+            pos = end
+        magic, width, height, maxval = fields[0], int(fields[1]), int(fields[2]), int(fields[3])
+        if magic != b'P6' or maxval > 255:
+            raise ValueError(f"{path} is not an 8-bit binary PPM")
+        super().__init__(path, (height, width, 3), np.uint8, offset=pos + 1)
+
+    def read(self, top, bottom):
+        return cv2.cvtColor(super().read(top, bottom), cv2.COLOR_RGB2BGR)
+
+# Pillow codecs that write the frame row by row as their input is read
+STREAMED_CODECS = ('zip', 'jpeg', 'raw')
+
+# Conversion to BGR of each Pillow mode decode_to_raw handles; RGB frames are
+# stored with a padding byte per pixel, like Pillow holds them in memory
+STREAMED_MODES = {'RGB': cv2.COLOR_RGBA2BGR, 'RGBA': cv2.COLOR_RGBA2BGR, 'L': cv2.COLOR_GRAY2BGR}
+
+# Compressed bytes read between two flushes of the decoded rows
+DECODE_FLUSH_BYTES = 1 << 20
+
+EXIF_ORIENTATION = 0x0112
+
+class DecodedSource(RawRaster):
+    """Band reader over a frame decoded by decode_to_raw, converting each band to BGR."""
+
+    def __init__(self, path, shape, conversion):
+        super().__init__(path, shape)
+        self.shape = tuple(shape[:2]) + (3,)  # of the BGR bands read returns
+        self.conversion = conversion
+
+    def read(self, top, bottom):
+        return cv2.cvtColor(super().read(top, bottom), self.conversion)
+
+class _FlushingReader:
+    """File wrapper that writes back and drops the decoded pages of mapping as the decoder reads its input."""
+
+    def __init__(self, fp, mapping):
+        self._fp = fp
+        self._mapping = mapping
+        self._unflushed = 0
+
+    def read(self, size=-1):
+        data = self._fp.read(size)
+        self._unflushed += len(data)
+        if self._unflushed >= DECODE_FLUSH_BYTES:
+            _drop_pages(self._mapping)
+            self._unflushed = 0
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._fp, name)
+
+def _drop_pages(mapping):
+    mapping.flush()
+    if hasattr(mapping, 'madvise'):  # not on Windows
+        mapping.madvise(mmap.MADV_DONTNEED)
+
+def _exif_rotated(img):
+    """True if img carries an EXIF orientation, which cv2.imread would apply."""
+    if not img.info.get('exif'):
+        return False
+    exif = Image.Exif()
+    exif.load(img.info['exif'])
+    return exif.get(EXIF_ORIENTATION, 1) != 1
+
+def decode_to_raw(image_path, raw_path):
+    """
+    Decodes an image into a raw file on disk without holding the frame in memory.
+
+    Pillow's PNG, JPEG and BMP decoders write the frame row by row as they
+    read the compressed data. Here they write into a shared mapping of
+    raw_path whose pages are written back and dropped every
+    DECODE_FLUSH_BYTES of input, so only the rows decoded since then are
+    resident.
+
+    Returns:
+        DecodedSource over raw_path, or None for images this cannot decode
+        exactly like cv2.imread (other codecs and modes, EXIF rotation);
+        those go through spill_to_raw.
+    """
+    with Image.open(image_path) as img:
+        if (img.mode not in STREAMED_MODES or len(img.tile) != 1 or img.tile[0][0] not in STREAMED_CODECS
+                or _exif_rotated(img)):
+            return None
+        width, height = img.size
+        shape = (height, width) if img.mode == 'L' else (height, width, 4)
+        conversion = STREAMED_MODES[img.mode]
+        with open(raw_path, 'w+b') as f:
+            f.truncate(int(np.prod(shape)))
+            mapping = mmap.mmap(f.fileno(), int(np.prod(shape)))
+        try:
+            # Pillow decodes into the image it finds in place of allocating one
+            img.im = Image.core.map_buffer(mapping, (width, height), 'raw', 0, (img.mode, 0, 1))
+            img.filename = None  # else Pillow maps uncompressed files itself
+            img.fp = _FlushingReader(img.fp, mapping)
+            img.load()
+            _drop_pages(mapping)
+        finally:
+            img.close()  # releases the image's hold on the mapping
+            mapping.close()
+    return DecodedSource(raw_path, shape, conversion)
+
+def spill_to_raw(image_path, raw_path):
+    """
+    Decodes an image once and stores it as a raw .npy file for banded reading.
+
+    Used for the formats decode_to_raw cannot stream (TIFF, WebP, GIF, ...),
+    so this is the one step whose memory grows with the image. Convert huge
+    inputs of those formats ahead of time (or upload them as .npy/.ppm) to
+    avoid it.
+    """
+    img = cv2.imread(image_path, cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError(f"Could not decode {image_path}")
+    np.save(raw_path, img)
+    return raw_path
+
+def open_raster(image_path, workdir, name):
+    """
+    Returns a band reader for image_path, spilling compressed formats to workdir.
+
+    The scratch file is named after name rather than the input, since both
+    inputs of a comparison may share a basename.
+    """
+    ext = os.path.splitext(image_path)[1].lower()
+    if ext in ('.ppm', '.pnm'):
+        return PPMSource(image_path)
+    if ext != '.npy':
+        raw_path = os.path.join(workdir, name)
+        source = decode_to_raw(image_path, raw_path + '.raw')
+        if source is not None:
+            return source
+        image_path = spill_to_raw(image_path, raw_path + '.npy')
+    return ArraySource.open_npy(image_path)
+
+def _bands(height, band_rows):
+    for top in range(0, height, band_rows):
+        yield top, min(top + band_rows, height)
+
+def render_overlays_tiled(source1, source2, workdir, mode="both", alpha=0.7, delta_e_method="cie76",
+                          threshold=50, band_rows=BAND_ROWS):
+    """
+    Renders the overlays of two band readers into raw .npy files in workdir.
+
+    The color path makes two passes: the first computes the Delta-E map (spilled
+    to a float32 raster) and its global range, the second applies the heatmap.
+    The grayscale path needs a single pass.
+
+    Returns:
+        dict mapping "color"/"gray" to the pair of .npy paths of the overlays.
+    """
+    if source1.shape != source2.shape:
+        raise ValueError(f"Images must have the same shape, got {source1.shape} and {source2.shape}")
+    if band_rows % BAND_ROWS:
+        raise ValueError(f"band_rows must be a multiple of {BAND_ROWS}")
+    height, width = source1.shape[:2]
+
+    def output(name, dtype=np.uint8, shape=source1.shape):
+        return RawRaster.create_npy(os.path.join(workdir, f"{name}.npy"), shape, dtype)
+
+    band_shape = (min(band_rows, height),) + source1.shape[1:]
+    out1 = np.empty(band_shape, dtype=np.uint8)
+    out2 = np.empty(band_shape, dtype=np.uint8)
+    overlays = {}
+
+    if mode in ["both", "color"]:
+        delta_e = output('delta_e', np.float32, (height, width))
+        band_delta_e = np.empty(band_shape[:2], dtype=np.float32)
+        lo, hi = np.inf, -np.inf
+        for top, bottom in _bands(height, band_rows):
+            band = delta_e_map(source1.read(top, bottom), source2.read(top, bottom), delta_e_method,
+                               out=band_delta_e[:bottom - top])
+            band_lo, band_hi, _, _ = cv2.minMaxLoc(band)
+            lo, hi = min(lo, band_lo), max(hi, band_hi)
+            delta_e.write(top, band)
+
+        color1, color2 = output('color1'), output('color2')
+        for top, bottom in _bands(height, band_rows):
+            n = bottom - top
+            color_overlay_band(source1.read(top, bottom), source2.read(top, bottom), delta_e.read(top, bottom),
+                               lo, hi, out1[:n], out2[:n])
+            color1.write(top, out1[:n])
+            color2.write(top, out2[:n])
+        for raster in (delta_e, color1, color2):
+            raster.close()
+        os.remove(delta_e.path)
+        overlays["color"] = (color1.path, color2.path)
+
+    if mode in ["both", "grayscale"]:
+        gray1, gray2 = output('gray1'), output('gray2')
+        for top, bottom in _bands(height, band_rows):
+            n = bottom - top
+            gray_overlay_band(source1.read(top, bottom), source2.read(top, bottom), alpha, threshold,
+                              out1[:n], out2[:n])
+            gray1.write(top, out1[:n])
+            gray2.write(top, out2[:n])
+        gray1.close()
+        gray2.close()
+        overlays["gray"] = (gray1.path, gray2.path)
+
+    return overlays
+
+@timed('tiled_compare')
+def compare_images_tiled(image_path1, image_path2, output_path1, output_path2, mode="both", alpha=0.7,
+                         delta_e_method="cie76", threshold=50, band_rows=BAND_ROWS, workdir=None,
+                         overlay_encoding=None):
+    """
+    Tiled counterpart of image_compare.compare_images for inputs at native resolution.
+
+    Takes the same output paths and overlay encoding and returns the same
+    result dict. Scratch rasters go to a temporary directory under workdir
+    (the system temp directory by default) and are removed afterwards. The
+    encoders need the whole frame, so each overlay is memory-mapped read-only
+    while it is encoded; those pages are clean and backed by the scratch file.
+    """
+    results = {}
+    overlay_encoding = overlay_encoding or encoding_for_path(output_path1)
+    ext = OUTPUT_FORMATS[overlay_encoding['format']]['ext']
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        source1 = open_raster(image_path1, tmp, 'input1')
+        source2 = open_raster(image_path2, tmp, 'input2')
+        try:
+            overlays = render_overlays_tiled(source1, source2, tmp, mode, alpha, delta_e_method, threshold,
+                                             band_rows)
+        finally:
+            source1.close()
+            source2.close()
+        for kind, raw_paths in overlays.items():
+            for n, (raw_path, output_path) in enumerate(zip(raw_paths, [output_path1, output_path2]), 1):
+                path = f"{os.path.splitext(output_path)[0]}_{kind}{n}{ext}"
+                write_image(path, np.load(raw_path, mmap_mode='r'), overlay_encoding)
+                results[f"{kind}{n}"] = path
+    return results
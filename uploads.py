@@ -0,0 +1,154 @@
+# uploads.py - Streaming ingestion of uploaded images
+#
+# StreamingUploadRequest makes Werkzeug write every uploaded file straight into
+# the upload folder while hashing it, so an upload is never held in memory and
+# never copied a second time. ingest_upload then checks the header (magic bytes
+# and the dimensions Pillow reads without decoding pixels) and moves the file
+# to its final name with the right extension, or rejects it before any decode.
+import hashlib
+import os
+import tempfile
+from flask import Request, current_app
+from PIL import Image
+
+# Magic bytes of the formats OpenCV can decode, with the extension we store them under
+SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'PNG', 'png'),
+    (b'\xff\xd8\xff', 'JPEG', 'jpg'),
+    (b'GIF87a', 'GIF', 'gif'),
+    (b'GIF89a', 'GIF', 'gif'),
+    (b'BM', 'BMP', 'bmp'),
+    (b'II*\x00', 'TIFF', 'tif'),
+    (b'MM\x00*', 'TIFF', 'tif'),
+]
+
+HEADER_BYTES = 64
+
+class UploadError(ValueError):
+    """Raised when an upload is not an acceptable image."""
+
+def sniff_format(header):
+    """Returns (format, extension) for the leading bytes of a file, or (None, None)."""
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'WEBP', 'webp'
+    for magic, fmt, ext in SIGNATURES:
+        if header.startswith(magic):
+            return fmt, ext
+    return None, None
+
+class HashingFile:
+    """
+    Temporary file in the upload folder that hashes everything written to it.
+
+    The file is deleted on close unless ingest_upload has moved it to its
+    final name.
+    """
+
+    def __init__(self, directory):
+        fd, self.name = tempfile.mkstemp(prefix='.upload-', dir=directory)
+        self._file = os.fdopen(fd, 'w+b')
+        self._digest = hashlib.sha256()
+        self.header = b''
+        self.size = 0
+        self.kept = False
+
+    def write(self, data):
+        self._digest.update(data)
+        if len(self.header) < HEADER_BYTES:
+            self.header += bytes(data[:HEADER_BYTES - len(self.header)])
+        self.size += len(data)
+        return self._file.write(data)
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+        if not self.kept:
+            try:
+                os.remove(self.name)
+            except FileNotFoundError:
+                pass
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+class StreamingUploadRequest(Request):
+    """Request class that spools uploaded files into the upload folder as they arrive."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        directory = current_app.config['UPLOAD_FOLDER']
+        os.makedirs(directory, exist_ok=True)
+        return HashingFile(directory)
+
+def _spool(file_storage, directory, chunk_size=64 * 1024):
+    """Copies a non-spooled upload to a HashingFile in chunks."""
+    spooled = HashingFile(directory)
+    for chunk in iter(lambda: file_storage.stream.read(chunk_size), b''):
+        spooled.write(chunk)
+    spooled.flush()
+    return spooled
+
+def ingest_upload(file_storage, directory, basename, max_pixels=None, max_dimension=None):
+    """
+    Validates an uploaded image from its header and moves it into place.
+
+    Args:
+        file_storage: The werkzeug FileStorage from request.files
+        directory: Upload folder
+        basename: File name without extension, e.g. "<uid>_img1"
+        max_pixels: Reject images with more pixels than this
+        max_dimension: Reject images wider or taller than this
+
+    Returns:
+        dict with path, sha256, format, width, height, frames (more than 1
+        for animated images) and size (bytes).
+
+    Raises:
+        UploadError: if the file is not a supported image or is too large.
+    """
+    spooled = file_storage.stream
+    if not isinstance(spooled, HashingFile):
+        spooled = _spool(file_storage, directory)
+    else:
+        spooled.flush()
+
+    label = file_storage.filename or basename
+    try:
+        fmt, ext = sniff_format(spooled.header)
+        if fmt is None:
+            raise UploadError(f'{label} is not a supported image (PNG, JPEG, GIF, BMP, TIFF or WebP)')
+
+        try:
+            with Image.open(spooled.name) as header:
+                width, height = header.size
+                frames = getattr(header, 'n_frames', 1)
+        except Image.DecompressionBombError:
+            raise UploadError(f'{label} has too many pixels')
+        except Exception:
+            raise UploadError(f'{label} has a corrupt or unreadable image header')
+
+        if max_pixels and width * height > max_pixels:
+            raise UploadError(f'{label} is {width}x{height}, more than the {max_pixels // 10 ** 6} megapixel limit')
+        if max_dimension and max(width, height) > max_dimension:
+            raise UploadError(f'{label} is {width}x{height}, larger than {max_dimension} pixels on a side')
+
+        path = os.path.join(directory, f"{basename}.{ext}")
+        os.replace(spooled.name, path)
+        spooled.kept = True
+    finally:
+        spooled.close()
+
+    return {
+        'path': path,
+        'sha256': spooled.hexdigest(),
+        'format': fmt,
+        'width': width,
+        'height': height,
+        'frames': frames,
+        'size': spooled.size,
+    }